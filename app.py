@@ -1,15 +1,25 @@
 import os
+import io
+import json
+import queue
+import asyncio
+import tempfile
+import threading
 import requests
 import flask
 import time
 import sys
 import traceback
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 
 from flask import Flask, request, render_template, jsonify
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-from functools import lru_cache
+from image_context import ImageContext
+from cache_store import get_cache, cache_stats
+from http_clients import get_http_session, get_async_http_client, get_openai_client, HTTP_TIMEOUT
+from places_plan import PlacesPlan, page_cache_key, trim_place, needs_details
+from metrics import stage, timed, in_request_context, begin_request, finish_request, render_metrics
 
 # セキュリティ強化
 try:
@@ -38,19 +48,19 @@ except ImportError:
     pass
 
 try:
-    from shikisai import get_color_emotions
+    from shikisai import analyze_colors
     SHIKISAI_AVAILABLE = True
 except ImportError:
     pass
 
 try:
-    from buttai import load_model, process_buttai
+    from buttai import process_buttai, inference_stats, can_preload, warm_up as warm_up_model
     BUTTAI_AVAILABLE = True
 except ImportError:
     pass
 
 try:
-    from emo_gpt_1 import process_emo
+    from emo_gpt_1 import process_emo, provides_scene_label
     EMO_GPT_AVAILABLE = True
 except ImportError:
     pass
@@ -154,9 +164,11 @@ def test_functionality():
     # 色彩分析テスト
     if SHIKISAI_AVAILABLE:
         try:
-            from shikisai import load_emotion_mapping
+            from shikisai import load_emotion_mapping, load_color_index
             df = load_emotion_mapping()
-            print(f"  🎨 色彩分析: ✅ 動作確認 (感情データ: {len(df)}件)")
+            # 色→感情インデックスをfork前に読み込み（ワーカー間でページ共有）
+            index = load_color_index()
+            print(f"  🎨 色彩分析: ✅ 動作確認 (感情データ: {len(df)}件, 語彙: {len(index['vocab'])}語)")
         except Exception as e:
             print(f"  🎨 色彩分析: ❌ エラー ({str(e)[:30]})")
     else:
@@ -208,11 +220,17 @@ load_dotenv(os.path.join(basedir, '.env'), override=True)
 template_dir = os.path.join(basedir, 'templates')
 static_dir = os.path.join(basedir, 'static')
 
+class InMemoryRequest(flask.Request):
+    """アップロードを一時ファイルに退避せずメモリ上で受け取る（MAX_CONTENT_LENGTHで上限あり）"""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
 app = Flask(
     __name__,
     template_folder=template_dir,
     static_folder=static_dir
 )
+app.request_class = InMemoryRequest
 
 # 基本設定
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
@@ -261,6 +279,28 @@ def handle_exception(e):
         'message': 'サーバーで問題が発生しました。管理者にお問い合わせください。'
     }), 500
 
+# 処理段階の計測（Server-Timingヘッダー・/metrics）。/metrics自身と静的ファイルは数えない
+UNMETERED_ENDPOINTS = ('metrics', 'static')
+
+@app.before_request
+def begin_metrics():
+    if request.endpoint not in UNMETERED_ENDPOINTS:
+        flask.g.metrics_token = begin_request(request.endpoint or 'unknown')
+
+@app.after_request
+def add_server_timing(response):
+    token = flask.g.pop('metrics_token', None)
+    if token is not None:
+        response.headers['Server-Timing'] = finish_request(token, response.status_code)
+    return response
+
+@app.teardown_request
+def end_metrics(exc):
+    # after_requestを通らずに終わった場合も処理中の数を戻す
+    token = flask.g.pop('metrics_token', None)
+    if token is not None:
+        finish_request(token, 500)
+
 # 静的ファイルキャッシュ設定
 @app.after_request
 def add_header(response):
@@ -290,12 +330,28 @@ def dated_url_for(endpoint, **values):
         return flask.url_for(endpoint, **values)
 
 # アップロードディレクトリ設定
+# 通常はディスクに保存せずメモリ上で分析する。デバッグ時のみ EMOTABI_DEBUG_CAPTURE=1 で保存
 UPLOAD_DIR = os.path.join(app.static_folder or static_dir, 'uploads')
-try:
-    os.makedirs(UPLOAD_DIR, exist_ok=True)
-    app.config['UPLOAD_FOLDER'] = UPLOAD_DIR
-except Exception:
-    pass
+DEBUG_CAPTURE = os.getenv('EMOTABI_DEBUG_CAPTURE', '').strip().lower() in ('1', 'true', 'yes')
+app.config['UPLOAD_FOLDER'] = UPLOAD_DIR
+if DEBUG_CAPTURE:
+    try:
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+    except Exception:
+        pass
+
+def capture_upload(data, filename):
+    """デバッグ用にアップロード画像を保存（EMOTABI_DEBUG_CAPTURE有効時のみ）"""
+    import uuid
+    file_extension = os.path.splitext(secure_filename(filename))[1]
+    unique_filename = f"upload_{int(time.time())}_{uuid.uuid4().hex[:8]}{file_extension}"
+    save_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+    try:
+        with open(save_path, 'wb') as out:
+            out.write(data)
+        print(f"📸 デバッグ保存: {save_path}")
+    except OSError as e:
+        print(f"📸 デバッグ保存失敗: {e}")
 
 # Google Maps APIクライアント初期化
 gmaps = None
@@ -317,154 +373,459 @@ def init_gmaps():
             gmaps = None
 
 # モデル初期化
+# --preloadではfork前にマスタープロセスでモデルを読み込み、ウォームアップ推論まで済ませる
+# （重みはワーカー間でコピーオンライト共有）。各ワーカーはfork直後にバックグラウンドで
+# 外部APIクライアントの作成と自プロセスでの推論を済ませ、完了後にreadyになる。
+WARMUP_ENABLED = os.getenv('EMOTABI_WARMUP', '1').strip().lower() not in ('0', 'false', 'no')
+WARMUP_TIMEOUT = float(os.getenv('EMOTABI_WARMUP_TIMEOUT', '120'))
 model_loaded = False
+_model_init_lock = threading.Lock()
+_ready = threading.Event()
 
-def init_model():
+def load_model_once(single_thread=False):
+    """モデルを1回だけ読み込み、ウォームアップ推論まで行う（同時に呼ばれても二重に読み込まない）"""
     global model_loaded
-    if not model_loaded and BUTTAI_AVAILABLE:
+    if model_loaded or not BUTTAI_AVAILABLE:
+        return
+    with _model_init_lock:
+        if model_loaded:
+            return
         try:
-            load_model()
+            warm_up_model(single_thread=single_thread)
             model_loaded = True
         except Exception:
             model_loaded = False
 
-@lru_cache(maxsize=128)
-def cached_places_search(query, language='ja'):
-    """Places APIの結果をキャッシュ（直接requests使用）"""
-    # 複数の方法でAPIキーを取得
-    api_key = get_google_maps_api_key()
-    
-    if not api_key:
-        return []
-    
-    # 直接requests でPlaces Text Search APIを呼び出し
-    import requests
-    url = "https://maps.googleapis.com/maps/api/place/textsearch/json"
-    params = {
-        'query': query,
+def init_model():
+    """リクエストから呼ぶ: ワーカーのウォームアップ中なら完了を待ち、未読み込みなら読み込む"""
+    _ready.wait(WARMUP_TIMEOUT)
+    load_model_once()
+
+def init_clients():
+    """外部APIクライアント（Google API用セッション・OpenAI）をこのプロセス用に作成"""
+    get_http_session()
+    get_openai_client()
+
+def preload():
+    """fork前（マスタープロセス）の初期化: fork後も安全なバックエンドならモデルを読み込んでウォームアップ"""
+    if BUTTAI_AVAILABLE and can_preload():
+        start = time.time()
+        load_model_once(single_thread=True)
+        print(f"🔥 モデル事前読み込み: {'完了' if model_loaded else '失敗'} ({time.time() - start:.2f}s)")
+
+def warm_up_worker():
+    """ワーカーの初期化（クライアント作成・モデル読み込み・自プロセスでの初回推論）。最後にreadyにする"""
+    start = time.time()
+    try:
+        init_clients()
+        if BUTTAI_AVAILABLE:
+            if model_loaded:
+                # 事前読み込み済みの重みで、このプロセスの推論スレッドを初期化
+                warm_up_model()
+            else:
+                load_model_once()
+    except Exception as e:
+        print(f"⚠️  ウォームアップ失敗: {e}")
+    finally:
+        _ready.set()
+        print(f"✅ ワーカー準備完了 (pid {os.getpid()}, {time.time() - start:.2f}s)")
+
+def start_worker_warm_up():
+    """fork直後の子プロセスで、ウォームアップをバックグラウンドで開始"""
+    _ready.clear()
+    threading.Thread(target=warm_up_worker, name='warm-up', daemon=True).start()
+
+if WARMUP_ENABLED:
+    preload()
+    os.register_at_fork(after_in_child=start_worker_warm_up)
+# forkせずにこのプロセスで処理する場合（python app.py など）は読み込み済みのモデルでそのまま受け付ける
+_ready.set()
+
+# Places検索結果キャッシュ（ワーカー間共有・再起動後も保持）
+# 正常な結果は長めのTTL、タイムアウトやクォータエラーは短いTTLで再試行させる
+PLACES_CACHE_TTL = int(os.getenv('EMOTABI_PLACES_CACHE_TTL', str(24 * 3600)))
+PLACES_NEGATIVE_TTL = int(os.getenv('EMOTABI_PLACES_NEGATIVE_TTL', '60'))
+PLACES_CACHE_MAX = int(os.getenv('EMOTABI_PLACES_CACHE_MAX', '2000'))
+places_cache = get_cache('places', max_entries=PLACES_CACHE_MAX, default_ttl=PLACES_CACHE_TTL)
+
+# Places API呼び出し用の共有スレッドプール（件数上限付き）
+PLACES_DETAILS_WORKERS = int(os.getenv('EMOTABI_PLACES_DETAILS_WORKERS', '12'))
+# /analyze/stream で分析全体を待つスレッド数（各分析はさらに3スレッドで並列実行）
+ANALYSIS_STREAM_WORKERS = int(os.getenv('EMOTABI_ANALYSIS_STREAM_WORKERS', '4'))
+_executors = {}
+_executors_lock = threading.Lock()
+
+def get_executor(name, max_workers):
+    """用途別の共有スレッドプール（--preloadのfork後はワーカーごとに作り直す）"""
+    key = (name, os.getpid())
+    executor = _executors.get(key)
+    if executor is None:
+        # 同時の初回リクエストがそれぞれ作って余りがリークしないよう、作成はロック内で1回だけ
+        with _executors_lock:
+            executor = _executors.get(key)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+                _executors[key] = executor
+    return executor
+
+# Places APIのエンドポイント（負荷試験ではEMOTABI_GOOGLE_MAPS_BASE_URLでスタブサーバーに向ける）
+GOOGLE_MAPS_BASE_URL = os.getenv('EMOTABI_GOOGLE_MAPS_BASE_URL', 'https://maps.googleapis.com').rstrip('/')
+PLACES_TEXTSEARCH_URL = f"{GOOGLE_MAPS_BASE_URL}/maps/api/place/textsearch/json"
+PLACES_DETAILS_URL = f"{GOOGLE_MAPS_BASE_URL}/maps/api/place/details/json"
+PLACES_DETAILS_FIELDS = 'name,formatted_address,rating,photos,place_id'
+# next_page_tokenは発行直後には有効にならないため、次ページの取得前に待つ秒数
+PLACES_PAGE_TOKEN_DELAY = float(os.getenv('EMOTABI_PLACES_PAGE_TOKEN_DELAY', '2'))
+
+def place_details_params(place_id, api_key, language='ja'):
+    """Place Details APIのパラメータ"""
+    return {
+        'place_id': place_id,
+        'fields': PLACES_DETAILS_FIELDS,
         'language': language,
         'key': api_key
     }
-    
+
+def text_search_params(step, api_key, language='ja'):
+    """Text Search APIのパラメータ（次ページの取得はpagetokenのみ）"""
+    if step.page_token:
+        return {'pagetoken': step.page_token, 'key': api_key}
+    return {
+        'query': step.query,
+        'language': language,
+        'key': api_key
+    }
+
+def parse_place_details(place, status_code, data):
+    """Place Detailsの応答を解釈。戻り値: (place, ok)。失敗時は検索結果をそのまま返す"""
+    if status_code == 200 and data.get('status') == 'OK' and 'result' in data:
+        return trim_place(data['result']), True
+    return place, False
+
+def parse_text_search(status_code, data):
+    """Text Searchの応答を解釈。戻り値: (page, ok)。ZERO_RESULTSは正常な結果"""
+    if status_code != 200:
+        return {'places': []}, False
+    status = data.get('status', 'UNKNOWN')
+    if status == 'OK':
+        page = {'places': [trim_place(place) for place in data.get('results', [])]}
+        if data.get('next_page_token'):
+            page['next_page_token'] = data['next_page_token']
+        return page, True
+    elif status == 'ZERO_RESULTS':
+        # 該当なしは正常な結果としてキャッシュする
+        return {'places': []}, True
+    return {'places': []}, False
+
+def details_cache_key(place, language='ja'):
+    """Place Detailsのキャッシュキー（検索ページのキー "言語:クエリ" とは重ならない）"""
+    return f"{language}#details:{place['place_id']}"
+
+def cached_first_pages(plan, language='ja'):
+    """未実行クエリの1ページ目のうち、キャッシュ済みのもの（{key: page}）"""
+    pages = {}
+    for key in plan.pending_keys():
+        page = places_cache.get(page_cache_key(language, key))
+        if page is not None:
+            pages[key] = page
+    return pages
+
+def store_places_result(cache_key, value, ok):
+    """Places APIの結果を保存（失敗は短いTTLでネガティブキャッシュ）"""
+    places_cache.set(cache_key, value, ttl=PLACES_CACHE_TTL if ok else PLACES_NEGATIVE_TTL)
+
+def cacheable_page(page):
+    """保存用の検索ページ（next_page_tokenは数分で失効するため保存せず、次ページの有無だけを残す）
+
+    キャッシュから読んだページの次ページは、同じく保存済みの "#p2" 以降のページがある場合のみ使う。
+    """
+    if not page.get('next_page_token'):
+        return page
+    stored = {k: v for k, v in page.items() if k != 'next_page_token'}
+    stored['has_next_page'] = True
+    return stored
+
+def log_places_plan(queries, plan):
+    print(f"検索計画: クエリ{len(queries)}件 → {plan.searches}ページ（キャッシュ含む）で{len(plan.places)}件を選択")
+
+def fetch_place_details(place, api_key, language='ja'):
+    """1件分のPlace Detailsを取得。戻り値: (place, ok)。失敗時は検索結果をそのまま返す"""
     try:
-        response = requests.get(url, params=params, timeout=10)
+        place_id = place.get('place_id')
+        if not place_id:
+            return place, True
         
-        if response.status_code == 200:
-            data = response.json()
-            status = data.get('status', 'UNKNOWN')
-            
-            if status == 'OK':
-                places = data.get('results', [])[:3]
-                
-                # 各場所の詳細情報を取得（同じくrequests使用）
-                detailed_places = []
-                for place in places:
-                    try:
-                        place_id = place.get('place_id')
-                        name = place.get('name', 'Unknown')
-                        
-                        if place_id:
-                            # Place Details API呼び出し
-                            details_url = "https://maps.googleapis.com/maps/api/place/details/json"
-                            details_params = {
-                                'place_id': place_id,
-                                'fields': 'name,formatted_address,rating,photos,place_id',
-                                'language': language,
-                                'key': api_key
-                            }
-                            
-                            details_response = requests.get(details_url, params=details_params, timeout=10)
-                            
-                            if details_response.status_code == 200:
-                                details_data = details_response.json()
-                                if details_data.get('status') == 'OK' and 'result' in details_data:
-                                    detailed_places.append(details_data['result'])
-                                else:
-                                    detailed_places.append(place)
-                            else:
-                                detailed_places.append(place)
-                        else:
-                            detailed_places.append(place)
-                            
-                    except Exception:
-                        detailed_places.append(place)
-                
-                return detailed_places
-                
-            else:
-                return []
-        else:
-            return []
+        # Place Details API呼び出し
+        with stage('places_details'):
+            details_response = get_http_session().get(
+                PLACES_DETAILS_URL, params=place_details_params(place_id, api_key, language), timeout=HTTP_TIMEOUT
+            )
+        data = details_response.json() if details_response.status_code == 200 else {}
+        return parse_place_details(place, details_response.status_code, data)
+        
+    except Exception:
+        return place, False
+
+def cached_place_details(place, api_key, language='ja'):
+    """表示項目が足りない場所のみDetailsで補う（place_idごとにキャッシュ）"""
+    if not needs_details(place):
+        return place
+    
+    cache_key = details_cache_key(place, language)
+    cached = places_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    detailed, ok = fetch_place_details(place, api_key, language)
+    store_places_result(cache_key, detailed, ok)
+    return detailed
+
+def fetch_text_search(step, api_key, language='ja'):
+    """Places Text Searchを1ページ分実行（キャッシュなし）
+
+    戻り値: (page, ok)。okがFalseの場合はタイムアウト・クォータ超過などの一時的な失敗。
+    """
+    if step.page_token:
+        time.sleep(PLACES_PAGE_TOKEN_DELAY)
+    
+    try:
+        # 共有セッション（Keep-Alive）でPlaces Text Search APIを呼び出し
+        with stage('places_search'):
+            response = get_http_session().get(
+                PLACES_TEXTSEARCH_URL, params=text_search_params(step, api_key, language), timeout=HTTP_TIMEOUT
+            )
+        data = response.json() if response.status_code == 200 else {}
+        return parse_text_search(response.status_code, data)
             
     except requests.exceptions.Timeout:
-        return []
+        return {'places': []}, False
         
     except requests.exceptions.RequestException:
-        return []
+        return {'places': []}, False
         
     except Exception:
-        return []
+        return {'places': []}, False
 
-def optimize_image(file_path, max_size=(320, 320)):
-    """画像サイズ最適化"""
-    if not CV2_AVAILABLE:
-        return True
+def text_search_page(step, api_key, language='ja'):
+    """検索計画の1手順を実行し、結果のページをキャッシュ"""
+    cache_key = page_cache_key(language, step.key, step.page_no)
+    if step.page_no > 1:
+        # 1ページ目は計画時にキャッシュを確認済み
+        cached = places_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        if not step.page_token:
+            # キャッシュから読んだページの続き（トークンが無いので取得できない）
+            return {'places': []}
+    
+    page, ok = fetch_text_search(step, api_key, language)
+    store_places_result(cache_key, cacheable_page(page), ok)
+    return page
+
+def plan_places(queries, api_key, language='ja'):
+    """検索計画に沿ってText Searchを実行し、重複しない場所を選ぶ（Detailsは未取得）"""
+    plan = PlacesPlan(queries)
+    plan.use_cached(cached_first_pages(plan, language))
+    while True:
+        step = plan.next_step()
+        if step is None:
+            break
+        plan.add_page(step.key, step.query, text_search_page(step, api_key, language), step.page_no)
+    log_places_plan(queries, plan)
+    return plan.places
+
+def iter_places(queries, language='ja'):
+    """提案する場所を順に返す（Detailsが必要な場所は共有プールで並列に取得）"""
+    # 複数の方法でAPIキーを取得
+    api_key = get_google_maps_api_key()
+    
+    if not api_key:
+        return
+    
+    places = plan_places(queries, api_key, language)
+    executor = get_executor('places-details', PLACES_DETAILS_WORKERS)
+    details = in_request_context(lambda p: cached_place_details(p, api_key, language))
+    for i, place in enumerate(executor.map(details, places), 1):
+        print(f"提案{i} → {place.get('name', 'Unknown')}を取得")
+        yield place
+
+async def fetch_place_details_async(place, api_key, language='ja'):
+    """fetch_place_detailsの非同期版（ASGIモード用、共有httpx.AsyncClientを使用）"""
+    try:
+        place_id = place.get('place_id')
+        if not place_id:
+            return place, True
+        
+        with stage('places_details'):
+            response = await get_async_http_client().get(
+                PLACES_DETAILS_URL, params=place_details_params(place_id, api_key, language)
+            )
+        data = response.json() if response.status_code == 200 else {}
+        return parse_place_details(place, response.status_code, data)
+        
+    except Exception:
+        return place, False
+
+async def cached_place_details_async(place, api_key, language='ja'):
+    """cached_place_detailsの非同期版（キャッシュの読み書きはスレッドで実行）"""
+    if not needs_details(place):
+        return place
+    
+    cache_key = details_cache_key(place, language)
+    cached = await asyncio.to_thread(places_cache.get, cache_key)
+    if cached is not None:
+        return cached
+    
+    detailed, ok = await fetch_place_details_async(place, api_key, language)
+    await asyncio.to_thread(store_places_result, cache_key, detailed, ok)
+    return detailed
+
+async def fetch_text_search_async(step, api_key, language='ja'):
+    """fetch_text_searchの非同期版"""
+    if step.page_token:
+        await asyncio.sleep(PLACES_PAGE_TOKEN_DELAY)
     
     try:
-        img = cv2.imread(file_path)
-        if img is None:
-            return False
+        with stage('places_search'):
+            response = await get_async_http_client().get(
+                PLACES_TEXTSEARCH_URL, params=text_search_params(step, api_key, language)
+            )
+        data = response.json() if response.status_code == 200 else {}
+        return parse_text_search(response.status_code, data)
         
-        # アスペクト比を保ちながらリサイズ
-        h, w = img.shape[:2]
-        if w > max_size[0] or h > max_size[1]:
-            scale = min(max_size[0]/w, max_size[1]/h)
-            new_w, new_h = int(w*scale), int(h*scale)
-            img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
-            cv2.imwrite(file_path, img, [cv2.IMWRITE_JPEG_QUALITY, 85])
-        return True
     except Exception:
-        return True
+        return {'places': []}, False
 
-def analyze_emotions_parallel(image_path):
-    """感情分析を並列処理で実行"""
+async def text_search_page_async(step, api_key, language='ja'):
+    """text_search_pageの非同期版"""
+    cache_key = page_cache_key(language, step.key, step.page_no)
+    if step.page_no > 1:
+        cached = await asyncio.to_thread(places_cache.get, cache_key)
+        if cached is not None:
+            return cached
+        if not step.page_token:
+            return {'places': []}
+    
+    page, ok = await fetch_text_search_async(step, api_key, language)
+    await asyncio.to_thread(store_places_result, cache_key, cacheable_page(page), ok)
+    return page
+
+async def plan_places_async(queries, api_key, language='ja'):
+    """plan_placesの非同期版"""
+    plan = PlacesPlan(queries)
+    plan.use_cached(await asyncio.to_thread(cached_first_pages, plan, language))
+    while True:
+        step = plan.next_step()
+        if step is None:
+            break
+        plan.add_page(step.key, step.query, await text_search_page_async(step, api_key, language), step.page_no)
+    log_places_plan(queries, plan)
+    return plan.places
+
+async def iter_places_async(queries, language='ja'):
+    """iter_placesの非同期版（Detailsはイベントループ上で並行に取得し、順に返す）"""
+    api_key = get_google_maps_api_key()
+    
+    if not api_key:
+        return
+    
+    places = await plan_places_async(queries, api_key, language)
+    details = [asyncio.ensure_future(cached_place_details_async(p, api_key, language)) for p in places]
+    for i, task in enumerate(details, 1):
+        place = await task
+        print(f"提案{i} → {place.get('name', 'Unknown')}を取得")
+        yield place
+
+@timed('decode')
+def optimize_image(data, max_size=(320, 320)):
+    """画像を1回だけデコード＆縮小し、全分析で共有するコンテキストを作成"""
+    try:
+        return ImageContext.from_bytes(data, max_size=max_size)
+    except ValueError:
+        return None
+
+# 分析結果キャッシュ（アップロード内容のハッシュがキー、ワーカー間で共有）
+ANALYSIS_CACHE_TTL = int(os.getenv('EMOTABI_ANALYSIS_CACHE_TTL', str(24 * 3600)))
+ANALYSIS_CACHE_MAX = int(os.getenv('EMOTABI_ANALYSIS_CACHE_MAX', '1000'))
+analysis_cache = get_cache('analysis', max_entries=ANALYSIS_CACHE_MAX, default_ttl=ANALYSIS_CACHE_TTL)
+
+def analysis_cache_key(data):
+    """アップロード画像のバイト列から分析キャッシュのキーを作成（色量子化方式も含める）"""
+    import hashlib
+    digest = hashlib.sha256(data).hexdigest()
+    quantizer = os.getenv('SHIKISAI_QUANTIZER', 'kmeans').strip().lower()
+    return f"{digest}:{quantizer}"
+
+def is_cacheable_analysis(results):
+    """一時的なAPIエラーを含む結果はキャッシュしない
+
+    物体未検出・低信頼度で 'api error' になるのはシーン判定・感情抽出のOpenAI呼び出しが
+    失敗した場合（scene_fallback）なので、これもキャッシュせず次回に再試行する。
+    """
+    color = results.get('color', {}).get('emotion')
+    atmosphere = results.get('atmosphere')
+    obj = results.get('object', {})
+    if not color or color == 'api error' or not atmosphere or atmosphere == 'api error':
+        return False
+    return obj.get('emotion') != 'api error'
+
+def analyze_emotions_parallel(image_ctx, on_result=None):
+    """感情分析を並列処理で実行（デコード済みの共有コンテキストを各分析に渡す）
+
+    on_result: 各分析の完了時に (name, results) で呼ばれるコールバック（'color' / 'object' / 'atmosphere'）
+    """
     results = {}
+    # 雰囲気分析のVision応答に含まれるシーン名（物体未検出時に物体検出側が待つ）
+    # 応答にシーン名が含まれない方式（chain）では待たず、物体検出側がすぐ個別に判定する
+    scene_future = Future() if EMO_GPT_AVAILABLE and provides_scene_label() else None
+    
+    def resolve_scene(scene_label):
+        if scene_future is not None and not scene_future.done():
+            scene_future.set_result(scene_label)
     
     def color_analysis():
         if not SHIKISAI_AVAILABLE:
             raise ImportError("色彩分析モジュール(shikisai)が利用できません")
         
-        emotion, chart = get_color_emotions(image_path)
-        # パレット抽出（保存せずHEX配列で返す）
-        try:
-            from shikisai import extract_palette_hex
-            palette = extract_palette_hex(image_path, num_colors=5)
-        except Exception:
-            palette = []
-        results['color'] = {'emotion': emotion, 'chart': chart, 'palette': palette}
+        # 色抽出は1回のみ（感情判定に使ったパレットをそのまま表示用に返す）
+        color = analyze_colors(image_ctx, num_colors=5)
+        results['color'] = {'emotion': color['emotion'], 'chart': color['chart'], 'palette': color['palette']}
+        if on_result:
+            on_result('color', results)
     
     def object_analysis():
         if not BUTTAI_AVAILABLE:
             raise ImportError("物体検出モジュール(buttai)が利用できません")
         
-        emotion, label = process_buttai(image_path)
+        emotion, label = process_buttai(image_ctx, scene_future=scene_future)
         # source判定（scene: で始まる場合はフォールバック）
         source = 'scene' if isinstance(label, str) and label.startswith('scene:') else 'yolo'
         results['object'] = {'emotion': emotion, 'label': label, 'source': source}
+        if on_result:
+            on_result('object', results)
     
     def atmosphere_analysis():
-        if not EMO_GPT_AVAILABLE:
-            raise ImportError("雰囲気分析モジュール(emo_gpt)が利用できません")
-        
-        cap_res = process_emo(image_path)
-        results['atmosphere'] = cap_res.get('emotion_label', '不明')
+        scene_label = ''
+        try:
+            if not EMO_GPT_AVAILABLE:
+                raise ImportError("雰囲気分析モジュール(emo_gpt)が利用できません")
+            
+            # Vision応答が届いた時点（chain方式へのフォールバック前）で物体検出側に渡す
+            cap_res = process_emo(image_ctx, on_scene=resolve_scene)
+            results['atmosphere'] = cap_res.get('emotion_label', '不明')
+            results['atmosphere_detail'] = {'caption': cap_res.get('caption', '')}
+            scene_label = cap_res.get('scene_label', '')
+        finally:
+            # 失敗時も空で解決し、物体検出側は個別のシーン判定に切り替える
+            resolve_scene(scene_label)
+        if on_result:
+            on_result('atmosphere', results)
     
     # 並列実行（エラー時は例外で停止）
     with ThreadPoolExecutor(max_workers=3) as executor:
         futures = [
-            executor.submit(color_analysis),
-            executor.submit(object_analysis),
-            executor.submit(atmosphere_analysis)
+            executor.submit(in_request_context(color_analysis)),
+            executor.submit(in_request_context(object_analysis)),
+            executor.submit(in_request_context(atmosphere_analysis))
         ]
         
         for future in as_completed(futures, timeout=30):
@@ -472,6 +833,15 @@ def analyze_emotions_parallel(image_path):
     
     return results
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus形式のメトリクス（段階別の所要時間・キャッシュのヒット/ミス・処理中のリクエスト数、全ワーカー分）"""
+    rendered = render_metrics()
+    if rendered is None:
+        return "prometheus_client is not installed", 503
+    body, content_type = rendered
+    return flask.Response(body, content_type=content_type)
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Railway用のヘルスチェックエンドポイント（詳細診断付き）"""
@@ -484,6 +854,10 @@ def health_check():
         gmaps_key = os.getenv('GOOGLE_MAPS_API_KEY')
         openai_key = os.getenv('OPENAI_API_KEY')
         
+        # ウォームアップ完了前は503（ロードバランサーに振り分けさせない）
+        if not _ready.is_set():
+            return jsonify({'status': 'starting', 'message': 'Warming up', 'timestamp': time.time(), 'ready': False}), 503
+        
         # 詳細な診断
         print("\n🔍 詳細診断:")
         
@@ -529,12 +903,15 @@ def health_check():
             'status': 'healthy',
             'message': 'EMOTABI is running',
             'timestamp': time.time(),
+            'ready': True,
             'modules': modules_status,
             'api_keys': {
                 'google_maps': bool(gmaps_key),
                 'openai': bool(openai_key)
             },
-            'features': features
+            'features': features,
+            'caches': cache_stats(),
+            'inference': inference_stats() if BUTTAI_AVAILABLE else None
         }
         return jsonify(status)
     except Exception as e:
@@ -561,251 +938,496 @@ def index():
         </html>
         """, 500
 
+@timed('upload')
+def read_analyze_request():
+    """/analyze のフォームを検証してアップロードを読み込む
+
+    戻り値: (region, purpose, data, filename, error)。不正な入力の場合はerrorに(レスポンス, ステータス)が入る。
+    """
+    region = request.form.get('region')
+    purpose = request.form.get('purpose')
+    if not region:
+        return None, None, None, None, (jsonify({'error': '地域を選択または入力してください'}), 400)
+    if not purpose:
+        return None, None, None, None, (jsonify({'error': '目的を選択または入力してください'}), 400)
+
+    f = request.files.get('image')
+    if not f or f.filename == '':
+        return None, None, None, None, (jsonify({'error': '画像をアップロードしてください'}), 400)
+    
+    # ファイルサイズチェック
+    if f.content_length and f.content_length > 16 * 1024 * 1024:
+        return None, None, None, None, (jsonify({'error': '画像サイズは16MB以下にしてください'}), 400)
+    
+    # リクエストストリームからメモリ上に読み込み（ディスクには書き込まない）
+    data = f.read()
+    if DEBUG_CAPTURE:
+        capture_upload(data, f.filename)
+    return region, purpose, data, f.filename, None
+
+def lookup_analysis(data):
+    """同じ画像の分析結果があれば再利用（地域・目的だけ変えた再アップロードなど）。戻り値: (cache_key, 結果またはNone)"""
+    cache_key = analysis_cache_key(data)
+    emotion_results = analysis_cache.get(cache_key)
+    if emotion_results is not None:
+        print(f"♻️  分析結果キャッシュヒット: {cache_key[:12]}")
+    return cache_key, emotion_results
+
+def store_analysis(cache_key, emotion_results):
+    """一時的なエラーを含まない分析結果のみキャッシュ"""
+    if is_cacheable_analysis(emotion_results):
+        analysis_cache.set(cache_key, emotion_results)
+
+def filter_emotion(emotion):
+    """APIエラーや無効な感情を除外"""
+    if not emotion or emotion.strip() == '' or emotion.strip().lower() == 'api error':
+        return ''
+    return emotion.strip()
+
+def display_object_emotion(emotion_results):
+    """表示用の物体感情（検出なし時の文言）"""
+    object_emotion = emotion_results.get('object', {}).get('emotion', '穏やか')
+    object_label = emotion_results.get('object', {}).get('label')
+    if object_emotion == 'api error' and object_label == 'no_object':
+        return '検出されませんでした'
+    return object_emotion
+
+def build_search_queries(region, purpose, emotion_results):
+    """分析結果からPlaces検索クエリを作成（分析結果のログ出力を含む）"""
+    color_emotion = emotion_results.get('color', {}).get('emotion', '穏やか')
+    object_emotion = emotion_results.get('object', {}).get('emotion', '穏やか')
+    atmosphere_emotion = emotion_results.get('atmosphere', '穏やか')
+
+    # 表示用の物体感情（検出なし時の文言）
+    object_emotion_display = display_object_emotion(emotion_results)
+
+    # 感情分析結果をターミナルに出力
+    print("=" * 50)
+    print("🔍 感情分析結果:")
+    print(f"  📍 地域: {region}")
+    print(f"  🎯 目的: {purpose}")
+    print(f"  🎨 色彩感情: {color_emotion}")
+    print(f"  📦 物体感情: {object_emotion_display}")
+    print(f"  💭 雰囲気感情: {atmosphere_emotion}")
+    print("=" * 50)
+    
+    # 有効な感情のみを抽出
+    valid_emotions = [
+        filter_emotion(object_emotion),
+        filter_emotion(color_emotion), 
+        filter_emotion(atmosphere_emotion)
+    ]
+    valid_emotions = [e for e in valid_emotions if e]  # 空文字を除去
+    
+    # Places API検索クエリ（3つの異なる順番。語順だけの違いは検索計画で1つにまとめる）
+    if valid_emotions:
+        queries = [
+            f"{region} {purpose} {' '.join(valid_emotions)}",
+            f"{region} {purpose} {' '.join(reversed(valid_emotions))}",
+            f"{region} {purpose} {' '.join(valid_emotions[1:] + valid_emotions[:1])}" if len(valid_emotions) > 1 else f"{region} {purpose} {' '.join(valid_emotions)}"
+        ]
+    else:
+        # 感情データがない場合は基本検索のみ
+        queries = [
+            f"{region} {purpose}",
+            f"{region} {purpose} おすすめ",
+            f"{region} {purpose} 人気"
+        ]
+    return queries
+
+def build_suggestion(p):
+    """1件の場所を表示用の提案に変換（リクエストコンテキスト内で呼ぶ）"""
+    name = p.get('name', '')
+    addr = p.get('formatted_address', '')
+    rating = p.get('rating', '―')
+    
+    # 画像取得処理
+    photos = p.get('photos', [])
+    placeholder_url = flask.url_for('static', filename='images/placeholder_r1.png')
+    photo_url = placeholder_url
+    
+    if photos and len(photos) > 0 and GOOGLEMAPS_AVAILABLE:
+        try:
+            photo_info = photos[0]
+            photo_reference = photo_info.get('photo_reference')
+            
+            if photo_reference:
+                photo_url = flask.url_for('proxy_photo', photo_ref=photo_reference, _external=True)
+                
+        except Exception:
+            photo_url = placeholder_url
+    
+    url = 'https://www.google.com/maps/search/?api=1&query=' + \
+          requests.utils.quote(f"{name} {addr}")
+    
+    return {
+        'name': name,
+        'addr': addr,
+        'rating': rating,
+        'url': url,
+        'photo_url': photo_url
+    }
+
+def build_suggestions(places):
+    """選択した場所を提案リストに変換（場所が無い場合はAPIキー設定の案内）"""
+    if places:
+        return [build_suggestion(p) for p in places]
+    # APIキーが設定されていない場合のフォールバック
+    return [{
+        'name': '観光地提案機能を有効にするには',
+        'addr': 'Google Maps APIキーを設定してください',
+        'rating': '―',
+        'url': '#',
+        'photo_url': flask.url_for('static', filename='images/placeholder_r1.png'),
+        'note': 'APIキー設定後、観光地の詳細情報が表示されます'
+    }]
+
+def build_analysis_response(emotion_results, suggestions, processing_time):
+    """/analyze のレスポンス本文"""
+    color_emotion = emotion_results.get('color', {}).get('emotion', '穏やか')
+    atmosphere_emotion = emotion_results.get('atmosphere', '穏やか')
+    object_emotion_display = display_object_emotion(emotion_results)
+
+    # 詳細情報を同梱
+    object_detail = emotion_results.get('object', {})
+    color_detail = emotion_results.get('color', {})
+    atmosphere_detail = {
+        'caption_ja': emotion_results.get('atmosphere_detail', {}).get('caption', '')
+    }
+
+    return {
+        'object_emotion': object_emotion_display,
+        'color_emotion': color_emotion,
+        'atmosphere_emotion': atmosphere_emotion,
+        'suggestions': suggestions,
+        'processing_time': f"{processing_time:.2f}s",
+        'details': {
+            'object': {
+                'label': object_detail.get('label'),
+                'source': object_detail.get('source')
+            },
+            'color': {
+                'palette': color_detail.get('palette', [])
+            },
+            'atmosphere': atmosphere_detail
+        }
+    }
+
 @app.route('/analyze', methods=['POST'])
 def analyze():
     try:
         start_time = time.time()
         
-        region = request.form.get('region')
-        purpose = request.form.get('purpose')
-        if not region:
-            return jsonify({'error': '地域を選択または入力してください'}), 400
-        if not purpose:
-            return jsonify({'error': '目的を選択または入力してください'}), 400
-
-        f = request.files.get('image')
-        if not f or f.filename == '':
-            return jsonify({'error': '画像をアップロードしてください'}), 400
-        
-        # ファイルサイズチェック
-        if f.content_length and f.content_length > 16 * 1024 * 1024:
-            return jsonify({'error': '画像サイズは16MB以下にしてください'}), 400
-        
-        # 一意のファイル名を生成
-        import uuid
-        file_extension = os.path.splitext(secure_filename(f.filename))[1]
-        unique_filename = f"upload_{int(time.time())}_{uuid.uuid4().hex[:8]}{file_extension}"
-        save_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        f.save(save_path)
-
-        # 画像最適化
-        if not optimize_image(save_path):
-            return jsonify({'error': '画像の処理に失敗しました'}), 500
-
-        # モデル初期化
-        init_model()
-
-        # 感情分析を並列実行
-        emotion_results = analyze_emotions_parallel(save_path)
-        
-        # 結果の取得
-        color_emotion = emotion_results.get('color', {}).get('emotion', '穏やか')
-        object_emotion = emotion_results.get('object', {}).get('emotion', '穏やか')
-        object_label = emotion_results.get('object', {}).get('label')
-        atmosphere_emotion = emotion_results.get('atmosphere', '穏やか')
-
-        # 表示用の物体感情（検出なし時の文言）
-        object_emotion_display = (
-            '検出されませんでした' if (object_emotion == 'api error' and object_label == 'no_object') else object_emotion
-        )
-
-        # 感情分析結果をターミナルに出力
-        print("=" * 50)
-        print("🔍 感情分析結果:")
-        print(f"  📍 地域: {region}")
-        print(f"  🎯 目的: {purpose}")
-        print(f"  🎨 色彩感情: {color_emotion}")
-        print(f"  📦 物体感情: {object_emotion_display}")
-        print(f"  💭 雰囲気感情: {atmosphere_emotion}")
-        print("=" * 50)
-
-        # 感情フィルタリング（api errorを除外）
-        def filter_emotion(emotion):
-            """APIエラーや無効な感情を除外"""
-            if not emotion or emotion.strip() == '' or emotion.strip().lower() == 'api error':
-                return ''
-            return emotion.strip()
-        
-        # 有効な感情のみを抽出
-        valid_emotions = [
-            filter_emotion(object_emotion),
-            filter_emotion(color_emotion), 
-            filter_emotion(atmosphere_emotion)
-        ]
-        valid_emotions = [e for e in valid_emotions if e]  # 空文字を除去
-        
-        # Places API検索（3つの異なる順番で検索）
-        if valid_emotions:
-            queries = [
-                f"{region} {purpose} {' '.join(valid_emotions)}",
-                f"{region} {purpose} {' '.join(reversed(valid_emotions))}",
-                f"{region} {purpose} {' '.join(valid_emotions[1:] + valid_emotions[:1])}" if len(valid_emotions) > 1 else f"{region} {purpose} {' '.join(valid_emotions)}"
-            ]
-        else:
-            # 感情データがない場合は基本検索のみ
-            queries = [
-                f"{region} {purpose}",
-                f"{region} {purpose} おすすめ",
-                f"{region} {purpose} 人気"
-            ]
-        
-        # 各検索から1つずつ結果を取得
-        final_places = []
-        seen_place_ids = set()
-        
-        for i, query in enumerate(queries, 1):
-            places = cached_places_search(query, language='ja')
-            
-            # この検索から1つの場所を選択（重複チェック付き）
-            selected_place = None
-            skipped_place = None
-            
-            for place in places:
-                place_id = place.get('place_id')
-                if place_id and place_id not in seen_place_ids:
-                    selected_place = place
-                    seen_place_ids.add(place_id)
-                    break
-                elif place_id and not skipped_place:
-                    skipped_place = place  # 最初の重複候補を記録
-            
-            if selected_place:
-                final_places.append(selected_place)
-                if skipped_place:
-                    print(f"検索{i} → {skipped_place.get('name', 'Unknown')}(重複)×→{selected_place.get('name', 'Unknown')}を取得")
-                else:
-                    print(f"検索{i} → {selected_place.get('name', 'Unknown')}を取得")
-            else:
-                print(f"検索{i} → 新しい場所が見つかりませんでした")
+        region, purpose, data, _, error = read_analyze_request()
+        if error is not None:
+            return error
+
+        cache_key, emotion_results = lookup_analysis(data)
+        if emotion_results is None:
+            # 画像最適化（ここで1回だけデコードし、以降の分析はファイルを読まない）
+            image_ctx = optimize_image(data)
+            if image_ctx is None:
+                return jsonify({'error': '画像の処理に失敗しました'}), 500
+
+            # モデル初期化
+            init_model()
+
+            # 感情分析を並列実行
+            emotion_results = analyze_emotions_parallel(image_ctx)
+            store_analysis(cache_key, emotion_results)
         
-        places = final_places
+        queries = build_search_queries(region, purpose, emotion_results)
         
-        suggestions = []
-        if places:
-            for i, p in enumerate(places):
-                name = p.get('name', '')
-                addr = p.get('formatted_address', '')
-                rating = p.get('rating', '―')
-                
-                # 画像取得処理
-                photos = p.get('photos', [])
-                placeholder_url = flask.url_for('static', filename='images/placeholder_r1.png')
-                photo_url = placeholder_url
-                
-                if photos and len(photos) > 0 and GOOGLEMAPS_AVAILABLE:
-                    try:
-                        photo_info = photos[0]
-                        photo_reference = photo_info.get('photo_reference')
-                        
-                        if photo_reference:
-                            photo_url = flask.url_for('proxy_photo', photo_ref=photo_reference, _external=True)
-                            
-                    except Exception:
-                        photo_url = placeholder_url
-                
-                # 絶対にアップロードされた画像のパスが使用されていないことを確認
-                if save_path in photo_url or unique_filename in photo_url:
-                    photo_url = placeholder_url
-                
-                url = 'https://www.google.com/maps/search/?api=1&query=' + \
-                      requests.utils.quote(f"{name} {addr}")
-                
-                suggestion = {
-                    'name': name,
-                    'addr': addr,
-                    'rating': rating,
-                    'url': url,
-                    'photo_url': photo_url
-                }
-                suggestions.append(suggestion)
-        else:
-            # APIキーが設定されていない場合のフォールバック
-            suggestions = [{
-                'name': '観光地提案機能を有効にするには',
-                'addr': 'Google Maps APIキーを設定してください',
-                'rating': '―',
-                'url': '#',
-                'photo_url': flask.url_for('static', filename='images/placeholder_r1.png'),
-                'note': 'APIキー設定後、観光地の詳細情報が表示されます'
-            }]
+        # 検索計画で重複クエリをまとめ、必要な回数だけ検索して重複しない場所を選ぶ
+        places = list(iter_places(queries, language='ja'))
+        suggestions = build_suggestions(places)
 
         # パフォーマンス測定結果
         processing_time = time.time() - start_time
-
-        # 詳細情報を同梱
-        object_detail = emotion_results.get('object', {})
-        color_detail = emotion_results.get('color', {})
-        atmosphere_detail = {
-            'caption_ja': cap_res.get('caption', '') if 'cap_res' in locals() else ''
-        }
-
-        return jsonify({
-            'object_emotion': object_emotion_display,
-            'color_emotion': color_emotion,
-            'atmosphere_emotion': atmosphere_emotion,
-            'suggestions': suggestions,
-            'processing_time': f"{processing_time:.2f}s",
-            'details': {
-                'object': {
-                    'label': object_detail.get('label'),
-                    'source': object_detail.get('source')
-                },
-                'color': {
-                    'palette': color_detail.get('palette', [])
-                },
-                'atmosphere': atmosphere_detail
-            }
-        })
+        return jsonify(build_analysis_response(emotion_results, suggestions, processing_time))
     
     except Exception as e:
         return jsonify({
             'error': f'処理中にエラーが発生しました: {str(e)}'
         }), 500
 
+def sse_event(event, data):
+    """Server-Sent Eventsの1イベント分の文字列"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def analysis_event(name, emotion_results):
+    """分析1件分のストリーミングイベント本文（name: 'color' / 'object' / 'atmosphere'）"""
+    if name == 'color':
+        color = emotion_results.get('color', {})
+        return {'emotion': color.get('emotion', '穏やか'), 'palette': color.get('palette', [])}
+    if name == 'object':
+        detail = emotion_results.get('object', {})
+        return {
+            'emotion': display_object_emotion(emotion_results),
+            'label': detail.get('label'),
+            'source': detail.get('source')
+        }
+    return {
+        'emotion': emotion_results.get('atmosphere', '穏やか'),
+        'caption_ja': emotion_results.get('atmosphere_detail', {}).get('caption', '')
+    }
+
+ANALYSIS_EVENTS = ('color', 'object', 'atmosphere')
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+@app.route('/analyze/stream', methods=['POST'])
+def analyze_stream():
+    """/analyze のストリーミング版（Server-Sent Events）
+
+    色彩・物体・雰囲気の各分析と各観光地の提案を、得られた順にイベントとして送る。
+    最後に /analyze と同じ本文を 'done' イベントで送る（エラー時は 'error'）。
+    """
+    start_time = time.time()
+    region, purpose, data, _, error = read_analyze_request()
+    if error is not None:
+        return error
+
+    def generate():
+        try:
+            cache_key, emotion_results = lookup_analysis(data)
+            if emotion_results is None:
+                image_ctx = optimize_image(data)
+                if image_ctx is None:
+                    yield sse_event('error', {'error': '画像の処理に失敗しました'})
+                    return
+                init_model()
+
+                # 分析スレッドから完了順に受け取り、そのままイベントとして送る
+                events = queue.Queue()
+                future = get_executor('analysis-stream', ANALYSIS_STREAM_WORKERS).submit(
+                    analyze_emotions_parallel, image_ctx,
+                    lambda name, results: events.put((name, analysis_event(name, results)))
+                )
+                future.add_done_callback(lambda _: events.put(None))
+                for name, payload in iter(events.get, None):
+                    yield sse_event(name, payload)
+                emotion_results = future.result()
+                store_analysis(cache_key, emotion_results)
+            else:
+                for name in ANALYSIS_EVENTS:
+                    yield sse_event(name, analysis_event(name, emotion_results))
+
+            queries = build_search_queries(region, purpose, emotion_results)
+
+            # 選ばれた場所から順に送る
+            places = []
+            for place in iter_places(queries, language='ja'):
+                places.append(place)
+                yield sse_event('suggestion', {'index': len(places) - 1, **build_suggestion(place)})
+
+            processing_time = time.time() - start_time
+            yield sse_event('done', build_analysis_response(emotion_results, build_suggestions(places), processing_time))
+
+        except Exception as e:
+            yield sse_event('error', {'error': f'処理中にエラーが発生しました: {str(e)}'})
+
+    return flask.Response(flask.stream_with_context(generate()), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+# 写真プロキシのディスクキャッシュ（photo_ref + maxwidth ごと、合計サイズ上限付き）
+PHOTO_CACHE_DIR = os.getenv('EMOTABI_PHOTO_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'emotabi_photos'))
+PHOTO_CACHE_MAX_BYTES = int(os.getenv('EMOTABI_PHOTO_CACHE_MAX_MB', '200')) * 1024 * 1024
+PHOTO_CHUNK_SIZE = 64 * 1024
+PHOTO_MAX_AGE = 3600
+_placeholder_image = None
+
+def get_placeholder_image():
+    """プレースホルダー画像のバイト列（初回のみ読み込み、以降はメモリから返す）"""
+    global _placeholder_image
+    if _placeholder_image is None:
+        placeholder_path = os.path.join(app.static_folder, 'images', 'placeholder_r1.png')
+        try:
+            with open(placeholder_path, 'rb') as f:
+                _placeholder_image = f.read()
+        except OSError:
+            return None
+    return _placeholder_image
+
+def placeholder_response(fallback_message, fallback_status):
+    """プレースホルダー画像のレスポンス（画像が無い場合はメッセージを返す）"""
+    data = get_placeholder_image()
+    if data is None:
+        return fallback_message, fallback_status
+    return flask.Response(data, mimetype='image/png')
+
+def photo_cache_key(photo_ref, maxwidth):
+    """写真キャッシュのキー（ETagとしても使用）"""
+    import hashlib
+    return hashlib.sha256(f"{photo_ref}:{maxwidth}".encode('utf-8')).hexdigest()[:32]
+
+def sniff_image_mimetype(head):
+    """先頭バイトから画像形式を判定"""
+    if head.startswith(b'\x89PNG'):
+        return 'image/png'
+    if head.startswith(b'GIF8'):
+        return 'image/gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'image/jpeg'
+
+def evict_photo_cache():
+    """合計サイズが上限を超えたら最終アクセスが古いファイルから削除"""
+    try:
+        entries = []
+        total = 0
+        with os.scandir(PHOTO_CACHE_DIR) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.startswith('.'):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+        if total <= PHOTO_CACHE_MAX_BYTES:
+            return
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            if total <= PHOTO_CACHE_MAX_BYTES:
+                break
+    except OSError:
+        pass
+
+def place_photo_url(photo_ref, maxwidth, api_key):
+    """Place Photo APIのURL"""
+    return f'{GOOGLE_MAPS_BASE_URL}/maps/api/place/photo?maxwidth={maxwidth}&photoreference={photo_ref}&key={api_key}'
+
+def clamp_photo_maxwidth(value):
+    """maxwidth指定を100〜1600に丸める（不正値は400）"""
+    try:
+        maxwidth = int(value) if value is not None else 400
+    except (TypeError, ValueError):
+        maxwidth = 400
+    return min(max(maxwidth, 100), 1600)
+
+def open_photo_part(cache_path):
+    """キャッシュ書き込み用の一時ファイルを開く。戻り値: (tmp_path, file)。失敗時は(None, None)"""
+    import uuid
+    tmp_path = f"{cache_path}.{uuid.uuid4().hex}.part"
+    try:
+        os.makedirs(PHOTO_CACHE_DIR, exist_ok=True)
+        return tmp_path, open(tmp_path, 'wb')
+    except OSError:
+        return None, None
+
+def discard_photo_part(tmp_path, out):
+    """一時ファイルを閉じて削除（不完全なファイルをキャッシュに残さない）"""
+    try:
+        out.close()
+    except OSError:
+        pass
+    try:
+        os.remove(tmp_path)
+    except OSError:
+        pass
+
+def write_photo_part(tmp_path, out, chunk):
+    """キャッシュへ書き込む。ディスクが一杯・読み取り専用なら書き込みをやめる（中継は続ける）
+
+    戻り値: 以後の書き込みに使うファイル（失敗時はNone）
+    """
+    if out is None:
+        return None
+    try:
+        out.write(chunk)
+        return out
+    except OSError:
+        discard_photo_part(tmp_path, out)
+        return None
+
+def finish_photo_part(tmp_path, out, cache_path, complete):
+    """一時ファイルを閉じ、最後まで受信できた場合のみキャッシュとして確定"""
+    if out is None:
+        return
+    if not complete:
+        # 途中切断時は不完全なファイルを残さない
+        discard_photo_part(tmp_path, out)
+        return
+    try:
+        out.close()
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        discard_photo_part(tmp_path, out)
+        return
+    evict_photo_cache()
+
+def stream_and_cache_photo(response, cache_path):
+    """Googleからの画像をチャンクで中継しつつキャッシュファイルに書き込む"""
+    tmp_path, out = open_photo_part(cache_path)
+    complete = False
+    try:
+        for chunk in response.iter_content(chunk_size=PHOTO_CHUNK_SIZE):
+            if chunk:
+                out = write_photo_part(tmp_path, out, chunk)
+                yield chunk
+        complete = True
+    finally:
+        response.close()
+        finish_photo_part(tmp_path, out, cache_path, complete)
+
 @app.route('/proxy-photo/<path:photo_ref>', methods=['GET'])
 def proxy_photo(photo_ref):
-    """Google Maps Photo APIの画像をプロキシして返す"""
+    """Google Maps Photo APIの画像をプロキシして返す（ディスクキャッシュ・ETag対応）"""
     try:
         api_key = os.getenv('GOOGLE_MAPS_API_KEY')
         if not api_key:
             return "API key not found", 400
         
-        photo_url = f'https://maps.googleapis.com/maps/api/place/photo?maxwidth=400&photoreference={photo_ref}&key={api_key}'
+        maxwidth = clamp_photo_maxwidth(request.args.get('maxwidth'))
+        etag = photo_cache_key(photo_ref, maxwidth)
+        cache_headers = {
+            'Cache-Control': f'public, max-age={PHOTO_MAX_AGE}',
+            'Access-Control-Allow-Origin': '*',
+            'ETag': f'"{etag}"'
+        }
+        
+        # photo_refごとの画像は変わらないため、同じETagなら本文なしで304を返す
+        if etag in request.if_none_match:
+            return flask.Response(status=304, headers=cache_headers)
         
-        import requests
-        response = requests.get(photo_url, timeout=10)
+        # キャッシュ済みならディスクからチャンクで返す
+        cache_path = os.path.join(PHOTO_CACHE_DIR, etag)
+        if os.path.exists(cache_path):
+            try:
+                os.utime(cache_path)  # 最終アクセスを更新（古い順の削除用）
+                with open(cache_path, 'rb') as f:
+                    head = f.read(16)
+                response = flask.send_file(
+                    cache_path,
+                    mimetype=sniff_image_mimetype(head),
+                    etag=etag,
+                    max_age=PHOTO_MAX_AGE,
+                    conditional=True
+                )
+                response.headers['Access-Control-Allow-Origin'] = '*'
+                return response
+            except OSError:
+                pass
+        
+        photo_url = place_photo_url(photo_ref, maxwidth, api_key)
+        
+        with stage('photo'):
+            response = get_http_session().get(photo_url, timeout=HTTP_TIMEOUT, stream=True)
         
         if response.status_code == 200:
             return flask.Response(
-                response.content,
+                stream_and_cache_photo(response, cache_path),
                 mimetype=response.headers.get('content-type', 'image/jpeg'),
-                headers={
-                    'Cache-Control': 'public, max-age=3600',
-                    'Access-Control-Allow-Origin': '*'
-                }
+                headers=cache_headers
             )
         else:
             # エラーの場合はプレースホルダー画像を返す
-            placeholder_path = os.path.join(app.static_folder, 'images', 'placeholder_r1.png')
-            if os.path.exists(placeholder_path):
-                with open(placeholder_path, 'rb') as f:
-                    return flask.Response(
-                        f.read(),
-                        mimetype='image/png'
-                    )
-            else:
-                return "Image not found", 404
+            response.close()
+            return placeholder_response("Image not found", 404)
                 
     except Exception:
         # エラーの場合もプレースホルダー画像を返す
-        placeholder_path = os.path.join(app.static_folder, 'images', 'placeholder_r1.png')
-        if os.path.exists(placeholder_path):
-            with open(placeholder_path, 'rb') as f:
-                return flask.Response(
-                    f.read(),
-                    mimetype='image/png'
-                )
-        return "Error occurred", 500
+        return placeholder_response("Error occurred", 500)
 
 @app.route('/debug', methods=['GET'])
 def debug_diagnostics():
@@ -0,0 +1,381 @@
+import io
+import os
+import sys
+import time
+import asyncio
+from urllib.parse import parse_qs
+
+import flask
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.http import parse_etags
+
+import app as emotabi
+from http_clients import get_async_http_client, close_async_clients
+from metrics import stage, begin_request, in_request_context
+
+try:
+    from buttai import process_buttai_async
+except ImportError:
+    process_buttai_async = None
+
+try:
+    from emo_gpt_1 import process_emo_async, provides_scene_label
+except ImportError:
+    process_emo_async = None
+    provides_scene_label = None
+
+# ASGIモード（EMOTABI_SERVER_MODE=async、uvicornワーカーで起動）のエントリポイント
+# /analyze と /proxy-photo はイベントループ上で処理し、OpenAI・Google APIの応答待ちで
+# ワーカーを占有しない。色彩分析・YOLO推論などのCPU処理は共有スレッドプールで実行する。
+# それ以外のルートは従来のFlaskアプリ（WSGI）にそのまま渡す。
+CPU_WORKERS = int(os.getenv('EMOTABI_CPU_WORKERS', '2'))
+ANALYSIS_TIMEOUT = 30
+
+flask_app = emotabi.app
+wsgi_app = WsgiToAsgi(flask_app)
+
+
+def run_cpu(func, *args):
+    """CPU処理を共有スレッドプールで実行（処理段階の計測は呼び出し元のリクエストに記録）"""
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(emotabi.get_executor('cpu', CPU_WORKERS), in_request_context(func), *args)
+
+
+def build_environ(scope, body):
+    """ASGIのscopeと本文から、Flaskのリクエストコンテキスト用のWSGI environを作る"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def get_header(scope, name):
+    """リクエストヘッダーの値（無ければ空文字）"""
+    for key, value in scope.get('headers', []):
+        if key == name:
+            return value.decode('latin-1')
+    return ''
+
+
+async def read_body(receive, limit):
+    """リクエスト本文を読み込む（limitを超えたらNone）"""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+async def send_start(send, response):
+    """Flaskレスポンスのステータスとヘッダーを送信"""
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in response.headers.items()],
+    })
+
+
+async def send_response(send, response):
+    """Flaskレスポンスをそのまま送信（本文はメモリ上のもの）"""
+    body = response.get_data()
+    response.headers['Content-Length'] = str(len(body))
+    await send_start(send, response)
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def finalize_response(rv):
+    """ビューの戻り値をレスポンスにし、after_request（Talisman等）を適用（リクエストコンテキスト内で呼ぶ）"""
+    return flask_app.process_response(flask_app.make_response(rv))
+
+
+async def analyze_emotions_async(image_ctx, on_result=None):
+    """analyze_emotions_parallelの非同期版（3つの分析をイベントループ上で並行に待つ）
+
+    on_result: 各分析の完了時に (name, results) で呼ばれるコールバック（イベントループ上で呼ぶ）
+    """
+    results = {}
+    # 雰囲気分析のVision応答に含まれるシーン名（物体未検出時に物体検出側が待つ。chain方式では待たない）
+    scene_future = None
+    if emotabi.EMO_GPT_AVAILABLE and provides_scene_label is not None and provides_scene_label():
+        scene_future = asyncio.get_running_loop().create_future()
+
+    def resolve_scene(scene_label):
+        if scene_future is not None and not scene_future.done():
+            scene_future.set_result(scene_label)
+
+    async def color_analysis():
+        if not emotabi.SHIKISAI_AVAILABLE:
+            raise ImportError("色彩分析モジュール(shikisai)が利用できません")
+
+        color = await run_cpu(emotabi.analyze_colors, image_ctx, 5)
+        results['color'] = {'emotion': color['emotion'], 'chart': color['chart'], 'palette': color['palette']}
+        if on_result:
+            on_result('color', results)
+
+    async def object_analysis():
+        if not emotabi.BUTTAI_AVAILABLE or process_buttai_async is None:
+            raise ImportError("物体検出モジュール(buttai)が利用できません")
+
+        emotion, label = await process_buttai_async(
+            image_ctx, scene_future=scene_future, executor=emotabi.get_executor('cpu', CPU_WORKERS)
+        )
+        source = 'scene' if isinstance(label, str) and label.startswith('scene:') else 'yolo'
+        results['object'] = {'emotion': emotion, 'label': label, 'source': source}
+        if on_result:
+            on_result('object', results)
+
+    async def atmosphere_analysis():
+        scene_label = ''
+        try:
+            if not emotabi.EMO_GPT_AVAILABLE or process_emo_async is None:
+                raise ImportError("雰囲気分析モジュール(emo_gpt)が利用できません")
+
+            cap_res = await process_emo_async(image_ctx, on_scene=resolve_scene)
+            results['atmosphere'] = cap_res.get('emotion_label', '不明')
+            results['atmosphere_detail'] = {'caption': cap_res.get('caption', '')}
+            scene_label = cap_res.get('scene_label', '')
+        finally:
+            # 失敗時も空で解決し、物体検出側は個別のシーン判定に切り替える
+            resolve_scene(scene_label)
+        if on_result:
+            on_result('atmosphere', results)
+
+    await asyncio.wait_for(
+        asyncio.gather(color_analysis(), object_analysis(), atmosphere_analysis()),
+        timeout=ANALYSIS_TIMEOUT
+    )
+    return results
+
+
+async def analyze_view(start_time):
+    """/analyze の非同期版ビュー（レスポンスはapp.analyzeと同じ）"""
+    try:
+        region, purpose, data, _, error = emotabi.read_analyze_request()
+        if error is not None:
+            return error
+
+        cache_key, emotion_results = await asyncio.to_thread(emotabi.lookup_analysis, data)
+        if emotion_results is None:
+            image_ctx = await run_cpu(emotabi.optimize_image, data)
+            if image_ctx is None:
+                return flask.jsonify({'error': '画像の処理に失敗しました'}), 500
+
+            await asyncio.to_thread(emotabi.init_model)
+            emotion_results = await analyze_emotions_async(image_ctx)
+            await asyncio.to_thread(emotabi.store_analysis, cache_key, emotion_results)
+
+        queries = emotabi.build_search_queries(region, purpose, emotion_results)
+        places = [place async for place in emotabi.iter_places_async(queries, language='ja')]
+        suggestions = emotabi.build_suggestions(places)
+
+        processing_time = time.time() - start_time
+        return flask.jsonify(emotabi.build_analysis_response(emotion_results, suggestions, processing_time))
+
+    except Exception as e:
+        return flask.jsonify({
+            'error': f'処理中にエラーが発生しました: {str(e)}'
+        }), 500
+
+
+async def analyze(scope, receive, send):
+    start_time = time.time()
+    body = await read_body(receive, flask_app.config['MAX_CONTENT_LENGTH'])
+    with flask_app.request_context(build_environ(scope, body or b'')):
+        if body is None:
+            rv = (flask.jsonify({'error': '画像サイズは16MB以下にしてください'}), 413)
+        else:
+            rv = flask_app.preprocess_request()
+            if rv is None:
+                rv = await analyze_view(start_time)
+        response = finalize_response(rv)
+    await send_response(send, response)
+
+
+async def analyze_stream_events(region, purpose, data, start_time):
+    """/analyze/stream の非同期版イベント列（app.analyze_streamと同じイベントを同じ順で生成）"""
+    try:
+        cache_key, emotion_results = await asyncio.to_thread(emotabi.lookup_analysis, data)
+        if emotion_results is None:
+            image_ctx = await run_cpu(emotabi.optimize_image, data)
+            if image_ctx is None:
+                yield emotabi.sse_event('error', {'error': '画像の処理に失敗しました'})
+                return
+            await asyncio.to_thread(emotabi.init_model)
+
+            # 分析の完了順に受け取り、そのままイベントとして送る
+            events = asyncio.Queue()
+            task = asyncio.ensure_future(analyze_emotions_async(
+                image_ctx, lambda name, results: events.put_nowait((name, emotabi.analysis_event(name, results)))
+            ))
+            task.add_done_callback(lambda _: events.put_nowait(None))
+            while True:
+                item = await events.get()
+                if item is None:
+                    break
+                yield emotabi.sse_event(*item)
+            emotion_results = task.result()
+            await asyncio.to_thread(emotabi.store_analysis, cache_key, emotion_results)
+        else:
+            for name in emotabi.ANALYSIS_EVENTS:
+                yield emotabi.sse_event(name, emotabi.analysis_event(name, emotion_results))
+
+        # 選ばれた場所から順に送る
+        queries = emotabi.build_search_queries(region, purpose, emotion_results)
+        places = []
+        async for place in emotabi.iter_places_async(queries, language='ja'):
+            places.append(place)
+            yield emotabi.sse_event('suggestion', {'index': len(places) - 1, **emotabi.build_suggestion(place)})
+
+        processing_time = time.time() - start_time
+        suggestions = emotabi.build_suggestions(places)
+        yield emotabi.sse_event('done', emotabi.build_analysis_response(emotion_results, suggestions, processing_time))
+
+    except Exception as e:
+        yield emotabi.sse_event('error', {'error': f'処理中にエラーが発生しました: {str(e)}'})
+
+
+async def analyze_stream(scope, receive, send):
+    """/analyze/stream の非同期版（イベントを生成しながら逐次送信）"""
+    start_time = time.time()
+    body = await read_body(receive, flask_app.config['MAX_CONTENT_LENGTH'])
+    with flask_app.request_context(build_environ(scope, body or b'')):
+        if body is None:
+            rv = (flask.jsonify({'error': '画像サイズは16MB以下にしてください'}), 413)
+        else:
+            rv = flask_app.preprocess_request()
+            if rv is None:
+                region, purpose, data, _, rv = emotabi.read_analyze_request()
+        if rv is not None:
+            await send_response(send, finalize_response(rv))
+            return
+
+        response = finalize_response(flask.Response(mimetype='text/event-stream', headers=emotabi.SSE_HEADERS))
+        response.headers.pop('Content-Length', None)
+        await send_start(send, response)
+        async for chunk in analyze_stream_events(region, purpose, data, start_time):
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+async def proxy_photo(scope, receive, send):
+    """Place Photoの未キャッシュ分だけを非同期に取得して中継（ディスクキャッシュへも書き込む）"""
+    photo_ref = scope['path'][len('/proxy-photo/'):]
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    maxwidth = emotabi.clamp_photo_maxwidth((query.get('maxwidth') or [None])[0])
+    etag = emotabi.photo_cache_key(photo_ref, maxwidth)
+    cache_path = os.path.join(emotabi.PHOTO_CACHE_DIR, etag)
+    api_key = os.getenv('GOOGLE_MAPS_API_KEY')
+
+    # APIキー未設定・304・キャッシュ済みはローカルだけで返せるためFlask側（send_file）に任せる
+    if (not api_key or not photo_ref or etag in parse_etags(get_header(scope, b'if-none-match'))
+            or os.path.exists(cache_path)):
+        await wsgi_app(scope, receive, send)
+        return
+
+    with flask_app.request_context(build_environ(scope, b'')):
+        # preprocess_requestを通さないため計測だけここで始める（finalize_responseでServer-Timingを付ける）
+        flask.g.metrics_token = begin_request('proxy_photo')
+        client = get_async_http_client()
+        try:
+            with stage('photo'):
+                upstream = await client.send(
+                    client.build_request('GET', emotabi.place_photo_url(photo_ref, maxwidth, api_key)), stream=True
+                )
+        except Exception:
+            await send_response(send, finalize_response(emotabi.placeholder_response("Error occurred", 500)))
+            return
+
+        if upstream.status_code != 200:
+            # エラーの場合はプレースホルダー画像を返す
+            await upstream.aclose()
+            await send_response(send, finalize_response(emotabi.placeholder_response("Image not found", 404)))
+            return
+
+        response = finalize_response(flask.Response(
+            mimetype=upstream.headers.get('content-type', 'image/jpeg'),
+            headers={
+                'Cache-Control': f'public, max-age={emotabi.PHOTO_MAX_AGE}',
+                'Access-Control-Allow-Origin': '*',
+                'ETag': f'"{etag}"'
+            }
+        ))
+        response.headers.pop('Content-Length', None)
+
+    tmp_path, out = emotabi.open_photo_part(cache_path)
+    complete = False
+    try:
+        await send_start(send, response)
+        async for chunk in upstream.aiter_bytes(emotabi.PHOTO_CHUNK_SIZE):
+            if chunk:
+                out = emotabi.write_photo_part(tmp_path, out, chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+        complete = True
+    finally:
+        await upstream.aclose()
+        await asyncio.to_thread(emotabi.finish_photo_part, tmp_path, out, cache_path, complete)
+
+
+async def lifespan(receive, send):
+    """起動・終了通知（ワーカーのウォームアップ完了後に起動完了を返し、終了時に非同期クライアントの接続を閉じる）"""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await asyncio.to_thread(emotabi.init_model)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_async_clients()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGIアプリ本体（非同期化したルート以外はFlaskへ）"""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] == 'http':
+        path, method = scope['path'], scope['method']
+        if path == '/analyze' and method == 'POST':
+            await analyze(scope, receive, send)
+            return
+        if path == '/analyze/stream' and method == 'POST':
+            await analyze_stream(scope, receive, send)
+            return
+        if path.startswith('/proxy-photo/') and method == 'GET':
+            await proxy_photo(scope, receive, send)
+            return
+    await wsgi_app(scope, receive, send)
@@ -0,0 +1,347 @@
+"""画像の一括分析（オフライン・バッチ処理）
+
+    python batch_analyze.py photos/ [list.txt ...] --out results.jsonl \
+        [--processes 4] [--batch 16] [--concurrency 8] [--openai-rps 5]
+
+ディレクトリ（再帰）・画像ファイル・ファイルリスト（1行1パス、`-` で標準入力）を入力に取り、
+HTTPを経由せず1画像1行のJSONLを書き出す。処理は2段のパイプライン:
+
+1. CPU段（プロセスプール）: 子プロセスごとにモデルと色→感情インデックスを1回だけ読み込み、
+   --batch 枚ずつデコード・色彩分析・YOLOのバッチ推論を行う。Vision用JPEGもここで作る。
+2. API段（スレッド）: 雰囲気分析（process_emo）と物体ラベル→感情語（get_emotion、未検出時は
+   シーン判定）を --concurrency 件まで並行して待つ。OpenAIの呼び出しは --openai-rps で制限する。
+
+--out のJSONLがチェックポイントを兼ね、再実行時は status が ok の画像を飛ばす
+（失敗した画像、OpenAIのエラーで一部の分析が欠けた画像（status が partial）は再実行で再分析し、
+同じパスの行は後のものが有効）。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import shikisai
+import buttai
+from emo_gpt_1 import process_emo
+from image_context import ImageContext
+from llm_cache import set_rate_limiter
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+# OpenAI呼び出しの上限（1秒あたり、0で無制限）と瞬間的に許す回数
+BATCH_OPENAI_RPS = float(os.getenv('EMOTABI_BATCH_OPENAI_RPS', '0'))
+BATCH_OPENAI_BURST = int(os.getenv('EMOTABI_BATCH_OPENAI_BURST', '5'))
+
+# 分析が得られなかったことを表す値（これを含む結果は partial とし、再実行で再分析する）
+FAILED_VALUES = ('api error', '不明')
+
+
+class RateLimiter:
+    """トークンバケット方式のレート制限（スレッドセーフ。acquire()は枠が空くまで待つ）"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+def iter_inputs(sources):
+    """入力（ディレクトリ・画像・ファイルリスト）から画像パスを順に返す（重複は除く）"""
+    seen = set()
+
+    def emit(path):
+        path = os.path.abspath(path)
+        if path not in seen:
+            seen.add(path)
+            yield path
+
+    for source in sources:
+        if source == '-':
+            for line in sys.stdin:
+                if line.strip():
+                    yield from emit(line.strip())
+        elif os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield from emit(os.path.join(root, name))
+        elif source.lower().endswith(IMAGE_EXTENSIONS):
+            yield from emit(source)
+        else:
+            with open(source, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        yield from emit(line.strip())
+
+
+def load_checkpoint(path):
+    """既存の出力から分析済み（status=ok）の画像パスを集める"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # 中断時の書きかけの行
+            if record.get('status') == 'ok':
+                done.add(record.get('path'))
+    return done
+
+
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def init_worker(processes):
+    """CPU段の子プロセス初期化（インデックスとモデルは1回だけ読み込み、推論スレッド数をコア数で分ける）"""
+    shikisai.load_color_index()
+    buttai.ensure_model()
+    # 子プロセスごとに全コア分のスレッドで推論すると取り合いになる（cpu_pool._init_childと同じ配分）
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(max(1, (os.cpu_count() or 1) // max(1, processes)))
+
+
+def analyze_chunk(paths):
+    """CPU段: デコード・色彩分析・YOLOバッチ推論。戻り値: 画像ごとの中間結果のリスト"""
+    items = []
+    contexts = []
+    for path in paths:
+        start = time.perf_counter()
+        try:
+            ctx = ImageContext.from_path(path)
+        except (OSError, ValueError) as e:
+            items.append({'path': path, 'status': 'error', 'error': f'cannot open image: {e}'})
+            continue
+        color = shikisai.analyze_colors(ctx, num_colors=5, in_process=True)
+        item = {
+            'path': path,
+            'color': {'emotion': color['emotion'], 'palette': color['palette']},
+            'jpeg': ctx.jpeg_bytes,
+            'cpu_ms': (time.perf_counter() - start) * 1000,
+        }
+        items.append(item)
+        contexts.append((item, ctx))
+
+    if contexts:
+        start = time.perf_counter()
+        if buttai.ensure_model():
+            try:
+                detections = buttai.detect_batch([ctx.scaled_bgr(320, 320) for _, ctx in contexts])
+                labels = [buttai.select_label(d) for d in detections]
+            except Exception as e:
+                print(f"Object detection error: {e}")
+                labels = [(None, 'error')] * len(contexts)
+        else:
+            labels = [(None, 'no_model')] * len(contexts)
+        # バッチ推論の時間は画像数で按分
+        share = (time.perf_counter() - start) * 1000 / len(contexts)
+        for (item, _), (label, reason) in zip(contexts, labels):
+            item['label'] = label
+            item['reason'] = reason
+            item['cpu_ms'] += share
+    return items
+
+
+def finish_item(item):
+    """API段: 雰囲気分析と物体の感情語を取得し、/analyze と同じ形の結果にする"""
+    start = time.perf_counter()
+    ctx = ImageContext.from_vision_jpeg(item['jpeg'], source=item['path'])
+
+    cap_res = process_emo(ctx)
+    scene_future = Future()
+    scene_future.set_result(cap_res.get('scene_label', ''))
+
+    label, reason = item['label'], item['reason']
+    if label is not None:
+        emotion = buttai.get_emotion(label)
+    elif reason in ('no_object', 'low_confidence'):
+        emotion, label = buttai.scene_fallback(ctx, scene_future, reason)
+    else:
+        emotion, label = 'api error', reason
+    source = 'scene' if isinstance(label, str) and label.startswith('scene:') else 'yolo'
+    atmosphere = cap_res.get('emotion_label', '不明')
+
+    record = {
+        'path': item['path'],
+        'status': 'ok',
+        'results': {
+            'color': item['color'],
+            'object': {'emotion': emotion, 'label': label, 'source': source},
+            'atmosphere': atmosphere,
+            'atmosphere_detail': {'caption': cap_res.get('caption', '')},
+        },
+        'timing_ms': {'cpu': round(item['cpu_ms'], 2), 'api': round((time.perf_counter() - start) * 1000, 2)},
+    }
+    # 一時的なAPIエラーを成功として記録しない（チェックポイントで飛ばされなくなる）
+    missing = [name for name, value in (('color', item['color']['emotion']), ('object', emotion),
+                                        ('atmosphere', atmosphere)) if not value or value in FAILED_VALUES]
+    if missing:
+        record['status'] = 'partial'
+        record['missing'] = missing
+    return record
+
+
+class BatchStats:
+    """処理件数・スループットの集計"""
+
+    def __init__(self, total, skipped):
+        self.total = total
+        self.skipped = skipped
+        self.ok = 0
+        self.partial = 0
+        self.errors = 0
+        self.cpu_ms = 0.0
+        self.api_ms = 0.0
+        self.started = time.perf_counter()
+        self._last_report = self.started
+
+    def add(self, record):
+        if record['status'] in ('ok', 'partial'):
+            if record['status'] == 'ok':
+                self.ok += 1
+            else:
+                self.partial += 1
+            self.cpu_ms += record['timing_ms']['cpu']
+            self.api_ms += record['timing_ms']['api']
+        else:
+            self.errors += 1
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        done = self.ok + self.partial + self.errors
+        completed = self.ok + self.partial
+        return {
+            'images': done,
+            'remaining': self.total - done,
+            'ok': self.ok,
+            'partial': self.partial,
+            'errors': self.errors,
+            'skipped': self.skipped,
+            'elapsed_s': round(elapsed, 2),
+            'images_per_s': round(done / elapsed, 3) if elapsed > 0 else 0.0,
+            'mean_cpu_ms': round(self.cpu_ms / completed, 2) if completed else 0.0,
+            'mean_api_ms': round(self.api_ms / completed, 2) if completed else 0.0,
+        }
+
+    def report(self, interval):
+        now = time.perf_counter()
+        if now - self._last_report >= interval:
+            self._last_report = now
+            s = self.summary()
+            print(f"[batch] {s['images']}/{self.total} ok={s['ok']} partial={s['partial']} errors={s['errors']} "
+                  f"{s['images_per_s']:.2f} img/s (cpu {s['mean_cpu_ms']:.1f}ms, api {s['mean_api_ms']:.1f}ms)",
+                  file=sys.stderr)
+
+
+def run(paths, out_path, processes, batch, concurrency, progress):
+    """2段のパイプラインで分析し、完了した順にJSONLへ追記する"""
+    done = load_checkpoint(out_path)
+    paths = [p for p in paths if p not in done]
+    stats = BatchStats(len(paths), len(done))
+    chunks = chunked(paths, batch)
+
+    mp_context = multiprocessing.get_context('forkserver')
+    mp_context.set_forkserver_preload(['shikisai', 'buttai'])
+    with open(out_path, 'a', encoding='utf-8') as out, \
+            ProcessPoolExecutor(max_workers=processes, mp_context=mp_context, initializer=init_worker,
+                                initargs=(processes,)) as cpu_pool, \
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch-api') as api_pool:
+
+        def write(record):
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+            out.flush()
+            stats.add(record)
+
+        cpu_pending = {}
+        api_pending = {}
+
+        def fill():
+            # CPU段の先行分を子プロセス数の2倍までに抑える（API段が詰まったらCPU段も待つ）
+            while len(cpu_pending) < processes * 2 and len(api_pending) < concurrency * 4:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    return
+                cpu_pending[cpu_pool.submit(analyze_chunk, chunk)] = chunk
+
+        fill()
+        while cpu_pending or api_pending:
+            finished, _ = wait(set(cpu_pending) | set(api_pending), return_when=FIRST_COMPLETED)
+            for future in finished:
+                if future in cpu_pending:
+                    chunk = cpu_pending.pop(future)
+                    try:
+                        items = future.result()
+                    except Exception as e:
+                        items = [{'path': path, 'status': 'error', 'error': f'cpu stage failed: {e}'} for path in chunk]
+                    for item in items:
+                        if item.get('status') == 'error':
+                            write(item)
+                        else:
+                            api_pending[api_pool.submit(finish_item, item)] = item['path']
+                else:
+                    path = api_pending.pop(future)
+                    try:
+                        write(future.result())
+                    except Exception as e:
+                        write({'path': path, 'status': 'error', 'error': f'api stage failed: {e}'})
+            stats.report(progress)
+            fill()
+
+    return stats.summary()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help='ディレクトリ・画像ファイル・ファイルリスト（- で標準入力）')
+    parser.add_argument('--out', required=True, help='結果のJSONL（チェックポイントを兼ねる）')
+    parser.add_argument('--processes', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help='CPU段の子プロセス数')
+    parser.add_argument('--batch', type=int, default=8, help='YOLOで1回に推論する枚数')
+    parser.add_argument('--concurrency', type=int, default=8, help='API段で並行して待つ画像数')
+    parser.add_argument('--openai-rps', type=float, default=BATCH_OPENAI_RPS,
+                        help='OpenAI呼び出しの上限（1秒あたり、0で無制限。キャッシュヒットは数えない）')
+    parser.add_argument('--openai-burst', type=int, default=BATCH_OPENAI_BURST)
+    parser.add_argument('--progress', type=float, default=10.0, help='進捗を表示する間隔（秒）')
+    args = parser.parse_args()
+
+    if args.openai_rps > 0:
+        set_rate_limiter(RateLimiter(args.openai_rps, args.openai_burst))
+
+    summary = run(
+        list(iter_inputs(args.inputs)), args.out,
+        processes=max(1, args.processes), batch=max(1, args.batch),
+        concurrency=max(1, args.concurrency), progress=args.progress
+    )
+    print(json.dumps(summary, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
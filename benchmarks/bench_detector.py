@@ -0,0 +1,96 @@
+"""物体検出バックエンドの比較ベンチマーク（torch vs ONNX Runtime vs OpenVINO）
+
+    python benchmarks/bench_detector.py [--backends torch,onnx,openvino] [--repeat 20] [--json out.json]
+
+バックエンドごとに別プロセスでモデルを読み込み、画像ごとの推論時間（p50/p95）、
+読み込み後・推論後のRSS、最上位ラベル（buttai.detect_labelが選ぶもの）を計測する。
+ラベルの一致率は最初のバックエンド（既定はtorch）を基準にする。
+ONNXモデルは事前に `python detectors.py --export [--int8]` で作成しておく。
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+import numpy as np
+
+from common import ROOT_DIR, image_corpus, rss_mb, summarize, time_call, write_json
+
+
+def top_label(detections):
+    """最も信頼度の高い検出のラベル（未検出はNone）"""
+    if len(detections.confs) == 0:
+        return None
+    idx = int(detections.confs.argmax())
+    return detections.names[int(detections.cls_ids[idx])]
+
+
+def run_worker(backend, repeat):
+    """1バックエンド分を計測してJSONを標準出力へ（親プロセスから呼ばれる）"""
+    from detectors import create_detector
+    from image_context import ImageContext
+
+    images = [(name, ImageContext.from_bytes(data).scaled_bgr(320, 320)) for name, data in image_corpus()]
+    baseline = rss_mb()
+    detector = create_detector(backend)
+    loaded = rss_mb()
+
+    rows = []
+    samples_all = []
+    for name, img in images:
+        samples = time_call(lambda: detector.detect(img, 0.3), repeat=repeat)
+        samples_all.extend(samples)
+        rows.append({'image': name, 'label': top_label(detector.detect(img, 0.3)), **summarize(samples)})
+
+    print(json.dumps({
+        'backend': detector.backend,
+        'images': rows,
+        'latency': summarize(samples_all),
+        'memory': {'before_load': baseline, 'after_load': loaded, 'after_inference': rss_mb()},
+    }))
+
+
+def measure(backend, repeat):
+    """別プロセスで1バックエンド分を計測（他のバックエンドの読み込みがRSSに混ざらないように）"""
+    cmd = [sys.executable, __file__, '--worker', backend, '--repeat', str(repeat)]
+    try:
+        out = subprocess.check_output(cmd, cwd=ROOT_DIR)
+        return json.loads(out.decode().strip().splitlines()[-1])
+    except (OSError, subprocess.CalledProcessError, ValueError) as e:
+        print(f"{backend}: measurement failed ({e})")
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', default='torch,onnx,openvino')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--json', help='結果をJSONで保存するパス')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.repeat)
+        return
+
+    results = [r for r in (measure(b.strip(), args.repeat) for b in args.backends.split(',') if b.strip()) if r]
+    if not results:
+        return
+
+    reference = {row['image']: row['label'] for row in results[0]['images']}
+    print(f"{'backend':<10} {'p50':>9} {'p95':>9} {'rss(load)':>10} {'peak rss':>9} {'top-1 agree':>12}")
+    for result in results:
+        agree = [row['label'] == reference.get(row['image']) for row in result['images']]
+        result['top1_agreement'] = round(float(np.mean(agree)), 3) if agree else None
+        latency = result['latency']
+        memory = result['memory']
+        print(f"{result['backend']:<10} {latency['p50_ms']:>7.2f}ms {latency['p95_ms']:>7.2f}ms "
+              f"{memory['after_load']['rss_mb']:>8}MB {memory['after_inference']['peak_rss_mb']:>7}MB "
+              f"{result['top1_agreement'] * 100:>11.1f}%")
+
+    if args.json:
+        write_json(args.json, {'benchmark': 'detector', 'reference': results[0]['backend'], 'backends': results})
+
+
+if __name__ == '__main__':
+    main()
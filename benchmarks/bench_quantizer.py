@@ -0,0 +1,97 @@
+"""色量子化エンジンの比較ベンチマーク（MiniBatchKMeans vs メディアンカット）
+
+    python benchmarks/bench_quantizer.py [--repeat 50] [--json out.json]
+
+画像ごとに extract_colors の所要時間、パレットの一致度（KMeans各色から
+最も近いメディアンカット色までのRGB距離を出現比率で加重平均）、
+色感情の一致を表示する。sklearnの読み込み時間も別プロセスで計測する。
+"""
+import argparse
+import subprocess
+import sys
+
+import numpy as np
+
+from common import image_corpus, summarize, time_call, write_json
+
+import shikisai
+from image_context import ImageContext
+
+
+def palette_distance(ref_counts, ref_centers, centers):
+    """基準パレットの各色から最も近い色までの距離（出現比率で加重平均）"""
+    ref_centers = np.asarray(ref_centers, dtype=np.float64)
+    centers = np.asarray(centers, dtype=np.float64)
+    d = np.sqrt(((ref_centers[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)).min(axis=1)
+    w = np.asarray(ref_counts, dtype=np.float64)
+    return float((d * w).sum() / w.sum())
+
+
+def import_time(module):
+    """別プロセスでモジュールの読み込み時間（ミリ秒）を計測"""
+    code = f"import time; t = time.perf_counter(); import {module}; print((time.perf_counter() - t) * 1000)"
+    try:
+        out = subprocess.check_output([sys.executable, '-c', code], stderr=subprocess.DEVNULL)
+        return round(float(out.decode().strip()), 2)
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--json', help='結果をJSONで保存するパス')
+    args = parser.parse_args()
+
+    shikisai.load_color_index()
+    rows = []
+    totals = {'kmeans': [], 'mediancut': []}
+
+    print(f"{'image':<24} {'kmeans p50':>11} {'mcut p50':>9} {'dist':>7} {'emotion':>8}")
+    for name, data in image_corpus():
+        thumb = ImageContext.from_bytes(data).resized_rgb(shikisai.THUMBNAIL_SIZE)
+        stats = {}
+        for method in ('kmeans', 'mediancut'):
+            samples = time_call(lambda: shikisai.extract_colors(thumb, method=method), repeat=args.repeat)
+            totals[method].extend(samples)
+            stats[method] = summarize(samples)
+
+        km_counts, km_centers = shikisai.extract_colors(thumb, method='kmeans')
+        mc_counts, mc_centers = shikisai.extract_colors(thumb, method='mediancut')
+        dist = palette_distance(km_counts, km_centers, mc_centers)
+        same_emotion = (shikisai.match_color_emotions(km_centers) ==
+                        shikisai.match_color_emotions(mc_centers))
+        # メディアンカットは同じ入力で常に同じ結果になること
+        deterministic = np.array_equal(mc_centers, shikisai.extract_colors(thumb, method='mediancut')[1])
+
+        rows.append({
+            'image': name,
+            'kmeans': stats['kmeans'],
+            'mediancut': stats['mediancut'],
+            'palette_distance': round(dist, 3),
+            'same_emotion': bool(same_emotion),
+            'mediancut_deterministic': bool(deterministic),
+        })
+        print(f"{name:<24} {stats['kmeans']['p50_ms']:>9.3f}ms {stats['mediancut']['p50_ms']:>7.3f}ms "
+              f"{dist:>7.2f} {'same' if same_emotion else 'diff':>8}")
+
+    summary = {
+        'kmeans': summarize(totals['kmeans']),
+        'mediancut': summarize(totals['mediancut']),
+        'mean_palette_distance': round(float(np.mean([r['palette_distance'] for r in rows])), 3),
+        'emotion_agreement': round(float(np.mean([r['same_emotion'] for r in rows])), 3),
+        'import_ms': {'sklearn.cluster': import_time('sklearn.cluster'), 'numpy': import_time('numpy')},
+    }
+    print()
+    print(f"kmeans    p50={summary['kmeans']['p50_ms']:.3f}ms p95={summary['kmeans']['p95_ms']:.3f}ms")
+    print(f"mediancut p50={summary['mediancut']['p50_ms']:.3f}ms p95={summary['mediancut']['p95_ms']:.3f}ms")
+    print(f"palette distance (RGB, weighted): {summary['mean_palette_distance']}")
+    print(f"color emotion agreement: {summary['emotion_agreement'] * 100:.1f}%")
+    print(f"import time: {summary['import_ms']}")
+
+    if args.json:
+        write_json(args.json, {'benchmark': 'quantizer', 'images': rows, 'summary': summary})
+
+
+if __name__ == '__main__':
+    main()
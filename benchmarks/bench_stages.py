@@ -0,0 +1,178 @@
+"""分析パイプラインの段階別マイクロベンチマーク（外部APIはインプロセスの代替で置き換え）
+
+    python benchmarks/bench_stages.py [--stages optimize_image,extract_colors,...] [--repeat 30] [--json out.json]
+
+同梱サンプル写真＋合成画像の固定コーパスで、各段階を単独で繰り返し実行し、
+p50/p95/p99 と1回あたりのPythonヒープの最大使用量（tracemalloc）を記録する。
+OpenAI・Google Placesは fakes.py の代替を使うためネットワーク・APIキーなしで動く
+（LLM応答キャッシュも無効にし、応答の解析を毎回計測する）。
+
+段階:
+  optimize_image          アップロード画像のデコード＋縮小（app.optimize_imageの本体）
+  extract_colors          サムネイルからの色抽出（SHIKISAI_QUANTIZERの方式）
+  cached_color_distance   CSV全行との色距離（cold: キャッシュ消去後 / warm: キャッシュヒット）
+  match_color_emotions    事前計算インデックスでのパレット照合
+  yolo_inference          YOLO推論＋ラベル選択（モデルが読み込めない場合は省略）
+  process_buttai          物体検出＋感情語（代替OpenAI）
+  process_text_with_gpt   応答の解析（json / fenced / broken の各経路）
+  process_emo             雰囲気分析（single方式のリクエスト作成・応答解析）
+  places_plan             検索計画・結果の整形（代替Places Text Search）
+"""
+import argparse
+import contextlib
+import os
+import sys
+
+from common import image_corpus, peak_allocation_kb, rss_mb, summarize, time_call, write_json
+import fakes
+
+os.environ.setdefault('OPENAI_API_KEY', 'sk-bench-fake')
+
+import llm_cache
+import shikisai
+import buttai
+import emo_gpt_1
+from image_context import ImageContext
+from places_plan import PlacesPlan, trim_place
+
+STAGES = (
+    'optimize_image', 'extract_colors', 'cached_color_distance', 'match_color_emotions',
+    'yolo_inference', 'process_buttai', 'process_text_with_gpt', 'process_emo', 'places_plan',
+)
+CAPTION = 'A quiet lake surrounded by autumn trees under a clear blue sky.'
+PLACES_QUERIES = ['静かな 湖 観光地', '湖 静かな 観光地', '穏やかな 山 観光地']
+
+
+def install_fake_openai(text_variant='json'):
+    """各モジュールが使うOpenAIクライアントを代替に差し替え、応答キャッシュを無効にする"""
+    fake = fakes.FakeOpenAI(text_variant=text_variant)
+    emo_gpt_1.get_openai_client = lambda: fake
+    buttai.get_openai_client = lambda: fake
+    llm_cache.llm_cache = fakes.NullCache()
+    return fake
+
+
+def run_places_plan(queries):
+    """代替Text Searchで件数が揃うまで検索計画を進める（app.iter_placesの同期部分と同じ流れ）"""
+    plan = PlacesPlan(queries)
+    while True:
+        step = plan.next_step()
+        if step is None:
+            return plan.places
+        data = fakes.fake_text_search(step.query, step.page_token)
+        page = {'places': [trim_place(place) for place in data.get('results', [])]}
+        if data.get('next_page_token'):
+            page['next_page_token'] = data['next_page_token']
+        plan.add_page(step.key, step.query, page, step.page_no)
+
+
+def stage_cases(stage, corpus):
+    """段階ごとの計測ケース [(ケース名, 関数)]。計測できない場合は空リスト"""
+    if stage == 'optimize_image':
+        return [(name, lambda data=data: ImageContext.from_bytes(data, max_size=(320, 320))) for name, data in corpus]
+
+    contexts = [(name, ImageContext.from_bytes(data)) for name, data in corpus]
+    if stage == 'extract_colors':
+        return [(name, lambda t=ctx.resized_rgb(shikisai.THUMBNAIL_SIZE): shikisai.extract_colors(t))
+                for name, ctx in contexts]
+    if stage in ('cached_color_distance', 'match_color_emotions'):
+        shikisai.load_color_index()
+        palettes = [(name, shikisai.extract_colors(ctx.resized_rgb(shikisai.THUMBNAIL_SIZE))[1]) for name, ctx in contexts]
+        if stage == 'match_color_emotions':
+            return [(name, lambda c=centers: shikisai.match_color_emotions(c)) for name, centers in palettes]
+        rgb = [tuple(int(v) for v in center) for _, centers in palettes for center in centers]
+
+        def cold():
+            shikisai.cached_color_distance.cache_clear()
+            for r, g, b in rgb:
+                shikisai.cached_color_distance(r, g, b, 'bench')
+
+        def warm():
+            for r, g, b in rgb:
+                shikisai.cached_color_distance(r, g, b, 'bench')
+
+        return [('cold', cold), ('warm', warm)]
+    if stage in ('yolo_inference', 'process_buttai'):
+        if not buttai.ensure_model():
+            print(f"{stage}: model unavailable, skipped")
+            return []
+        if stage == 'yolo_inference':
+            return [(name, lambda c=ctx: buttai.detect_label(c, in_process=True)) for name, ctx in contexts]
+        install_fake_openai()
+        return [(name, lambda c=ctx: buttai.process_buttai(c)) for name, ctx in contexts]
+    if stage == 'process_text_with_gpt':
+        install_fake_openai()
+
+        def parse(variant):
+            fake = fakes.FakeOpenAI(text_variant=variant)
+            getter = lambda: fake
+
+            def run():
+                emo_gpt_1.get_openai_client = getter
+                return emo_gpt_1.process_text_with_gpt(CAPTION)
+            return run
+        return [(variant, parse(variant)) for variant in fakes.TEXT_VARIANTS]
+    if stage == 'process_emo':
+        install_fake_openai()
+        return [(name, lambda c=ctx: emo_gpt_1.process_emo(c)) for name, ctx in contexts]
+    if stage == 'places_plan':
+        return [('dedupe+first_page', lambda: run_places_plan(PLACES_QUERIES)),
+                ('single_query', lambda: run_places_plan(PLACES_QUERIES[:1]))]
+    raise ValueError(f'unknown stage: {stage}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stages', default=','.join(STAGES))
+    parser.add_argument('--repeat', type=int, default=30)
+    parser.add_argument('--json', help='結果をJSONで保存するパス')
+    args = parser.parse_args()
+
+    stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(unknown)}")
+
+    corpus = image_corpus()
+    results = {}
+    print(f"{'stage':<24} {'n':>6} {'p50':>10} {'p95':>10} {'p99':>10} {'peak alloc':>11}")
+    for stage in stages:
+        cases = stage_cases(stage, corpus)
+        if not cases:
+            results[stage] = {'skipped': True}
+            continue
+        rows = []
+        samples_all = []
+        # 各段階のログ出力（print）は計測中は捨てる
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for case, fn in cases:
+                samples = time_call(fn, repeat=args.repeat)
+                samples_all.extend(samples)
+                rows.append({'case': case, **summarize(samples)})
+            # メモリは代表ケース（最初のケース）の1回分
+            peak_kb = peak_allocation_kb(cases[0][1])
+        latency = summarize(samples_all)
+        results[stage] = {'latency': latency, 'cases': rows, 'peak_alloc_kb': peak_kb}
+        print(f"{stage:<24} {latency['n']:>6} {latency['p50_ms']:>8.3f}ms {latency['p95_ms']:>8.3f}ms "
+              f"{latency['p99_ms']:>8.3f}ms {peak_kb:>9.1f}KB")
+
+    memory = rss_mb()
+    print(f"RSS {memory['rss_mb']}MB (peak {memory['peak_rss_mb']}MB)")
+
+    if args.json:
+        write_json(args.json, {
+            'benchmark': 'stages',
+            'repeat': args.repeat,
+            'corpus': [name for name, _ in corpus],
+            'config': {
+                'quantizer': os.getenv('SHIKISAI_QUANTIZER', 'kmeans'),
+                'detector_backend': buttai.DETECTOR_BACKEND,
+                'python': sys.version.split()[0],
+            },
+            'stages': results,
+            'memory': memory,
+        })
+
+
+if __name__ == '__main__':
+    main()
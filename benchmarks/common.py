@@ -0,0 +1,139 @@
+"""ベンチマーク共通処理（計測・統計・画像コーパス）
+
+各スクリプトはリポジトリ直下から `python benchmarks/<script>.py` で実行する。
+"""
+import os
+import sys
+import json
+import time
+import glob
+import subprocess
+import tracemalloc
+
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+SAMPLE_IMAGE_DIR = os.path.join(ROOT_DIR, 'static', 'images')
+
+
+def time_call(fn, repeat=50, warmup=3):
+    """fnを繰り返し実行し、各回の所要時間（ミリ秒）のリストを返す"""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def summarize(samples):
+    """所要時間リストからp50/p95/p99などの統計を作る（ミリ秒）"""
+    arr = np.asarray(samples, dtype=np.float64)
+    if arr.size == 0:
+        return {'n': 0}
+    return {
+        'n': int(arr.size),
+        'mean_ms': round(float(arr.mean()), 4),
+        'p50_ms': round(float(np.percentile(arr, 50)), 4),
+        'p95_ms': round(float(np.percentile(arr, 95)), 4),
+        'p99_ms': round(float(np.percentile(arr, 99)), 4),
+        'max_ms': round(float(arr.max()), 4),
+    }
+
+
+def rss_mb():
+    """現在のRSSとピークRSS（MB）"""
+    usage = {}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    key, value = line.split(':', 1)
+                    usage[key] = round(int(value.split()[0]) / 1024, 1)
+    except OSError:
+        import resource
+        usage['VmHWM'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return {'rss_mb': usage.get('VmRSS'), 'peak_rss_mb': usage.get('VmHWM')}
+
+
+def peak_allocation_kb(fn):
+    """fnを1回実行したときのPythonヒープ（numpy配列を含む）の最大使用量（KB）"""
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round(peak / 1024, 1)
+
+
+def synthetic_images(count=6, size=(640, 480), seed=0):
+    """決定的な合成画像（BGR）を生成: グラデーション・単色ブロック・ノイズ"""
+    rng = np.random.default_rng(seed)
+    w, h = size
+    images = []
+    for i in range(count):
+        kind = i % 3
+        if kind == 0:
+            x = np.linspace(0, 255, w, dtype=np.float32)
+            y = np.linspace(0, 255, h, dtype=np.float32)[:, None]
+            img = np.stack([np.broadcast_to(x, (h, w)), np.broadcast_to(y, (h, w)),
+                            np.full((h, w), (i * 40) % 256, np.float32)], axis=2)
+        elif kind == 1:
+            blocks = rng.integers(0, 256, (4, 4, 3)).astype(np.float32)
+            img = np.kron(blocks, np.ones((h // 4 + 1, w // 4 + 1, 1), np.float32))[:h, :w]
+        else:
+            base = rng.integers(0, 256, 3).astype(np.float32)
+            img = base + rng.normal(0, 35, (h, w, 3)).astype(np.float32)
+        images.append((f'synthetic_{i}', np.clip(img, 0, 255).astype(np.uint8)))
+    return images
+
+
+def sample_image_paths():
+    """リポジトリ同梱のサンプル写真（static/images/*.jpg）"""
+    return sorted(glob.glob(os.path.join(SAMPLE_IMAGE_DIR, '*.jpg')))
+
+
+def encode_jpeg(bgr, quality=90):
+    """BGR配列をJPEGバイト列に変換"""
+    import cv2
+    ok, enc = cv2.imencode('.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError('jpeg encode failed')
+    return enc.tobytes()
+
+
+def image_corpus():
+    """(名前, JPEGバイト列) のリスト: 同梱サンプル写真 + 合成画像"""
+    corpus = []
+    for path in sample_image_paths():
+        with open(path, 'rb') as f:
+            corpus.append((os.path.basename(path), f.read()))
+    for name, img in synthetic_images():
+        corpus.append((name, encode_jpeg(img)))
+    return corpus
+
+
+def git_revision():
+    """計測対象のコミット（取得できない場合は空文字）"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def write_json(path, payload):
+    """計測結果をJSONで保存（コミット間比較用）"""
+    payload = dict(payload)
+    payload.setdefault('revision', git_revision())
+    payload.setdefault('timestamp', time.time())
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2)
+    print(f"Results written to {path}")
@@ -0,0 +1,146 @@
+"""外部APIのインプロセス代替（OpenAI chat completions・Google Places）
+
+ベンチマークをオフラインで実行するため、応答の内容をリクエストから決めて返す。
+応答は決定的（同じリクエストには同じ応答）。
+"""
+import json
+import time
+import hashlib
+from types import SimpleNamespace
+
+SCENES = ['sea', 'mountain', 'temple', 'park', 'city skyline', 'lake']
+EMOTIONS = ['穏やかな', '壮大な', '静かな', '爽やかな', '懐かしい', '幻想的な']
+
+# process_text_with_gpt の応答の形（解析経路ごとに計測するため）
+#   json: そのままJSON / fenced: 前後に説明文が付く（正規表現で抽出）/ broken: JSONなし（フォールバック）
+TEXT_VARIANTS = ('json', 'fenced', 'broken')
+
+
+def _pick(values, *parts):
+    digest = hashlib.md5('|'.join(str(p) for p in parts).encode('utf-8')).digest()
+    return values[digest[0] % len(values)]
+
+
+def _message_text(messages):
+    """メッセージ中のテキスト部分を連結（画像パートは除く）"""
+    texts = []
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, str):
+            texts.append(content)
+        elif isinstance(content, list):
+            texts.extend(part.get('text', '') for part in content if part.get('type') == 'text')
+    return '\n'.join(texts)
+
+
+def fake_chat_content(model, messages, text_variant='json', **params):
+    """リクエストの種類（応答形式・プロンプト）に応じた応答本文"""
+    text = _message_text(messages)
+    response_format = params.get('response_format') or {}
+    emotion = _pick(EMOTIONS, text)
+    scene = _pick(SCENES, text)
+
+    if response_format.get('type') == 'json_schema':
+        # single方式の雰囲気分析（Vision 1回）
+        return json.dumps({
+            'original_caption_en': f'A view of the {scene}.',
+            'improved_caption_en': f'A quiet, beautiful view of the {scene} in soft light.',
+            'translated_caption_jp': f'柔らかな光に包まれた静かな{scene}の景色。',
+            'extracted_emotion': emotion,
+            'scene_label': scene,
+        }, ensure_ascii=False)
+    if '"scene"' in text:
+        return json.dumps({'scene': scene})
+    if 'extracted_emotion' in text:
+        payload = json.dumps({
+            'improved_caption_en': 'A calm landscape under a clear sky.',
+            'translated_caption_jp': '晴れた空の下の穏やかな風景。',
+            'extracted_emotion': emotion,
+        }, ensure_ascii=False)
+        if text_variant == 'fenced':
+            return f'以下が結果です。\n```json\n{payload}\n```\n以上。'
+        if text_variant == 'broken':
+            return f'improved: A calm landscape. 感情は{emotion}です'
+        return payload
+    if 'translated_caption_jp' in text:
+        return json.dumps({
+            'improved_caption_en': 'A calm landscape under a clear sky.',
+            'translated_caption_jp': '晴れた空の下の穏やかな風景。',
+        }, ensure_ascii=False)
+    if (params.get('max_tokens') or 0) <= 10:
+        # 物体ラベル→感情語
+        return emotion
+    return f'A photo of a {scene} with people walking.'
+
+
+class FakeChatCompletions:
+    def __init__(self, owner):
+        self.owner = owner
+
+    def create(self, model, messages, **params):
+        self.owner.calls += 1
+        if self.owner.latency:
+            time.sleep(self.owner.latency)
+        content = fake_chat_content(model, messages, text_variant=self.owner.text_variant, **params)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+class FakeOpenAI:
+    """openai.OpenAIの代わりに使うクライアント（chat.completions.createのみ）"""
+
+    def __init__(self, text_variant='json', latency=0.0):
+        self.text_variant = text_variant
+        self.latency = latency
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=FakeChatCompletions(self))
+
+
+class NullCache:
+    """常にミスするキャッシュ（API応答の解析を毎回計測するため）"""
+
+    def get(self, key, default=None):
+        return default
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+
+def fake_place(query, index):
+    """Text Searchの結果1件（Google Places APIの形式）"""
+    place_id = 'fake-' + hashlib.md5(f'{query}|{index}'.encode('utf-8')).hexdigest()[:16]
+    return {
+        'place_id': place_id,
+        'name': f'{query} スポット{index + 1}',
+        'formatted_address': f'日本、東京都 架空区 {index + 1}-1',
+        'rating': round(3.5 + (index % 15) / 10, 1),
+        'photos': [{'photo_reference': f'photo-{place_id}', 'height': 800, 'width': 1200}],
+        'types': ['tourist_attraction', 'point_of_interest'],
+        'geometry': {'location': {'lat': 35.0 + index / 100, 'lng': 139.0 + index / 100}},
+    }
+
+
+def fake_text_search(query, page_token=None, per_page=20, pages=3):
+    """Text Searchの応答JSON（page_tokenで次ページ、pagesページ目まで）"""
+    page_no = int(page_token.rsplit(':', 1)[1]) if page_token else 1
+    start = (page_no - 1) * per_page
+    data = {'status': 'OK', 'results': [fake_place(query, start + i) for i in range(per_page)]}
+    if page_no < pages:
+        data['next_page_token'] = f'{hashlib.md5(query.encode("utf-8")).hexdigest()[:8]}:{page_no + 1}'
+    return data
+
+
+def fake_place_details(place_id):
+    """Place Detailsの応答JSON"""
+    return {
+        'status': 'OK',
+        'result': {
+            'place_id': place_id,
+            'name': f'スポット {place_id[-4:]}',
+            'formatted_address': '日本、東京都 架空区 1-1',
+            'rating': 4.2,
+            'photos': [{'photo_reference': f'photo-{place_id}'}],
+        },
+    }
@@ -0,0 +1,219 @@
+"""起動中のアプリに /analyze と /proxy-photo の負荷をかける負荷生成ツール
+
+    python benchmarks/loadgen.py --url http://127.0.0.1:5000 [--concurrency 16] [--duration 60 | --requests 500]
+        [--mix analyze=1,photo=3] [--unique] [--stub-url http://127.0.0.1:8090] [--json out.json]
+
+外部APIの課金を避けるため、アプリは stub_api.py に向けて起動しておく（環境変数は stub_api.py を参照）。
+--concurrency 本のスレッドが --mix の比率でエンドポイントを選んで送り続け、エンドポイントごとの
+スループット・レイテンシ（p50/p95/p99）・エラー率・ステータスコードを表示する。
+
+- /analyze には同梱のサンプル写真を送る。--unique を付けるとJPEGの末尾に乱数を足して
+  分析キャッシュを効かなくする（デコード結果は同じ）
+- /proxy-photo は /analyze の応答に含まれる写真と、--photo-refs 種類の架空の参照を交互に使う
+  （ディスクキャッシュのヒットとミスが混ざる）
+"""
+import argparse
+import os
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+
+import requests
+
+from common import sample_image_paths, summarize, write_json
+
+REGIONS = ['東京', '京都', '北海道', '沖縄', '長野']
+PURPOSES = ['観光', 'リラックス', 'グルメ', '自然']
+
+
+def parse_mix(value):
+    """'analyze=1,photo=3' を [(名前, 重み)] に変換"""
+    mix = []
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        if name not in ('analyze', 'photo'):
+            raise argparse.ArgumentTypeError(f'unknown endpoint: {name}')
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+class LoadStats:
+    """エンドポイントごとのレイテンシ・ステータスの集計（スレッドセーフ）"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.errors = Counter()
+
+    def add(self, endpoint, elapsed_ms, status, ok):
+        with self.lock:
+            self.samples[endpoint].append(elapsed_ms)
+            self.statuses[endpoint][str(status)] += 1
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def report(self, elapsed_s):
+        endpoints = {}
+        for endpoint, samples in sorted(self.samples.items()):
+            count = len(samples)
+            endpoints[endpoint] = {
+                'requests': count,
+                'throughput_rps': round(count / elapsed_s, 3) if elapsed_s > 0 else 0.0,
+                'error_rate': round(self.errors[endpoint] / count, 4) if count else 0.0,
+                'statuses': dict(self.statuses[endpoint]),
+                'latency': summarize(samples),
+            }
+        total = sum(len(s) for s in self.samples.values())
+        return {
+            'elapsed_s': round(elapsed_s, 2),
+            'requests': total,
+            'throughput_rps': round(total / elapsed_s, 3) if elapsed_s > 0 else 0.0,
+            'error_rate': round(sum(self.errors.values()) / total, 4) if total else 0.0,
+            'endpoints': endpoints,
+        }
+
+
+class LoadGenerator:
+    def __init__(self, args):
+        self.url = args.url.rstrip('/')
+        self.mix = args.mix
+        self.unique = args.unique
+        self.photo_refs = args.photo_refs
+        self.timeout = args.timeout
+        self.images = []
+        for path in sample_image_paths():
+            with open(path, 'rb') as f:
+                self.images.append((os.path.basename(path), f.read()))
+        if not self.images:
+            raise SystemExit('no sample images found under static/images')
+        self.stats = LoadStats()
+        self.seen_photos = []
+        self.lock = threading.Lock()
+        self.issued = 0
+
+    def take_ticket(self, limit):
+        """送信数の上限（--requests）を超えないよう1件分の枠を取る"""
+        with self.lock:
+            if limit and self.issued >= limit:
+                return False
+            self.issued += 1
+            return True
+
+    def analyze(self, session, rng):
+        name, data = rng.choice(self.images)
+        if self.unique:
+            data = data + rng.randbytes(16)
+        response = session.post(
+            f'{self.url}/analyze',
+            data={'region': rng.choice(REGIONS), 'purpose': rng.choice(PURPOSES)},
+            files={'image': (name, data, 'image/jpeg')},
+            timeout=self.timeout,
+        )
+        ok = response.status_code == 200
+        if ok:
+            body = response.json()
+            ok = 'error' not in body
+            photos = [s.get('photo_url', '') for s in body.get('suggestions', [])]
+            photos = [url for url in photos if '/proxy-photo/' in url]
+            if photos:
+                with self.lock:
+                    self.seen_photos.extend(photos)
+                    del self.seen_photos[:-200]
+        return response.status_code, ok
+
+    def photo(self, session, rng):
+        with self.lock:
+            seen = list(self.seen_photos)
+        if seen and rng.random() < 0.5:
+            url = rng.choice(seen)
+        else:
+            url = f'{self.url}/proxy-photo/loadtest-{rng.randrange(self.photo_refs)}?maxwidth=400'
+        response = session.get(url, timeout=self.timeout)
+        response.content  # 本文まで受信して計測する
+        return response.status_code, response.status_code in (200, 304)
+
+    def worker(self, seed, deadline, limit):
+        rng = random.Random(seed)
+        session = requests.Session()
+        names = [name for name, _ in self.mix]
+        weights = [weight for _, weight in self.mix]
+        while time.perf_counter() < deadline and self.take_ticket(limit):
+            endpoint = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                status, ok = getattr(self, endpoint)(session, rng)
+            except requests.RequestException as e:
+                status, ok = type(e).__name__, False
+            self.stats.add(endpoint, (time.perf_counter() - start) * 1000, status, ok)
+
+    def run(self, concurrency, duration, limit, seed):
+        deadline = time.perf_counter() + (duration if duration else float('inf'))
+        threads = [
+            threading.Thread(target=self.worker, args=(seed + i, deadline, limit), daemon=True)
+            for i in range(concurrency)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.stats.report(time.perf_counter() - start)
+
+
+def fetch_stub_stats(stub_url):
+    try:
+        return requests.get(f'{stub_url.rstrip("/")}/stub/stats', timeout=5).json()
+    except (requests.RequestException, ValueError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, help='計測時間（秒）。既定は60、--requests指定時は無制限')
+    parser.add_argument('--requests', type=int, default=0, help='送信する総リクエスト数（0で無制限）')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('analyze=1,photo=3'))
+    parser.add_argument('--unique', action='store_true', help='毎回異なる画像として送る（分析キャッシュを無効化）')
+    parser.add_argument('--photo-refs', type=int, default=50, help='架空の写真参照の種類数')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stub-url', help='stub_api.pyのURL（外部API呼び出し数も記録する）')
+    parser.add_argument('--json', help='結果をJSONで保存するパス')
+    args = parser.parse_args()
+    if args.duration is None:
+        args.duration = 0 if args.requests else 60.0
+
+    before = fetch_stub_stats(args.stub_url) if args.stub_url else None
+    report = LoadGenerator(args).run(max(1, args.concurrency), args.duration, args.requests, args.seed)
+    if args.stub_url:
+        after = fetch_stub_stats(args.stub_url)
+        if before and after:
+            report['upstream_calls'] = {k: v - before['calls'].get(k, 0) for k, v in after['calls'].items()}
+            report['upstream_errors'] = {k: v - before['errors'].get(k, 0) for k, v in after['errors'].items()}
+
+    print(f"{'endpoint':<10} {'reqs':>6} {'rps':>8} {'errors':>7} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for endpoint, row in report['endpoints'].items():
+        latency = row['latency']
+        print(f"{endpoint:<10} {row['requests']:>6} {row['throughput_rps']:>8.2f} {row['error_rate'] * 100:>6.1f}% "
+              f"{latency['p50_ms']:>7.0f}ms {latency['p95_ms']:>7.0f}ms {latency['p99_ms']:>7.0f}ms")
+    print(f"total {report['requests']} requests in {report['elapsed_s']}s "
+          f"({report['throughput_rps']:.2f} rps, errors {report['error_rate'] * 100:.1f}%)")
+    if 'upstream_calls' in report:
+        print(f"upstream calls: {report['upstream_calls']} errors: {report['upstream_errors']}")
+
+    if args.json:
+        write_json(args.json, {
+            'benchmark': 'loadgen',
+            'target': args.url,
+            'concurrency': args.concurrency,
+            'mix': dict(args.mix),
+            'unique': args.unique,
+            **report,
+        })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""負荷試験用のOpenAI・Google Placesスタブサーバー
+
+    python benchmarks/stub_api.py [--port 8090] [--latency openai=600:200] [--error-rate openai=0.02] [--seed 0]
+
+アプリが使う範囲だけを実装する（応答の内容は fakes.py と同じ決定的なもの）:
+  POST /v1/chat/completions                  OpenAI chat completions
+  GET  /maps/api/place/textsearch/json       Places Text Search（next_page_tokenあり）
+  GET  /maps/api/place/details/json          Place Details
+  GET  /maps/api/place/photo                 Place Photo（同梱のサンプル写真を返す）
+  GET  /stub/stats                           種類ごとの呼び出し数・エラー数
+
+アプリ側は次の環境変数でスタブに向ける:
+  OPENAI_BASE_URL=http://127.0.0.1:8090/v1  OPENAI_API_KEY=sk-stub
+  EMOTABI_GOOGLE_MAPS_BASE_URL=http://127.0.0.1:8090  GOOGLE_MAPS_API_KEY=stub
+
+遅延は種類ごとに `平均ms:標準偏差ms` の正規分布（0未満は0）。エラーは指定の割合で、
+OpenAIは429/500/503（SDKの再試行対象）、Places検索・詳細はHTTP 200の OVER_QUERY_LIMIT、
+写真はHTTP 500を返す。
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import fakes
+
+# 標準ライブラリだけで動かすため common.py（numpy）は読み込まない
+SAMPLE_IMAGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'images')
+
+KINDS = ('openai', 'textsearch', 'details', 'photo')
+DEFAULT_LATENCY = {'openai': (600, 200), 'textsearch': (150, 50), 'details': (100, 30), 'photo': (80, 20)}
+OPENAI_ERROR_STATUSES = (429, 500, 503)
+
+
+def parse_kind_values(values, convert):
+    """['openai=600:200', ...] を {kind: 値} に変換"""
+    parsed = {}
+    for item in values or []:
+        kind, _, value = item.partition('=')
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f'unknown kind: {kind} (choose from {", ".join(KINDS)})')
+        parsed[kind] = convert(value)
+    return parsed
+
+
+def parse_latency(value):
+    mean, _, stddev = value.partition(':')
+    return float(mean), float(stddev or 0)
+
+
+class StubState:
+    """遅延・エラーの設定と呼び出し数の集計（スレッドセーフ）"""
+
+    def __init__(self, latency, error_rate, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.errors = Counter()
+        self.photos = sorted(glob.glob(os.path.join(SAMPLE_IMAGE_DIR, '*.jpg')))
+
+    def draw(self, kind):
+        """この呼び出しの遅延（秒）とエラーにするかを決める"""
+        mean, stddev = self.latency.get(kind, (0, 0))
+        with self.lock:
+            delay = max(0.0, self.random.gauss(mean, stddev)) / 1000 if mean or stddev else 0.0
+            failed = self.random.random() < self.error_rate.get(kind, 0.0)
+            self.calls[kind] += 1
+            if failed:
+                self.errors[kind] += 1
+            status = self.random.choice(OPENAI_ERROR_STATUSES)
+        return delay, failed, status
+
+    def photo_bytes(self, photo_ref):
+        """photo_referenceごとに決まったサンプル写真"""
+        if not self.photos:
+            return b''
+        index = int(hashlib.md5(photo_ref.encode('utf-8')).hexdigest(), 16) % len(self.photos)
+        with open(self.photos[index], 'rb') as f:
+            return f.read()
+
+    def stats(self):
+        with self.lock:
+            return {'calls': dict(self.calls), 'errors': dict(self.errors)}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, format, *args):
+        pass  # 1リクエストごとのログは出さない
+
+    def send_body(self, status, body, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        if url.path.rstrip('/') != '/v1/chat/completions':
+            return self.send_body(404, {'error': {'message': 'not found'}})
+
+        delay, failed, status = self.state.draw('openai')
+        time.sleep(delay)
+        if failed:
+            return self.send_body(status, {'error': {'message': 'stub error', 'type': 'server_error', 'code': status}})
+
+        params = {k: v for k, v in payload.items() if k not in ('model', 'messages')}
+        content = fakes.fake_chat_content(payload.get('model', ''), payload.get('messages', []), **params)
+        self.send_body(200, {
+            'id': 'chatcmpl-stub',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': payload.get('model', ''),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+        })
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path == '/stub/stats':
+            return self.send_body(200, self.state.stats())
+
+        routes = {
+            '/maps/api/place/textsearch/json': 'textsearch',
+            '/maps/api/place/details/json': 'details',
+            '/maps/api/place/photo': 'photo',
+        }
+        kind = routes.get(url.path)
+        if kind is None:
+            return self.send_body(404, {'status': 'NOT_FOUND'})
+
+        delay, failed, _ = self.state.draw(kind)
+        time.sleep(delay)
+        if kind == 'photo':
+            if failed:
+                return self.send_body(500, b'stub error', 'text/plain')
+            return self.send_body(200, self.state.photo_bytes(query.get('photoreference', '')), 'image/jpeg')
+        if failed:
+            return self.send_body(200, {'status': 'OVER_QUERY_LIMIT', 'results': []})
+        if kind == 'textsearch':
+            return self.send_body(200, fakes.fake_text_search(query.get('query', ''), query.get('pagetoken')))
+        self.send_body(200, fakes.fake_place_details(query.get('place_id', '')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', action='append', metavar='KIND=MEAN_MS[:STDDEV_MS]',
+                        help=f'種類ごとの遅延（既定: {DEFAULT_LATENCY}）')
+    parser.add_argument('--error-rate', action='append', metavar='KIND=RATE', help='種類ごとのエラー率（0〜1）')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    latency = dict(DEFAULT_LATENCY)
+    latency.update(parse_kind_values(args.latency, parse_latency))
+    error_rate = parse_kind_values(args.error_rate, float)
+
+    StubHandler.state = StubState(latency, error_rate, seed=args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    server.daemon_threads = True
+    print(f"Stub API listening on http://{args.host}:{args.port} (latency={latency}, errors={error_rate})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
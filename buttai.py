@@ -1,137 +1,266 @@
 import os
-import base64
+import json
+import asyncio
+import threading
+import numpy as np
 from PIL import Image
-from functools import lru_cache
-from openai import OpenAI
-import cv2
-from ultralytics import YOLO
+from http_clients import get_openai_client, get_async_openai_client
+from detectors import DETECTOR_BACKEND, FORK_SAFE_BACKENDS, create_detector, normalize_backend
+from inference_batcher import InferenceBatcher
+from metrics import stage, timed, in_request_context
+from cpu_pool import CPU_PROCESSES, pool_enabled, in_pool_child, run_in_pool, start_pool, detect_label_task
+from image_context import as_image_context, vision_detail
+from llm_cache import cached_chat_completion, cached_chat_completion_async, is_json_with
+from scene_labels import SCENE_LABELS
 
 # OpenAIクライアントを初期化（新API対応）
 client = None
 
 def init_openai_client():
-    """OpenAI API クライアントの遅延初期化"""
+    """OpenAI API クライアントの取得（全モジュール共有・接続プール付き）"""
     global client
-    if client is None:
-        api_key = os.getenv('OPENAI_API_KEY')
-        if api_key:
-            try:
-                client = OpenAI(api_key=api_key)
-            except TypeError as e:
-                print(f"OpenAI client initialization error (buttai): {e}")
-                client = None
-            except Exception as e:
-                print(f"OpenAI client initialization error (buttai): {e}")
-                client = None
+    client = get_openai_client()
+
+# 雰囲気分析のVision応答（シーン名）を待つ最大秒数（超えたら個別にシーン判定）
+SCENE_WAIT_TIMEOUT = float(os.getenv('BUTTAI_SCENE_WAIT_TIMEOUT', '20'))
+
+# シーン判定時のVision APIのdetail（候補から1つ選ぶだけなのでlowで十分）
+VISION_DETAIL = vision_detail(os.getenv('BUTTAI_VISION_DETAIL'), 'low')
 
 # グローバルモデル変数
 model = None
 model_conf = 0.3
 
-def load_model(model_name='yolov8n', conf=0.3):
+# ultralyticsの推論・OpenVINOの推論リクエストはスレッドセーフでないため、同一プロセス内の同時推論を直列化する
+_predict_lock = threading.Lock()
+
+# 同時リクエストの推論をまとめるマイクロバッチ（BUTTAI_MAX_BATCH=1で無効、1枚ずつ推論）
+# 同期ワーカー（1プロセス1リクエスト）では2件以上まとまらず待ち時間だけ増えるため、既定はASGIモードのみ有効
+SERVER_MODE = os.getenv('EMOTABI_SERVER_MODE', 'sync').strip().lower()
+MAX_BATCH = int(os.getenv('BUTTAI_MAX_BATCH', '8' if SERVER_MODE == 'async' else '1'))
+BATCH_WAIT_MS = float(os.getenv('BUTTAI_BATCH_WAIT_MS', '5'))
+
+
+def detect_batch(images):
+    """複数画像をまとめて推論（ウォームアップ推論とも重ならないようロックを取る）"""
+    with _predict_lock:
+        return model.detect_batch(images, model_conf)
+
+
+_batcher = InferenceBatcher(detect_batch, max_batch=MAX_BATCH, max_wait_ms=BATCH_WAIT_MS, name='yolo-batcher')
+
+
+def batching_enabled():
+    """マイクロバッチを使うか（プロセスプールの子は1件ずつ処理するためまとめない）"""
+    return MAX_BATCH > 1 and not in_pool_child()
+
+
+def run_detection(img, expected=False):
+    """推論1件（マイクロバッチ有効時はスケジューラ経由で他の要求とまとめて実行）
+
+    expected: 前処理の前に _batcher.expect() で予告済みの場合に指定
+    """
+    if batching_enabled():
+        return _batcher.submit(img, expected)
+    with _predict_lock:
+        return model.detect(img, model_conf)
+
+
+def inference_stats():
+    """推論スケジューラの集計（キューの深さ・バッチサイズ）"""
+    # プロセスプール有効時は推論は子プロセス側で行われる（ここでの集計は0のまま）
+    return {
+        'backend': getattr(model, 'backend', None) or normalize_backend(DETECTOR_BACKEND),
+        'max_batch': MAX_BATCH,
+        'cpu_processes': CPU_PROCESSES if pool_enabled() else 0,
+        **_batcher.stats(),
+    }
+
+# 初回読み込みの排他（同時の初回リクエストでモデルを二重に読み込まない）
+_model_lock = threading.Lock()
+
+def load_model(model_name='yolov8n', conf=0.3, backend=None):
     """
-    ultralytics YOLOv8 Nanoモデルをロードします。
+    YOLOv8 Nanoモデルをロードします。
     model_name: 'yolov8n' など
     conf: 信頼度閾値
+    backend: 'torch'（ultralytics）/ 'onnx'（ONNX Runtime）/ 'openvino'。省略時は環境変数 BUTTAI_BACKEND
     """
     global model, model_conf
+    backend = backend or DETECTOR_BACKEND
     try:
-        model_path = f"{model_name}.pt"
-        
-        # モデルファイルが存在しない場合の処理
-        if not os.path.exists(model_path):
-            print(f"Model file {model_path} not found. Downloading...")
-            model = YOLO(model_name)  # 自動ダウンロード
-        else:
-            model = YOLO(model_path)
-        
+        model = create_detector(backend, model_name)
         model_conf = conf
         
-        # モデル設定の最適化
-        model.overrides['verbose'] = False  # ログを削減
-        
-        print("YOLO model loaded successfully")
+        print(f"YOLO model loaded successfully ({model.backend})")
         return True
         
     except ImportError:
-        print("Ultralytics YOLO not available. Object detection disabled.")
+        print(f"Inference runtime for '{backend}' not available. Object detection disabled.")
         return False
     except Exception as e:
         print(f"Error loading YOLO model: {e}")
         return False
 
 
-def classify_scene_label(image_path):
+def ensure_model():
+    """モデルが未ロードならロード（複数スレッドから同時に呼ばれても1回だけ読み込む）"""
+    if model is not None:
+        return True
+    with _model_lock:
+        if model is not None:
+            return True
+        return load_model()
+
+
+def can_preload():
+    """fork前のマスタープロセスでモデルを読み込めるか（設定中のバックエンドがfork後も安全か）
+
+    CPUプロセスプール有効時はモデルをプールの子プロセスだけが持つため読み込まない。
+    """
+    return not pool_enabled() and normalize_backend(DETECTOR_BACKEND) in FORK_SAFE_BACKENDS
+
+
+def warm_up(single_thread=False):
+    """モデルを読み込み、ダミー画像で1回推論して初回推論の初期化コストを先に払う
+
+    single_thread: fork前のマスタープロセスで実行する場合に指定（推論スレッドを起動しない）
+    CPUプロセスプール有効時はプールを起動し、子プロセス側で読み込み・ウォームアップする。
+    """
+    if pool_enabled():
+        return start_pool() > 0
+    if not ensure_model():
+        return False
+    img = np.full((320, 320, 3), 114, dtype=np.uint8)
+    with _predict_lock:
+        model.warm_up(img, model_conf, single_thread=single_thread)
+    return True
+
+
+def scene_request(ctx):
+    """シーン判定のリクエスト（同期・非同期の両方で共有）"""
+    # 指示: リストから最も適切な1つを選びJSONで返す
+    messages = [
+        {
+            'role': 'system',
+            'content': 'あなたは写真のシーンを判定する分類器です。出力は必ずJSONのみで返し、説明は不要です。'
+        },
+        {
+            'role': 'user',
+            'content': [
+                { 'type': 'text', 'text': (
+                    '次の候補から最も当てはまるシーンを1つ選び、{"scene":"<label>"} のJSONのみで出力してください。\n'
+                    f"候補: {', '.join(SCENE_LABELS)}"
+                ) },
+                ctx.vision_image_part(VISION_DETAIL)
+            ]
+        }
+    ]
+    return {
+        'model': 'gpt-4o-mini',
+        'messages': messages,
+        'temperature': 0.2,
+        'max_tokens': 20,
+        'response_format': {"type": "json_object"},
+        'timeout': 15,
+        'validate': is_json_with('scene')
+    }
+
+
+def parse_scene(content):
+    """シーン判定の応答からシーン名を取り出す"""
+    payload = json.loads(content)
+    return str(payload.get('scene', '')).strip()
+
+
+@timed('scene')
+def classify_scene_label(image):
     """YOLO未検出時のフォールバック: OpenAI Visionでシーン名（英語ラベル）を1つ返す"""
     try:
         init_openai_client()
         if client is None:
             return ''
 
-        # 候補シーン（英語ラベル）
-        scene_labels = [
-            'mountain','lake','sea','forest','temple','shrine','castle','tower',
-            'city skyline','night view','sunset','waterfall','park','river','snow','desert','island'
-        ]
-
-        # 画像をBase64化
-        with open(image_path, 'rb') as f:
-            b64 = base64.b64encode(f.read()).decode('utf-8')
-
-        # 指示: リストから最も適切な1つを選びJSONで返す
-        messages = [
-            {
-                'role': 'system',
-                'content': 'あなたは写真のシーンを判定する分類器です。出力は必ずJSONのみで返し、説明は不要です。'
-            },
-            {
-                'role': 'user',
-                'content': [
-                    { 'type': 'text', 'text': (
-                        '次の候補から最も当てはまるシーンを1つ選び、{"scene":"<label>"} のJSONのみで出力してください。\n'
-                        f"候補: {', '.join(scene_labels)}"
-                    ) },
-                    { 'type': 'image_url', 'image_url': { 'url': f'data:image/jpeg;base64,{b64}' } }
-                ]
-            }
-        ]
-
-        res = client.chat.completions.create(
-            model='gpt-4o-mini',
-            messages=messages,
-            temperature=0.2,
-            max_tokens=20,
-            response_format={"type": "json_object"},
-            timeout=15
-        )
-
-        import json as _json
-        payload = _json.loads(res.choices[0].message.content)
-        scene = str(payload.get('scene', '')).strip()
-        return scene
+        # 共有コンテキストの縮小済みペイロードを使用（再読み込み・再エンコードしない）
+        ctx = as_image_context(image)
+        if ctx is None:
+            return ''
+
+        # 同じ画像の判定は共有キャッシュから再利用
+        return parse_scene(cached_chat_completion(client, **scene_request(ctx)))
 
     except Exception:
         return ''
 
 
-@lru_cache(maxsize=256)
+@timed('scene')
+async def classify_scene_label_async(image):
+    """classify_scene_labelの非同期版（AsyncOpenAIで応答を待つ）"""
+    try:
+        aclient = get_async_openai_client()
+        if aclient is None:
+            return ''
+
+        ctx = as_image_context(image)
+        if ctx is None:
+            return ''
+
+        return parse_scene(await cached_chat_completion_async(aclient, **scene_request(ctx)))
+
+    except Exception:
+        return ''
+
+
+def resolve_scene_label(ctx, scene_future=None):
+    """シーン名を取得：雰囲気分析のVision応答を優先し、得られなければ個別に判定
+
+    scene_futureは雰囲気分析と並行して解決されるFuture（値はシーン名、なければ空文字）。
+    雰囲気分析の応答にシーン名が含まれない方式（chain）ではNoneを渡し、待たずに個別に判定する。
+    """
+    if scene_future is not None:
+        try:
+            scene = scene_future.result(timeout=SCENE_WAIT_TIMEOUT)
+        except Exception:
+            scene = ''
+        if scene:
+            return scene
+    return classify_scene_label(ctx)
+
+
+def scene_fallback(ctx, scene_future, reason):
+    """YOLO未検出・低信頼度時のフォールバック（シーン名→感情抽出）"""
+    scene_label = resolve_scene_label(ctx, scene_future)
+    if scene_label:
+        emotion_fb = get_emotion(scene_label)
+        if emotion_fb and emotion_fb != 'api error':
+            return emotion_fb, f"scene:{scene_label}"
+    return 'api error', reason
+
+
+def emotion_request(label):
+    """物体ラベル→感情語のリクエスト（同期・非同期の両方で共有）"""
+    prompt = f"物体「{label}」を見たときに、多くの人が直感的に抱く一般的な感情を、日本語の形容詞または形容動詞で一語だけ答えてください（例: 穏やかな, 壮大な, 静かな）。名詞や句は不可。"
+    
+    # 新API形式 + GPT-3.5-turbo使用（ラベルごとの応答はキャッシュ）
+    return {
+        'model': 'gpt-4o-mini',
+        'messages': [{'role':'user','content':prompt}],
+        'max_tokens': 5,  # トークン数削減
+        'temperature': 0.1,  # 温度下げて安定性向上
+        'timeout': 10,  # タイムアウト設定
+        'validate': lambda c: bool(c.strip().strip('「」"'))
+    }
+
+
+@timed('object_emotion')
 def get_emotion(label):
-    """物体ラベルから感情キーワードを取得（API専用版）"""
+    """物体ラベルから感情キーワードを取得（API専用版、応答は全ワーカー共有のキャッシュに保存）"""
     try:
         init_openai_client()
         if client is not None:
-            prompt = f"物体「{label}」を見たときに、多くの人が直感的に抱く一般的な感情を、日本語の形容詞または形容動詞で一語だけ答えてください（例: 穏やかな, 壮大な, 静かな）。名詞や句は不可。"
+            content = cached_chat_completion(client, **emotion_request(label))
             
-            # 新API形式 + GPT-3.5-turbo使用
-            response = client.chat.completions.create(
-                model='gpt-4o-mini',
-                messages=[{'role':'user','content':prompt}],
-                max_tokens=5,  # トークン数削減
-                temperature=0.1,  # 温度下げて安定性向上
-                timeout=10  # タイムアウト設定
-            )
-            
-            emotion = response.choices[0].message.content.strip().strip('「」"')
+            emotion = (content or '').strip().strip('「」"')
             if emotion:
                 return emotion
         
@@ -142,72 +271,185 @@ def get_emotion(label):
         print(f"OpenAI API error: {e}")
         return 'api error'
 
-def process_buttai(image_path):
-    """画像パスを受け取り、物体検出と感情ラベルを返す（最適化版）"""
-    # モデル初期化
-    if model is None:
-        if not load_model():
-            return 'api error', 'no_model'  # モデル読み込み失敗時
 
+@timed('object_emotion')
+async def get_emotion_async(label):
+    """get_emotionの非同期版（AsyncOpenAIで応答を待つ）"""
     try:
-        # 1) 画像読み込み＆最適化
-        img = cv2.imread(image_path)
-        if img is None:
-            return 'api error', 'invalid_image'
-        
-        # より効率的なリサイズ（アスペクト比保持）
-        h, w = img.shape[:2]
-        scale = min(320/w, 320/h)
-        new_w, new_h = int(w*scale), int(h*scale)
-        img_small = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
-
-        # 2) YOLOv8 Nano推論（最適化設定）
-        results = model(
-            img_small, 
-            conf=model_conf,
-            verbose=False,  # ログ抑制
-            save=False,     # 保存しない
-            show=False      # 表示しない
-        )
-        
-        r = results[0]
-        boxes = r.boxes
-        
-        if boxes is None or len(boxes) == 0:
-            # シーン分類フォールバック（名称→感情抽出）
-            scene_label = classify_scene_label(image_path)
-            if scene_label:
-                emotion_fb = get_emotion(scene_label)
-                if emotion_fb and emotion_fb != 'api error':
-                    return emotion_fb, f"scene:{scene_label}"
-            return 'api error', 'no_object'
-
-        # 3) 最も信頼度の高い物体を選択
-        confs = boxes.conf.cpu().numpy()
-        cls_ids = boxes.cls.cpu().numpy().astype(int)
-        
-        idx = confs.argmax()
-        confidence = confs[idx]
-        
-        # 信頼度チェック
-        if confidence < 0.25:  # 閾値を少し下げて検出率向上
-            # シーン分類フォールバック（名称→感情抽出）
-            scene_label = classify_scene_label(image_path)
-            if scene_label:
-                emotion_fb = get_emotion(scene_label)
-                if emotion_fb and emotion_fb != 'api error':
-                    return emotion_fb, f"scene:{scene_label}"
-            return 'api error', 'low_confidence'
-        
-        label = r.names[cls_ids[idx]]
-        print(f"=== 物体検出結果 ===")
-        print(f"選択された物体: {label} (信頼度: {confidence:.3f})")
-        emotion = get_emotion(label)
-        print(f"取得された感情: {emotion}")
-        print("===================")
+        aclient = get_async_openai_client()
+        if aclient is not None:
+            content = await cached_chat_completion_async(aclient, **emotion_request(label))
+            
+            emotion = (content or '').strip().strip('「」"')
+            if emotion:
+                return emotion
         
-        return emotion, label
+        return 'api error'
+                
+    except Exception as e:
+        print(f"OpenAI API error: {e}")
+        return 'api error'
+
+
+def select_label(detections):
+    """検出結果から最も信頼度の高い物体のラベルを選ぶ。戻り値: (label, reason)"""
+    if len(detections.confs) == 0:
+        return None, 'no_object'
+
+    confs = detections.confs
+    cls_ids = detections.cls_ids
+    
+    idx = confs.argmax()
+    confidence = confs[idx]
+    
+    # 信頼度チェック
+    if confidence < 0.25:  # 閾値を少し下げて検出率向上
+        return None, 'low_confidence'
+    
+    label = detections.names[int(cls_ids[idx])]
+    print(f"=== 物体検出結果 ===")
+    print(f"選択された物体: {label} (信頼度: {confidence:.3f})")
+    return label, None
+
+
+@timed('yolo')
+def detect_label(image, in_process=False):
+    """YOLOで最も信頼度の高い物体ラベルを返す（CPU処理のみ、API呼び出しなし）
+
+    戻り値: (label, ctx, reason)。検出できない場合labelはNoneで、reasonに
+    'no_model' / 'invalid_image' / 'no_object' / 'low_confidence' / 'error' が入る。
+    CPUプロセスプール有効時（in_process=Falseの場合）は推論を子プロセスで実行する。
+    """
+    if pool_enabled() and not in_process:
+        ctx = as_image_context(image)
+        if ctx is None or ctx.bgr is None:
+            return None, None, 'invalid_image'
+        try:
+            # 画像は共有メモリ経由で渡し、ラベルだけを受け取る（ctxはこのプロセスのものを返す）
+            def fallback():
+                label, _, reason = detect_label(ctx, in_process=True)
+                return label, reason
+            label, reason = run_in_pool(detect_label_task, ctx.bgr, fallback=fallback)
+            return label, ctx, reason
+        except Exception as e:
+            print(f"Object detection error: {e}")
+            return None, ctx, 'error'
+
+    # 前処理中も予告しておき、同時の要求を1回のバッチ推論にまとめる（予告が無ければ待たずに推論）
+    expecting = batching_enabled()
+    if expecting:
+        _batcher.expect()
+    try:
+        ctx, img_small, reason = prepare_detection(image)
+        if reason is not None:
+            return None, None, reason
+
+        # YOLOv8 Nano推論（バックエンド共通: NMS済みの信頼度・クラスID）
+        expected, expecting = expecting, False
+        detections = run_detection(img_small, expected=expected)
+
+        # 最も信頼度の高い物体を選択
+        label, reason = select_label(detections)
+        return label, ctx, reason
         
     except Exception as e:
         print(f"Object detection error: {e}")
-        return 'api error', 'error' 
\ No newline at end of file
+        return None, None, 'error'
+    finally:
+        if expecting:
+            _batcher.cancel_expect()
+
+
+def prepare_detection(image):
+    """推論前の準備（モデル読み込み・推論用画像の取得）。戻り値: (ctx, img_small, reason)"""
+    # モデル初期化
+    if not ensure_model():
+        return None, None, 'no_model'  # モデル読み込み失敗時
+
+    # 共有コンテキストから推論用画像を取得（アスペクト比保持で320に収める）
+    ctx = as_image_context(image)
+    if ctx is None or ctx.bgr is None:
+        return None, None, 'invalid_image'
+    return ctx, ctx.scaled_bgr(320, 320), None
+
+
+async def detect_label_async(image, executor=None):
+    """detect_labelの非同期版（ASGIモード用、戻り値も同じ）
+
+    マイクロバッチ有効時は前処理だけをexecutorで行い、推論の完了はイベントループ上で待つ。
+    executorのスレッドで推論を待たないため、まとめられる件数がスレッド数で頭打ちにならない。
+    """
+    loop = asyncio.get_running_loop()
+    if pool_enabled() or not batching_enabled():
+        return await loop.run_in_executor(executor, in_request_context(detect_label), image)
+
+    with stage('yolo'):
+        _batcher.expect()
+        expecting = True
+        try:
+            ctx, img_small, reason = await loop.run_in_executor(executor, in_request_context(prepare_detection), image)
+            if reason is not None:
+                return None, None, reason
+
+            expecting = False
+            detections = await asyncio.wrap_future(_batcher.enqueue(img_small, expected=True))
+            label, reason = select_label(detections)
+            return label, ctx, reason
+
+        except Exception as e:
+            print(f"Object detection error: {e}")
+            return None, None, 'error'
+        finally:
+            if expecting:
+                _batcher.cancel_expect()
+
+
+def process_buttai(image, scene_future=None):
+    """画像パスまたはImageContextを受け取り、物体検出と感情ラベルを返す（最適化版）
+
+    scene_future: 未検出時に使うシーン名のFuture（雰囲気分析のVision応答から取得、省略時は個別に判定）
+    """
+    label, ctx, reason = detect_label(image)
+    if label is None:
+        if reason in ('no_object', 'low_confidence'):
+            # シーン分類フォールバック（名称→感情抽出）
+            return scene_fallback(ctx, scene_future, reason)
+        return 'api error', reason
+
+    emotion = get_emotion(label)
+    print(f"取得された感情: {emotion}")
+    print("===================")
+    return emotion, label
+
+
+async def process_buttai_async(image, scene_future=None, executor=None):
+    """process_buttaiの非同期版（ASGIモード用）
+
+    YOLOの前処理・推論はexecutor（省略時は既定のスレッドプール）で実行し（マイクロバッチ有効時は
+    推論の完了をイベントループ上で待つ）、感情語はAsyncOpenAIで取得する。
+    scene_futureはasyncio.Future（雰囲気分析のVision応答から得るシーン名）。
+    """
+    label, ctx, reason = await detect_label_async(image, executor)
+    if label is None:
+        if reason not in ('no_object', 'low_confidence'):
+            return 'api error', reason
+
+        # シーン分類フォールバック（雰囲気分析の応答を待ち、得られなければ個別に判定）
+        scene_label = ''
+        if scene_future is not None:
+            try:
+                scene_label = await asyncio.wait_for(asyncio.shield(scene_future), SCENE_WAIT_TIMEOUT)
+            except Exception:
+                scene_label = ''
+        if not scene_label:
+            scene_label = await classify_scene_label_async(ctx)
+        if scene_label:
+            emotion_fb = await get_emotion_async(scene_label)
+            if emotion_fb and emotion_fb != 'api error':
+                return emotion_fb, f"scene:{scene_label}"
+        return 'api error', reason
+
+    emotion = await get_emotion_async(label)
+    print(f"取得された感情: {emotion}")
+    print("===================")
+    return emotion, label
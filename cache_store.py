@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+
+from metrics import record_cache
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+# キャッシュのバックエンド設定
+# memory: プロセス内LRU（gunicornワーカー間で共有されない）
+# sqlite: ローカルのSQLiteファイル（同一ホストの全ワーカーで共有・再起動後も保持）
+# redis:  Redis互換サーバー（複数インスタンス間でも共有）
+CACHE_BACKEND = os.getenv('EMOTABI_CACHE_BACKEND', 'sqlite').strip().lower()
+CACHE_PATH = os.getenv('EMOTABI_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'emotabi_cache.sqlite3'))
+CACHE_URL = os.getenv('EMOTABI_CACHE_URL', 'redis://localhost:6379/0')
+
+# 期限切れ・上限超過の掃除を何回のsetごとに行うか
+_EVICT_EVERY = 50
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class BaseCache:
+    """TTL・件数上限付きキャッシュの共通部分（値はJSONで保存）"""
+
+    def __init__(self, namespace, max_entries=1000, default_ttl=3600):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self._sets = 0
+        self._stats_lock = threading.Lock()
+
+    def _count(self, hit):
+        record_cache(self.namespace, hit)
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _should_evict(self):
+        with self._stats_lock:
+            self._sets += 1
+            return self._sets % _EVICT_EVERY == 0
+
+    def get(self, key, default=None):
+        try:
+            raw = self._get(key)
+        except Exception as e:
+            print(f"Cache get error ({self.namespace}): {e}")
+            raw = None
+        self._count(raw is not None)
+        if raw is None:
+            return default
+        return json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        try:
+            self._set(key, json.dumps(value, ensure_ascii=False), ttl)
+        except Exception as e:
+            print(f"Cache set error ({self.namespace}): {e}")
+
+    def delete(self, key):
+        try:
+            self._delete(key)
+        except Exception as e:
+            print(f"Cache delete error ({self.namespace}): {e}")
+
+    def stats(self):
+        """このプロセスでのヒット/ミス回数"""
+        total = self.hits + self.misses
+        return {
+            'backend': self.backend,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+class MemoryCache(BaseCache):
+    """プロセス内LRU"""
+    backend = 'memory'
+
+    def __init__(self, namespace, max_entries=1000, default_ttl=3600):
+        super().__init__(namespace, max_entries, default_ttl)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            raw, expires_at = item
+            if expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return raw
+
+    def _set(self, key, raw, ttl):
+        with self._lock:
+            self._data[key] = (raw, time.time() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def _delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class SQLiteCache(BaseCache):
+    """SQLiteファイルによる共有キャッシュ（最終アクセスが古い順に件数上限まで削除）"""
+    backend = 'sqlite'
+
+    def __init__(self, namespace, max_entries=1000, default_ttl=3600, path=CACHE_PATH):
+        super().__init__(namespace, max_entries, default_ttl)
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            ' namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,'
+            ' expires_at REAL NOT NULL, accessed_at REAL NOT NULL,'
+            ' PRIMARY KEY (namespace, key))'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (namespace, accessed_at)')
+
+    def _conn(self):
+        # 接続はスレッドごと・プロセスごと（--preloadのfork後に親の接続を使い回さない）
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _get(self, key):
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute(
+            'SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?',
+            (self.namespace, key)
+        ).fetchone()
+        if row is None:
+            return None
+        if row[1] < now:
+            conn.execute('DELETE FROM cache WHERE namespace = ? AND key = ?', (self.namespace, key))
+            return None
+        conn.execute(
+            'UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?',
+            (now, self.namespace, key)
+        )
+        return row[0]
+
+    def _set(self, key, raw, ttl):
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            'INSERT OR REPLACE INTO cache (namespace, key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+            (self.namespace, key, raw, now + ttl, now)
+        )
+        if self._should_evict():
+            self.evict()
+
+    def _delete(self, key):
+        self._conn().execute('DELETE FROM cache WHERE namespace = ? AND key = ?', (self.namespace, key))
+
+    def evict(self):
+        """期限切れを削除し、件数上限を超えた分を最終アクセスが古い順に削除"""
+        conn = self._conn()
+        conn.execute('DELETE FROM cache WHERE namespace = ? AND expires_at < ?', (self.namespace, time.time()))
+        conn.execute(
+            'DELETE FROM cache WHERE namespace = ? AND key IN ('
+            ' SELECT key FROM cache WHERE namespace = ? ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+            (self.namespace, self.namespace, self.max_entries)
+        )
+
+
+class RedisCache(BaseCache):
+    """Redis互換サーバーによる共有キャッシュ（TTLはサーバー側、件数上限は登録順のsorted setで管理）"""
+    backend = 'redis'
+
+    def __init__(self, namespace, max_entries=1000, default_ttl=3600, url=CACHE_URL):
+        super().__init__(namespace, max_entries, default_ttl)
+        self.client = redis.Redis.from_url(url, socket_timeout=2, socket_connect_timeout=2)
+        self.client.ping()
+        self._prefix = f'emotabi:{namespace}:'
+        self._index = f'emotabi:{namespace}:__index__'
+
+    def _get(self, key):
+        raw = self.client.get(self._prefix + key)
+        return raw.decode('utf-8') if raw is not None else None
+
+    def _set(self, key, raw, ttl):
+        pipe = self.client.pipeline()
+        pipe.set(self._prefix + key, raw, ex=max(int(ttl), 1))
+        pipe.zadd(self._index, {key: time.time()})
+        pipe.execute()
+        if self._should_evict():
+            self.evict()
+
+    def _delete(self, key):
+        pipe = self.client.pipeline()
+        pipe.delete(self._prefix + key)
+        pipe.zrem(self._index, key)
+        pipe.execute()
+
+    def evict(self):
+        """件数上限を超えた分を古い順に削除（期限切れはRedisが自動削除）"""
+        overflow = self.client.zcard(self._index) - self.max_entries
+        if overflow > 0:
+            old_keys = [k.decode('utf-8') for k in self.client.zrange(self._index, 0, overflow - 1)]
+            pipe = self.client.pipeline()
+            for key in old_keys:
+                pipe.delete(self._prefix + key)
+            pipe.zrem(self._index, *old_keys)
+            pipe.execute()
+
+
+def get_cache(namespace, max_entries=1000, default_ttl=3600):
+    """名前空間ごとのキャッシュを取得（バックエンドはEMOTABI_CACHE_BACKEND、失敗時はメモリにフォールバック）"""
+    with _caches_lock:
+        cache = _caches.get(namespace)
+        if cache is not None:
+            return cache
+        try:
+            if CACHE_BACKEND == 'redis' and REDIS_AVAILABLE:
+                cache = RedisCache(namespace, max_entries, default_ttl)
+            elif CACHE_BACKEND == 'sqlite':
+                cache = SQLiteCache(namespace, max_entries, default_ttl)
+            elif CACHE_BACKEND == 'memory':
+                cache = MemoryCache(namespace, max_entries, default_ttl)
+            else:
+                print(f"Unknown or unavailable cache backend '{CACHE_BACKEND}', using memory")
+        except Exception as e:
+            print(f"Cache backend '{CACHE_BACKEND}' initialization error ({namespace}): {e}, using memory")
+        if cache is None:
+            cache = MemoryCache(namespace, max_entries, default_ttl)
+        _caches[namespace] = cache
+        return cache
+
+
+def cache_stats():
+    """全キャッシュのヒット/ミス統計（/health 用）"""
+    with _caches_lock:
+        return {name: cache.stats() for name, cache in _caches.items()}
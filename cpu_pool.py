@@ -0,0 +1,163 @@
+"""CPU処理（色彩分析・物体検出）用のプロセスプール
+
+スレッドで実行するとGILや推論ライブラリのスレッドプールを取り合うため、
+EMOTABI_CPU_PROCESSES > 0 のときは各ワーカーが長寿命のプロセスプールを1つ持ち、
+色彩分析（縮小＋量子化）とYOLO推論をそこで実行する。画像は共有メモリで渡し、
+配列をpickleしない。OpenAI・Google APIの待ちは従来どおりスレッド／asyncioで行う。
+
+プールはforkserver経由で起動する（スレッドを持つワーカープロセスを直接forkしない）。
+"""
+import os
+import sys
+import threading
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+
+CPU_PROCESSES = int(os.getenv('EMOTABI_CPU_PROCESSES', '0'))
+# 1件の処理を待つ最大秒数（子プロセスが固まった場合はプールごと作り直す）
+CPU_TASK_TIMEOUT = float(os.getenv('EMOTABI_CPU_TASK_TIMEOUT', '20'))
+
+# 共有メモリ上の画像（名前・形状・型）
+SharedImage = namedtuple('SharedImage', ['name', 'shape', 'dtype'])
+
+_pool = None
+_pool_pid = None
+_lock = threading.Lock()
+# プール内の子プロセスではTrue（子からさらにプールへ投げない）
+_in_pool_child = False
+
+
+def pool_enabled():
+    """このプロセスからプールへ処理を投げるか"""
+    return CPU_PROCESSES > 0 and not _in_pool_child
+
+
+def in_pool_child():
+    """このプロセスがプールの子プロセスか（1件ずつ処理するため同時の要求は来ない）"""
+    return _in_pool_child
+
+
+def share_image(arr):
+    """配列を共有メモリへコピー。戻り値: (SharedMemory, SharedImage)。使用後に close()・unlink() する"""
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, SharedImage(shm.name, arr.shape, arr.dtype.str)
+
+
+def read_shared_image(handle):
+    """共有メモリの画像を子プロセス側の配列として取り出す（共有メモリはすぐ閉じる）"""
+    shm = shared_memory.SharedMemory(name=handle.name)
+    try:
+        return np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=shm.buf).copy()
+    finally:
+        shm.close()
+
+
+def _init_child(processes):
+    """子プロセスの初期化: 色→感情インデックスとモデルを先に読み込み、推論スレッド数をコア数で分ける"""
+    global _in_pool_child
+    _in_pool_child = True
+    # 所要時間は親プロセス側で記録する（/metricsで二重に数えない）
+    import metrics
+    metrics.disable()
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(max(1, (os.cpu_count() or 1) // max(1, processes)))
+    try:
+        import shikisai
+        shikisai.load_color_index()
+    except Exception as e:
+        print(f"CPU pool: color index preload failed: {e}")
+    try:
+        import buttai
+        buttai.warm_up()
+    except Exception as e:
+        print(f"CPU pool: model preload failed: {e}")
+
+
+def get_process_pool():
+    """ワーカープロセスごとの共有プロセスプール（fork後・プール破損時は作り直す）"""
+    global _pool, _pool_pid
+    if _pool is not None and _pool_pid == os.getpid():
+        return _pool
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            ctx = multiprocessing.get_context('forkserver')
+            ctx.set_forkserver_preload(['cpu_pool', 'shikisai', 'buttai'])
+            _pool = ProcessPoolExecutor(
+                max_workers=CPU_PROCESSES, mp_context=ctx,
+                initializer=_init_child, initargs=(CPU_PROCESSES,)
+            )
+            _pool_pid = os.getpid()
+    return _pool
+
+
+def _ping():
+    return os.getpid()
+
+
+def start_pool():
+    """プロセスを起動して初期化（モデル読み込み）まで済ませる。戻り値: 起動した子プロセス数"""
+    pool = get_process_pool()
+    futures = [pool.submit(_ping) for _ in range(CPU_PROCESSES)]
+    return len({future.result() for future in futures})
+
+
+def _discard_pool(pool, terminate=False):
+    """プールを破棄（terminate: 応答しない子プロセスを強制終了する）"""
+    global _pool
+    with _lock:
+        if _pool is pool:
+            _pool = None
+    if terminate:
+        # shutdownだけでは実行中の子プロセスは終わらないため先に止める
+        for process in list((getattr(pool, '_processes', None) or {}).values()):
+            process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def run_in_pool(task, arr, *args, fallback=None):
+    """画像を共有メモリで渡してプールでtask(handle, *args)を実行
+
+    子プロセスの異常終了などでプールが壊れた場合は作り直し、今回はfallback()をこのプロセスで実行する。
+    CPU_TASK_TIMEOUT秒以内に終わらない場合もプールを作り直し、TimeoutErrorを送出する
+    （待ち時間を使い切っているためfallbackは実行しない）。
+    """
+    # プールの作成に失敗しても共有メモリを残さないよう、プールを先に用意する
+    pool = get_process_pool()
+    shm, handle = share_image(arr)
+    try:
+        return pool.submit(task, handle, *args).result(timeout=CPU_TASK_TIMEOUT)
+    except FutureTimeoutError:
+        print(f"CPU pool task timed out after {CPU_TASK_TIMEOUT}s; recreating the pool")
+        _discard_pool(pool, terminate=True)
+        raise
+    except BrokenProcessPool:
+        print("CPU pool broken; recreating and running in-process")
+        _discard_pool(pool)
+        if fallback is None:
+            raise
+        return fallback()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def analyze_colors_task(handle, num_colors):
+    """子プロセス: 色彩分析"""
+    from image_context import ImageContext
+    from shikisai import analyze_colors
+    return analyze_colors(ImageContext(None, bgr=read_shared_image(handle)), num_colors=num_colors)
+
+
+def detect_label_task(handle):
+    """子プロセス: YOLOで最上位ラベルを検出。戻り値: (label, reason)"""
+    import buttai
+    from image_context import ImageContext
+    label, _, reason = buttai.detect_label(ImageContext(None, bgr=read_shared_image(handle)))
+    return label, reason
@@ -0,0 +1,332 @@
+"""物体検出の推論バックエンド（buttai.pyから使用）
+
+- torch:    ultralytics YOLO（PyTorch、従来どおり）
+- onnx:     エクスポート済みONNXモデルをONNX Runtime（CPU）で実行
+- openvino: 同じONNXモデルをOpenVINO（CPU）で実行
+
+onnx / openvino はtorchを読み込まず、前処理（レターボックス）・NMS・ラベル対応を
+ultralyticsと同じ手順でNumPy/OpenCVで行う。モデルは次のコマンドで作成する:
+
+    python detectors.py --export [--int8] [--imgsz 320] [--dynamic-batch]
+
+--dynamic-batch でバッチ次元を可変にすると、複数画像を1回の推論でまとめて処理できる
+（固定形状のモデルでは1枚ずつ推論する）。
+"""
+import os
+import sys
+import ast
+import glob
+import json
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+BACKENDS = ('torch', 'onnx', 'openvino')
+# fork前（gunicorn --preloadのマスタープロセス）で読み込んでもワーカーで使えるバックエンド
+# ONNX Runtime / OpenVINOの内部スレッドプールはfork後の子プロセスでは使えない
+FORK_SAFE_BACKENDS = ('torch',)
+DETECTOR_BACKEND = os.getenv('BUTTAI_BACKEND', 'torch').strip().lower()
+
+# ONNXモデルのパス（未指定時は "<model_name>.onnx"、BUTTAI_INT8=1 なら "<model_name>-int8.onnx"）
+ONNX_MODEL_PATH = os.getenv('BUTTAI_ONNX_MODEL', '').strip()
+USE_INT8 = os.getenv('BUTTAI_INT8', '').strip().lower() in ('1', 'true', 'yes')
+# 推論スレッド数（0はランタイムの既定値）
+NUM_THREADS = int(os.getenv('BUTTAI_NUM_THREADS', '0'))
+
+# 推論の入力サイズ（torchの推論とONNX/OpenVINOのエクスポートで共通。バックエンドを替えても検出条件を変えない）
+# IoU閾値・最大検出数はultralyticsの推論と同じ既定値
+EXPORT_IMGSZ = 320
+IOU_THRESHOLD = 0.7
+MAX_DETECTIONS = 300
+LETTERBOX_COLOR = 114
+
+# 検出結果（信頼度の高い順）。namesはクラスID→ラベル名
+Detections = namedtuple('Detections', ['confs', 'cls_ids', 'names'])
+
+
+def normalize_backend(value):
+    """バックエンド名を正規化（不明な値は警告してtorch）"""
+    backend = (value or 'torch').strip().lower()
+    if backend not in BACKENDS:
+        print(f"Unknown detector backend '{value}'; using torch")
+        return 'torch'
+    return backend
+
+
+def onnx_model_path(model_name, int8=USE_INT8):
+    """エクスポートしたONNXモデルの既定のパス"""
+    return f"{model_name}-int8.onnx" if int8 else f"{model_name}.onnx"
+
+
+def names_path(model_path):
+    """ラベル名ファイル（エクスポート時に書き出す）のパス"""
+    return f"{os.path.splitext(model_path)[0]}.names.json"
+
+
+def load_names(model_path, metadata=None):
+    """クラスID→ラベル名。ラベル名ファイル、なければONNXのメタデータ（ultralyticsのエクスポート形式）から読む"""
+    path = names_path(model_path)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            return {int(k): v for k, v in json.load(f).items()}
+    if metadata and 'names' in metadata:
+        return {int(k): v for k, v in ast.literal_eval(metadata['names']).items()}
+    raise FileNotFoundError(f"Label names not found for {model_path} (expected {path})")
+
+
+def is_static_dim(dim):
+    return isinstance(dim, int) and dim > 0
+
+
+def input_hw(shape, metadata=None):
+    """NCHWの入力形状から(高さ, 幅)（動的形状の場合はメタデータのimgsz、なければエクスポート既定値）"""
+    h, w = shape[2], shape[3]
+    if is_static_dim(h) and is_static_dim(w):
+        return h, w
+    if metadata and 'imgsz' in metadata:
+        h, w = ast.literal_eval(metadata['imgsz'])
+        return int(h), int(w)
+    return EXPORT_IMGSZ, EXPORT_IMGSZ
+
+
+def letterbox(img, size):
+    """アスペクト比を保って縮小・拡大し、中央に配置して灰色で埋める（ultralyticsと同じ）"""
+    th, tw = size
+    h, w = img.shape[:2]
+    r = min(th / h, tw / w)
+    nh, nw = int(round(h * r)), int(round(w * r))
+    if (nh, nw) != (h, w):
+        img = cv2.resize(img, (nw, nh), interpolation=cv2.INTER_LINEAR)
+    top, left = (th - nh) // 2, (tw - nw) // 2
+    out = np.full((th, tw, 3), LETTERBOX_COLOR, dtype=np.uint8)
+    out[top:top + nh, left:left + nw] = img
+    return out
+
+
+def preprocess(img_bgr, size):
+    """BGR画像 → 1x3xHxWのRGB float32（0〜1）"""
+    img = letterbox(img_bgr, size)
+    blob = img[:, :, ::-1].transpose(2, 0, 1)[None].astype(np.float32) / 255.0
+    return np.ascontiguousarray(blob)
+
+
+def postprocess(output, conf, names, iou=IOU_THRESHOLD, max_det=MAX_DETECTIONS):
+    """YOLOv8の出力(1, 4+クラス数, アンカー数)をクラス別NMSで絞り込む"""
+    pred = output[0].T
+    scores = pred[:, 4:]
+    cls_ids = scores.argmax(axis=1)
+    confs = scores[np.arange(len(scores)), cls_ids]
+    keep = confs > conf
+    if not keep.any():
+        return Detections(np.empty(0, np.float32), np.empty(0, int), names)
+
+    pred, confs, cls_ids = pred[keep], confs[keep], cls_ids[keep]
+    # 中心xywh → 左上xywh
+    boxes = pred[:, :4].copy()
+    boxes[:, :2] -= boxes[:, 2:] / 2
+    idx = cv2.dnn.NMSBoxesBatched(boxes.tolist(), confs.tolist(), cls_ids.tolist(), conf, iou)
+    idx = np.asarray(idx, dtype=int).reshape(-1)[:max_det]
+    return Detections(confs[idx], cls_ids[idx].astype(int), names)
+
+
+class UltralyticsDetector:
+    """ultralytics YOLO（PyTorch）による推論"""
+    backend = 'torch'
+
+    def __init__(self, model_name):
+        from ultralytics import YOLO
+        model_path = f"{model_name}.pt"
+
+        # モデルファイルが存在しない場合の処理
+        if not os.path.exists(model_path):
+            print(f"Model file {model_path} not found. Downloading...")
+            self.model = YOLO(model_name)  # 自動ダウンロード
+        else:
+            self.model = YOLO(model_path)
+
+        # モデル設定の最適化
+        self.model.overrides['verbose'] = False  # ログを削減
+
+    def detect(self, img_bgr, conf):
+        return self.detect_batch([img_bgr], conf)[0]
+
+    def warm_up(self, img_bgr, conf, single_thread=False):
+        """初回推論（層の融合・メモリ確保）を済ませる
+
+        single_thread: fork前に実行する場合に指定。OpenMPのスレッドを起動しないため、
+        fork後の子プロセスは自分のスレッドプールで推論できる。
+        """
+        if not single_thread:
+            self.detect(img_bgr, conf)
+            return
+        import torch
+        threads = torch.get_num_threads()
+        torch.set_num_threads(1)
+        try:
+            self.detect(img_bgr, conf)
+        finally:
+            torch.set_num_threads(threads)
+
+    def detect_batch(self, images, conf):
+        """複数画像を推論（同じ形の画像ごとに1回の推論でまとめる）
+
+        ultralyticsは形の違う画像を正方形に、揃った画像（1枚を含む）は最小の矩形にレターボックスするため、
+        形の違う画像を一緒に渡すと結果が同時に推論した画像によって変わる。形ごとに分ければ1枚ずつと同じになる。
+        """
+        groups = {}
+        for i, img in enumerate(images):
+            groups.setdefault(img.shape, []).append(i)
+        detections = [None] * len(images)
+        for indices in groups.values():
+            results = self.model(
+                [images[i] for i in indices],
+                conf=conf,
+                imgsz=EXPORT_IMGSZ,  # ONNX/OpenVINOと同じ入力サイズ（ultralyticsの既定は640）
+                verbose=False,  # ログ抑制
+                save=False,     # 保存しない
+                show=False      # 表示しない
+            )
+            for i, r in zip(indices, results):
+                detections[i] = self._detections(r)
+        return detections
+
+    @staticmethod
+    def _detections(r):
+        boxes = r.boxes
+        if boxes is None or len(boxes) == 0:
+            return Detections(np.empty(0, np.float32), np.empty(0, int), r.names)
+        return Detections(boxes.conf.cpu().numpy(), boxes.cls.cpu().numpy().astype(int), r.names)
+
+
+class OnnxRuntimeDetector:
+    """ONNX Runtime（CPU）による推論"""
+    backend = 'onnx'
+
+    def __init__(self, model_path):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if NUM_THREADS:
+            options.intra_op_num_threads = NUM_THREADS
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.input_name = model_input.name
+        self.input_size = input_hw(model_input.shape, metadata)
+        self.batch_dynamic = not is_static_dim(model_input.shape[0])
+        self.names = load_names(model_path, metadata)
+
+    def infer(self, blob):
+        return self.session.run(None, {self.input_name: blob})[0]
+
+    def detect(self, img_bgr, conf):
+        return postprocess(self.infer(preprocess(img_bgr, self.input_size)), conf, self.names)
+
+    def warm_up(self, img_bgr, conf, single_thread=False):
+        """初回推論（カーネル選択・メモリ確保）を済ませる"""
+        self.detect(img_bgr, conf)
+
+    def detect_batch(self, images, conf):
+        """複数画像を推論（バッチ次元が可変のモデルなら1回の推論でまとめる）"""
+        if not self.batch_dynamic or len(images) == 1:
+            return [self.detect(img, conf) for img in images]
+        output = self.infer(np.concatenate([preprocess(img, self.input_size) for img in images]))
+        return [postprocess(output[i:i + 1], conf, self.names) for i in range(len(images))]
+
+
+class OpenVinoDetector(OnnxRuntimeDetector):
+    """OpenVINO（CPU）による推論（ONNXモデルをそのまま読み込む）"""
+    backend = 'openvino'
+
+    def __init__(self, model_path):
+        import openvino as ov
+        core = ov.Core()
+        config = {'PERFORMANCE_HINT': 'LATENCY'}
+        if NUM_THREADS:
+            config['INFERENCE_NUM_THREADS'] = NUM_THREADS
+        model = core.read_model(model_path)
+        shape = [d.get_length() if d.is_static else -1 for d in model.input(0).get_partial_shape()]
+        self.input_size = input_hw(shape)
+        self.batch_dynamic = not is_static_dim(shape[0])
+        self.request = core.compile_model(model, 'CPU', config).create_infer_request()
+        self.names = load_names(model_path)
+
+    def infer(self, blob):
+        self.request.infer({0: blob})
+        return self.request.get_output_tensor(0).data.copy()
+
+
+def create_detector(backend, model_name='yolov8n'):
+    """バックエンド名から推論器を作成（ランタイム未導入の場合はImportError）"""
+    backend = normalize_backend(backend)
+    model_path = ONNX_MODEL_PATH or onnx_model_path(model_name)
+    if backend == 'onnx':
+        return OnnxRuntimeDetector(model_path)
+    if backend == 'openvino':
+        return OpenVinoDetector(model_path)
+    return UltralyticsDetector(model_name)
+
+
+def calibration_images(size):
+    """int8量子化の校正用画像（同梱サンプル写真を推論時と同じ320px以内に縮小）"""
+    images = []
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'images', '*.jpg'))):
+        img = cv2.imread(path)
+        if img is not None:
+            h, w = img.shape[:2]
+            r = min(1.0, size / max(h, w))
+            images.append(cv2.resize(img, (int(w * r), int(h * r))) if r < 1.0 else img)
+    return images
+
+
+def quantize_onnx(src_path, dst_path, size):
+    """ONNXモデルをint8に静的量子化（畳み込みのみ、サンプル写真で校正）"""
+    import onnxruntime as ort
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+    input_name = ort.InferenceSession(src_path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+    blobs = [{input_name: preprocess(img, (size, size))} for img in calibration_images(size)]
+
+    class Reader(CalibrationDataReader):
+        def __init__(self):
+            self.blobs = iter(blobs)
+
+        def get_next(self):
+            return next(self.blobs, None)
+
+    # 出力層（座標とクラススコアの結合）は精度低下が大きいためfloatのまま残す
+    quantize_static(
+        src_path, dst_path, Reader(),
+        quant_format=QuantFormat.QDQ,
+        op_types_to_quantize=['Conv'],
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True
+    )
+
+
+def export_onnx(model_name='yolov8n', imgsz=EXPORT_IMGSZ, int8=False, dynamic_batch=False):
+    """ultralyticsでONNXへエクスポートし、ラベル名ファイルを書き出す（int8なら量子化版も作成）"""
+    detector = UltralyticsDetector(model_name)
+    exported = detector.model.export(format='onnx', imgsz=imgsz, dynamic=dynamic_batch, simplify=True)
+    paths = [onnx_model_path(model_name, int8=False)]
+    if os.path.abspath(exported) != os.path.abspath(paths[0]):
+        os.replace(exported, paths[0])
+    if int8:
+        paths.append(onnx_model_path(model_name, int8=True))
+        quantize_onnx(paths[0], paths[1], imgsz)
+
+    names = {int(k): v for k, v in detector.model.names.items()}
+    for path in paths:
+        with open(names_path(path), 'w', encoding='utf-8') as f:
+            json.dump(names, f, ensure_ascii=False)
+        print(f"Exported {path}")
+    return paths
+
+
+if __name__ == '__main__':
+    # ONNXモデルを作成: python detectors.py --export [--int8] [--imgsz 320] [--dynamic-batch]
+    if '--export' in sys.argv:
+        imgsz = int(sys.argv[sys.argv.index('--imgsz') + 1]) if '--imgsz' in sys.argv else EXPORT_IMGSZ
+        export_onnx(imgsz=imgsz, int8='--int8' in sys.argv, dynamic_batch='--dynamic-batch' in sys.argv)
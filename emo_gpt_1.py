@@ -1,59 +1,92 @@
 import json
 import re
 import os
-import base64
-from openai import OpenAI
+from http_clients import get_openai_client, get_async_openai_client
+from image_context import ImageContext, as_image_context, vision_detail
+from llm_cache import cached_chat_completion, cached_chat_completion_async, is_json_with
+from metrics import timed
+from scene_labels import SCENE_LABELS
+
+# 雰囲気分析の呼び出し方式
+# single: 1回のVision呼び出し（JSONスキーマ強制）でキャプション・改善・翻訳・感情を同時に取得
+# chain:  キャプション生成→テキスト処理の2段階（single失敗時のフォールバックにも使用）
+EMO_GPT_MODE = os.getenv('EMO_GPT_MODE', 'single').strip().lower()
+
+# キャプション生成時のVision APIのdetail（low: 512px固定で低トークン / high / auto）
+VISION_DETAIL = vision_detail(os.getenv('EMO_GPT_VISION_DETAIL'), 'low')
+
+# single方式の応答スキーマ（strict: すべてのキー必須・追加キー不可）
+VISION_ANALYSIS_SCHEMA = {
+    "name": "atmosphere_analysis",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "original_caption_en": {"type": "string"},
+            "improved_caption_en": {"type": "string"},
+            "translated_caption_jp": {"type": "string"},
+            "extracted_emotion": {"type": "string"},
+            "scene_label": {"type": "string", "enum": SCENE_LABELS}
+        },
+        "required": [
+            "original_caption_en",
+            "improved_caption_en",
+            "translated_caption_jp",
+            "extracted_emotion",
+            "scene_label"
+        ],
+        "additionalProperties": False
+    }
+}
 
 # OpenAIクライアントを初期化（新API対応）
 client = None
 
 def init_openai_client():
-    """OpenAI API クライアントの遅延初期化"""
+    """OpenAI API クライアントの取得（全モジュール共有・接続プール付き）"""
     global client
-    if client is None:
-        api_key = os.getenv('OPENAI_API_KEY')
-        if api_key:
-            try:
-                client = OpenAI(api_key=api_key)
-            except TypeError as e:
-                print(f"OpenAI client initialization error (emo_gpt): {e}")
-                client = None
-            except Exception as e:
-                print(f"OpenAI client initialization error (emo_gpt): {e}")
-                client = None
+    client = get_openai_client()
 
 
 
 
 
-def generate_caption_with_vision(image_path):
-    """Vision APIを使用してキャプションを生成"""
+def caption_request(ctx):
+    """chain方式のキャプション生成リクエスト（同期・非同期の両方で共有）"""
+    messages = [
+        {"role": "system", "content": "あなたは画像を詳細に説明するシステムです。画像の内容を簡潔に英語で説明してください。"},
+        {"role": "user", "content": [
+            {"type": "text", "text": "この画像の内容を簡潔な英語で説明してください。"},
+            ctx.vision_image_part(VISION_DETAIL)
+        ]}
+    ]
+
+    # 同じ画像のキャプションは共有キャッシュから再利用
+    return {
+        'model': "gpt-4o-mini",
+        'messages': messages,
+        'temperature': 0.3,
+        'max_tokens': 100,
+        'timeout': 15,
+        'validate': lambda c: bool(c.strip())
+    }
+
+
+@timed('caption')
+def generate_caption_with_vision(image):
+    """Vision APIを使用してキャプションを生成（imageはパスまたはImageContext）"""
     try:
         init_openai_client()
         if client is None:
             return None
         
-        # 画像をBase64エンコード
-        with open(image_path, "rb") as image_file:
-            base64_image = base64.b64encode(image_file.read()).decode('utf-8')
-        
-        messages = [
-            {"role": "system", "content": "あなたは画像を詳細に説明するシステムです。画像の内容を簡潔に英語で説明してください。"},
-            {"role": "user", "content": [
-                {"type": "text", "text": "この画像の内容を簡潔な英語で説明してください。"},
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
-            ]}
-        ]
-
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0.3,
-            max_tokens=100,
-            timeout=15
-        )
-
-        caption = response.choices[0].message.content.strip()
+        # 共有コンテキストの縮小済みペイロードを使用（再読み込み・再エンコードしない）
+        ctx = as_image_context(image)
+        if ctx is None:
+            return None
+
+        content = cached_chat_completion(client, **caption_request(ctx))
+        caption = (content or '').strip()
         return caption
 
     except Exception as e:
@@ -61,6 +94,135 @@ def generate_caption_with_vision(image_path):
         return None
 
 
+@timed('caption')
+async def generate_caption_with_vision_async(image):
+    """generate_caption_with_visionの非同期版（AsyncOpenAIで応答を待つ）"""
+    try:
+        aclient = get_async_openai_client()
+        if aclient is None:
+            return None
+
+        ctx = as_image_context(image)
+        if ctx is None:
+            return None
+
+        content = await cached_chat_completion_async(aclient, **caption_request(ctx))
+        return (content or '').strip()
+
+    except Exception as e:
+        print(f"Caption generation error: {e}")
+        return None
+
+
+def text_request(caption_en):
+    """英語キャプション→改善・翻訳・感情語のリクエスト（同期・非同期の両方で共有）"""
+    messages = [
+        {
+            "role": "system",
+            "content": (
+                "あなたは画像キャプションの要約/翻訳の専門家です。次の厳格な制約を守ってください。"
+                "1) 出力はJSONのみ。前後の説明文・コードフェンス・余分な文字は一切含めない。"
+                "2) すべてのキーを必ず含める（空でも文字列で埋める）。"
+                "3) ダブルクォートはASCIIの\\\"のみを使用。スマートクォート不可。"
+                "4) 値は簡潔で1行（改行や装飾を入れない）。"
+                "5) improved_caption_enは自然で簡潔な英語（最大180文字）。"
+                "6) translated_caption_jpは自然な日本語（最大120文字）。"
+                "7) extracted_emotionは日本語の形容詞/形容動詞を一語のみ（例: 穏やかな, 壮大な, 静かな）。名詞や句は不可。"
+            )
+        },
+        {
+            "role": "user",
+            "content": (
+                f"次の英語キャプションを基に、以下3つを作成してください。\n"
+                "1) improved_caption_en: より自然で雰囲気を表す英語（簡潔）\n"
+                "2) translated_caption_jp: 1)の日本語訳\n"
+                "3) extracted_emotion: 2)を読んだときの一般的な感情（日本語の形容詞/形容動詞で一語）\n\n"
+                f"入力:\n{caption_en}\n\n"
+                "必ず次のJSON形式のみで出力:\n"
+                "{\\\"improved_caption_en\\\":\\\"...\\\", \\\"translated_caption_jp\\\":\\\"...\\\", \\\"extracted_emotion\\\":\\\"...\\\"}"
+            )
+        }
+    ]
+    
+    # 同じキャプションの処理結果は共有キャッシュから再利用（JSONとして正しい応答のみ保存）
+    return {
+        'model': 'gpt-4o-mini',
+        'messages': messages,
+        'max_tokens': 240,
+        'temperature': 0.2,  # 安定性向上のため温度を下げる
+        'timeout': 15,
+        'response_format': {"type": "json_object"},  # JSON強制モード
+        'validate': is_json_with('extracted_emotion')
+    }
+
+
+def parse_text_response(content):
+    """テキスト処理の応答をJSONとして解析（寛容版）。解析できなければNone"""
+    try:
+        # 直接JSON解析を試行
+        return json.loads(content)
+    except json.JSONDecodeError:
+        pass
+
+    # JSON部分のみ抽出を試行（複数パターン）
+    json_patterns = [
+        r'\{.*\}',  # 基本パターン
+        r'\{[^}]*"improved_caption_en"[^}]*"extracted_emotion"[^}]*\}',  # より具体的
+        r'\{[^}]*"extracted_emotion"[^}]*\}',  # 最小限
+    ]
+    
+    for pattern in json_patterns:
+        match = re.search(pattern, content, re.DOTALL)
+        if match:
+            try:
+                result = json.loads(match.group())
+                # 必要なキーが存在するかチェック
+                if 'extracted_emotion' in result:
+                    return result
+            except json.JSONDecodeError:
+                continue
+    return None
+
+
+def salvage_emotion(content):
+    """JSONとして解析できない応答から感情語だけを抜き出す（見つからなければ空文字）"""
+    emotion_match = re.search(r'"extracted_emotion":\s*"([^"]+)"', content)
+    if emotion_match:
+        return emotion_match.group(1)
+    japanese_emotion = re.search(r'[ぁ-んァ-ヶー一-龯]{2,6}(?:い|な|的)', content)
+    if japanese_emotion:
+        return japanese_emotion.group()
+    return ''
+
+
+def translation_request(caption_en):
+    """JSON解析失敗時に改善英語・日本語訳だけを取り直すリクエスト"""
+    fallback_messages = [
+        {"role": "system", "content": "あなたは翻訳と言い換えの専門家です。出力は必ずJSONのみ。説明は不要。"},
+        {"role": "user", "content": f'''次の英語文を1)自然な英語に改善、2)日本語に翻訳してください。\n文: {caption_en}\n形式: {{"improved_caption_en":"...","translated_caption_jp":"..."}}'''}
+    ]
+    return {
+        'model': 'gpt-4o-mini',
+        'messages': fallback_messages,
+        'max_tokens': 160,
+        'temperature': 0.2,
+        'response_format': {"type": "json_object"},
+        'timeout': 15,
+        'validate': is_json_with('translated_caption_jp')
+    }
+
+
+def salvaged_text_result(emotion_value, translation=None):
+    """抜き出した感情語と（取得できれば）取り直した翻訳から最低限の結果を作る"""
+    translation = translation or {}
+    return {
+        'extracted_emotion': emotion_value or 'api error',
+        'translated_caption_jp': translation.get('translated_caption_jp', '—'),
+        'improved_caption_en': translation.get('improved_caption_en', '')
+    }
+
+
+@timed('text')
 def process_text_with_gpt(caption_en):
     """英語キャプションを改善→日本語翻訳→感情語抽出"""
     try:
@@ -68,188 +230,290 @@ def process_text_with_gpt(caption_en):
         if client is None:
             return None
         
-        messages = [
-            {
-                "role": "system",
-                "content": (
-                    "あなたは画像キャプションの要約/翻訳の専門家です。次の厳格な制約を守ってください。"
-                    "1) 出力はJSONのみ。前後の説明文・コードフェンス・余分な文字は一切含めない。"
-                    "2) すべてのキーを必ず含める（空でも文字列で埋める）。"
-                    "3) ダブルクォートはASCIIの\\\"のみを使用。スマートクォート不可。"
-                    "4) 値は簡潔で1行（改行や装飾を入れない）。"
-                    "5) improved_caption_enは自然で簡潔な英語（最大180文字）。"
-                    "6) translated_caption_jpは自然な日本語（最大120文字）。"
-                    "7) extracted_emotionは日本語の形容詞/形容動詞を一語のみ（例: 穏やかな, 壮大な, 静かな）。名詞や句は不可。"
-                )
-            },
-            {
-                "role": "user",
-                "content": (
-                    f"次の英語キャプションを基に、以下3つを作成してください。\n"
-                    "1) improved_caption_en: より自然で雰囲気を表す英語（簡潔）\n"
-                    "2) translated_caption_jp: 1)の日本語訳\n"
-                    "3) extracted_emotion: 2)を読んだときの一般的な感情（日本語の形容詞/形容動詞で一語）\n\n"
-                    f"入力:\n{caption_en}\n\n"
-                    "必ず次のJSON形式のみで出力:\n"
-                    "{\\\"improved_caption_en\\\":\\\"...\\\", \\\"translated_caption_jp\\\":\\\"...\\\", \\\"extracted_emotion\\\":\\\"...\\\"}"
-                )
-            }
-        ]
-        
-        response = client.chat.completions.create(
-            model='gpt-4o-mini',
-            messages=messages,
-            max_tokens=240,
-            temperature=0.2,  # 安定性向上のため温度を下げる
-            timeout=15,
-            response_format={"type": "json_object"}  # JSON強制モード
-        )
-        
-        content = response.choices[0].message.content.strip()
-        
-        # JSON パース（寛容版）
+        content = (cached_chat_completion(client, **text_request(caption_en)) or '').strip()
+        result = parse_text_response(content)
+        if result is not None:
+            return result
+
+        # JSON解析が完全に失敗した場合、感情語だけ抽出し、改善英語/日本語訳を別リクエストで取得
+        print(f"JSON parsing failed, attempting fallback extraction: {content[:200]}...")
+        emotion_value = salvage_emotion(content)
         try:
-            # 直接JSON解析を試行
-            result = json.loads(content)
+            init_openai_client()
+            if client is not None:
+                fb_content = cached_chat_completion(client, **translation_request(caption_en))
+                return salvaged_text_result(emotion_value, json.loads(fb_content))
+        except Exception:
+            pass
+
+        # 最低限の構造で返却
+        return salvaged_text_result(emotion_value)
+
+    except Exception as e:
+        print(f"Text processing error: {e}")
+        return None
+
+
+@timed('text')
+async def process_text_with_gpt_async(caption_en):
+    """process_text_with_gptの非同期版（AsyncOpenAIで応答を待つ）"""
+    try:
+        aclient = get_async_openai_client()
+        if aclient is None:
+            return None
+
+        content = (await cached_chat_completion_async(aclient, **text_request(caption_en)) or '').strip()
+        result = parse_text_response(content)
+        if result is not None:
             return result
-        except json.JSONDecodeError:
-            # JSON部分のみ抽出を試行（複数パターン）
-            json_patterns = [
-                r'\{.*\}',  # 基本パターン
-                r'\{[^}]*"improved_caption_en"[^}]*"extracted_emotion"[^}]*\}',  # より具体的
-                r'\{[^}]*"extracted_emotion"[^}]*\}',  # 最小限
-            ]
-            
-            for pattern in json_patterns:
-                match = re.search(pattern, content, re.DOTALL)
-                if match:
-                    try:
-                        result = json.loads(match.group())
-                        # 必要なキーが存在するかチェック
-                        if 'extracted_emotion' in result:
-                            return result
-                    except json.JSONDecodeError:
-                        continue
-            
-            # JSON解析が完全に失敗した場合、フォールバック処理
-            print(f"JSON parsing failed, attempting fallback extraction: {content[:200]}...")
-            
-            # 1) まず感情語だけ抽出
-            emotion_value = ''
-            emotion_match = re.search(r'"extracted_emotion":\s*"([^"]+)"', content)
-            if emotion_match:
-                emotion_value = emotion_match.group(1)
-            else:
-                japanese_emotion = re.search(r'[ぁ-んァ-ヶー一-龯]{2,6}(?:い|な|的)', content)
-                if japanese_emotion:
-                    emotion_value = japanese_emotion.group()
 
-            # 2) 改善英語/日本語訳を別リクエストで取得
-            try:
-                init_openai_client()
-                if client is not None:
-                    fallback_messages = [
-                        {"role": "system", "content": "あなたは翻訳と言い換えの専門家です。出力は必ずJSONのみ。説明は不要。"},
-                        {"role": "user", "content": f'''次の英語文を1)自然な英語に改善、2)日本語に翻訳してください。\n文: {caption_en}\n形式: {{"improved_caption_en":"...","translated_caption_jp":"..."}}'''}
-                    ]
-                    fb = client.chat.completions.create(
-                        model='gpt-4o-mini',
-                        messages=fallback_messages,
-                        max_tokens=160,
-                        temperature=0.2,
-                        response_format={"type": "json_object"},
-                        timeout=15
-                    )
-                    import json as _json
-                    fb_payload = _json.loads(fb.choices[0].message.content)
-                    return {
-                        'extracted_emotion': emotion_value or 'api error',
-                        'translated_caption_jp': fb_payload.get('translated_caption_jp', '—'),
-                        'improved_caption_en': fb_payload.get('improved_caption_en', '')
-                    }
-            except Exception:
-                pass
-
-            # 3) 最低限の構造で返却
-            return {
-                'extracted_emotion': emotion_value or 'api error',
-                'translated_caption_jp': '—',
-                'improved_caption_en': ''
-            }
+        print(f"JSON parsing failed, attempting fallback extraction: {content[:200]}...")
+        emotion_value = salvage_emotion(content)
+        try:
+            fb_content = await cached_chat_completion_async(aclient, **translation_request(caption_en))
+            return salvaged_text_result(emotion_value, json.loads(fb_content))
+        except Exception:
+            return salvaged_text_result(emotion_value)
 
     except Exception as e:
         print(f"Text processing error: {e}")
         return None
 
 
-def process_emo_with_api(image_path):
-    """新しいワークフロー：キャプション生成→改善→翻訳→感情抽出"""
+def vision_analysis_request(ctx):
+    """single方式のリクエスト（同期・非同期の両方で共有）"""
+    messages = [
+        {
+            "role": "system",
+            "content": (
+                "あなたは画像キャプションの生成・要約・翻訳の専門家です。次の制約を守ってください。"
+                "1) 値は簡潔で1行（改行や装飾を入れない）。"
+                "2) original_caption_enは画像の内容を簡潔に説明する英語。"
+                "3) improved_caption_enは1)をより自然で雰囲気を表す英語にしたもの（最大180文字）。"
+                "4) translated_caption_jpは3)の自然な日本語訳（最大120文字）。"
+                "5) extracted_emotionは4)を読んだときの一般的な感情を日本語の形容詞/形容動詞で一語のみ（例: 穏やかな, 壮大な, 静かな）。名詞や句は不可。"
+                "6) scene_labelは候補の中から画像に最も当てはまるシーンを1つ。"
+            )
+        },
+        {"role": "user", "content": [
+            {"type": "text", "text": "この画像について、指定のJSON形式で5つの項目を作成してください。"},
+            ctx.vision_image_part(VISION_DETAIL)
+        ]}
+    ]
+    # 同じ画像の結果は共有キャッシュから再利用（スキーマを満たす応答のみ保存）
+    return {
+        'model': "gpt-4o-mini",
+        'messages': messages,
+        'temperature': 0.2,
+        'max_tokens': 340,
+        'timeout': 20,
+        'response_format': {"type": "json_schema", "json_schema": VISION_ANALYSIS_SCHEMA},
+        'validate': is_json_with(*VISION_ANALYSIS_SCHEMA["schema"]["required"])
+    }
+
+
+def parse_vision_analysis(content):
+    """single方式の応答をdictに変換（感情語が無ければNone）"""
+    result = json.loads((content or '').strip())
+    if not isinstance(result, dict) or not str(result.get('extracted_emotion', '')).strip():
+        return None
+    return result
+
+
+@timed('vision')
+def analyze_image_with_vision(image):
+    """1回のVision呼び出しでキャプション生成→改善→翻訳→感情抽出をまとめて行う
+
+    応答はJSONスキーマで強制するため、chain方式のようなJSON修復・追加呼び出しは行わない。
+    失敗時はNoneを返す（呼び出し元でchain方式にフォールバック）。
+    """
     try:
-        # Step 1: Vision APIでキャプション生成
-        caption_en = generate_caption_with_vision(image_path)
-        if not caption_en or caption_en.strip() == '':
-            return {'emotion_label': 'api error', 'caption': 'Caption generation failed'}
-        
-        # Step 2: キャプション改善→翻訳→感情抽出
-        result = process_text_with_gpt(caption_en)
-        if not result or not isinstance(result, dict):
-            return {'emotion_label': 'api error', 'caption': 'Text processing failed'}
-        
-        # 結果をemo_gpt形式に変換（より寛容に）
-        emotion_label = result.get('extracted_emotion', '').strip()
-        if not emotion_label or emotion_label == 'api error':
-            emotion_label = 'api error'
-        
-        caption = result.get('translated_caption_jp', '').strip()
-        if not caption:
-            caption = 'キャプション生成に失敗しました'
-        
-        # キャプション情報をターミナルに表示
-        print("=== キャプション生成結果 ===")
-        print(f"元の英語: {caption_en}")
-        print(f"改善版英語: {result.get('improved_caption_en', '')}")
-        print(f"日本語訳: {caption}")
-        print(f"抽出感情: {emotion_label}")
-        print("==========================")
-        
-        return {
-            'emotion_label': emotion_label,
-            'caption': caption,
-            'improved_caption_en': result.get('improved_caption_en', ''),
-            'original_caption_en': caption_en
-        }
+        init_openai_client()
+        if client is None:
+            return None
+
+        ctx = as_image_context(image)
+        if ctx is None:
+            return None
+
+        content = cached_chat_completion(client, **vision_analysis_request(ctx))
+        return parse_vision_analysis(content)
 
     except Exception as e:
-        print(f"OpenAI API error: {e}")
-        return {'emotion_label': 'api error', 'caption': f'API error: {str(e)}'}
+        print(f"Single-call vision analysis error: {e}")
+        return None
 
 
+@timed('vision')
+async def analyze_image_with_vision_async(image):
+    """analyze_image_with_visionの非同期版（AsyncOpenAIで応答を待つ）"""
+    try:
+        aclient = get_async_openai_client()
+        if aclient is None:
+            return None
 
-# 画像パスを受け取り、感情分析を行う（APIエラー版）
-def process_emo(image_path):
-    """画像パスを受け取り、感情分析を行う（APIエラー版）"""
+        ctx = as_image_context(image)
+        if ctx is None:
+            return None
+
+        content = await cached_chat_completion_async(aclient, **vision_analysis_request(ctx))
+        return parse_vision_analysis(content)
+
+    except Exception as e:
+        print(f"Single-call vision analysis error: {e}")
+        return None
+
+
+def build_emo_result(caption_en, result):
+    """テキスト処理結果をemo_gpt形式（app.analyzeが参照するキー）に変換"""
+    # 結果をemo_gpt形式に変換（より寛容に）
+    emotion_label = result.get('extracted_emotion', '').strip()
+    if not emotion_label or emotion_label == 'api error':
+        emotion_label = 'api error'
+    
+    caption = result.get('translated_caption_jp', '').strip()
+    if not caption:
+        caption = 'キャプション生成に失敗しました'
     
-    # 画像ファイル存在チェック
-    if not os.path.exists(image_path):
-        return {'emotion_label': 'api error', 'caption': f'Image file not found: {image_path}'}
+    # キャプション情報をターミナルに表示
+    print("=== キャプション生成結果 ===")
+    print(f"元の英語: {caption_en}")
+    print(f"改善版英語: {result.get('improved_caption_en', '')}")
+    print(f"日本語訳: {caption}")
+    print(f"抽出感情: {emotion_label}")
+    print("==========================")
+    
+    return {
+        'emotion_label': emotion_label,
+        'caption': caption,
+        'improved_caption_en': result.get('improved_caption_en', ''),
+        'original_caption_en': caption_en,
+        # single方式のみ（chain方式では空。物体検出のシーンフォールバックが参照）
+        'scene_label': result.get('scene_label', '')
+    }
+
+
+def process_emo_chain(image):
+    """chain方式：キャプション生成→改善→翻訳→感情抽出"""
+    # Step 1: Vision APIでキャプション生成
+    caption_en = generate_caption_with_vision(image)
+    if not caption_en or caption_en.strip() == '':
+        return {'emotion_label': 'api error', 'caption': 'Caption generation failed'}
+    
+    # Step 2: キャプション改善→翻訳→感情抽出
+    result = process_text_with_gpt(caption_en)
+    if not result or not isinstance(result, dict):
+        return {'emotion_label': 'api error', 'caption': 'Text processing failed'}
+    
+    return build_emo_result(caption_en, result)
+
+
+async def process_emo_chain_async(image):
+    """process_emo_chainの非同期版（AsyncOpenAIで応答を待つ）"""
+    caption_en = await generate_caption_with_vision_async(image)
+    if not caption_en or caption_en.strip() == '':
+        return {'emotion_label': 'api error', 'caption': 'Caption generation failed'}
+    
+    result = await process_text_with_gpt_async(caption_en)
+    if not result or not isinstance(result, dict):
+        return {'emotion_label': 'api error', 'caption': 'Text processing failed'}
+    
+    return build_emo_result(caption_en, result)
+
+
+def provides_scene_label():
+    """雰囲気分析の応答にシーン名が含まれるか（single方式のみ。物体検出側が待つかどうかの判断に使う）"""
+    return EMO_GPT_MODE == 'single'
+
+
+def process_emo_with_api(image, on_scene=None):
+    """雰囲気分析：single方式（1回のVision呼び出し）、失敗時はchain方式（キャプション生成→改善→翻訳→感情抽出）
+
+    on_scene: single方式のVision応答が得られた時点でシーン名（失敗時は空文字）を渡すコールバック。
+    chain方式へのフォールバックを待たずに、物体検出側が個別のシーン判定に切り替えられる。
+    """
+    try:
+        if EMO_GPT_MODE == 'single':
+            result = analyze_image_with_vision(image)
+            if on_scene:
+                on_scene(result.get('scene_label', '') if result else '')
+            if result:
+                return build_emo_result(result.get('original_caption_en', '').strip(), result)
+            print("Single-call vision analysis failed, falling back to chained calls")
+
+        return process_emo_chain(image)
+
+    except Exception as e:
+        print(f"OpenAI API error: {e}")
+        return {'emotion_label': 'api error', 'caption': f'API error: {str(e)}'}
+
+
+def precheck_emo(image):
+    """API呼び出し前のチェック（問題があればエラー結果、なければNone）"""
+    # 画像ファイル存在チェック（共有コンテキストの場合は不要）
+    if not isinstance(image, ImageContext) and not os.path.exists(image):
+        return {'emotion_label': 'api error', 'caption': f'Image file not found: {image}'}
     
     # OpenAI APIキーチェック
     api_key = os.getenv('OPENAI_API_KEY')
     if not api_key or not api_key.strip():
         return {'emotion_label': 'api error', 'caption': 'OpenAI API key is not configured'}
+    return None
+
+
+def check_emo_result(result):
+    """API結果を検証（有効な感情語が無い場合はエラー結果に置き換える）"""
+    if result and isinstance(result, dict) and 'emotion_label' in result:
+        # emotion_labelが有効な値かチェック
+        emotion = result.get('emotion_label', '').strip()
+        if emotion and emotion != 'api error':
+            return result
+        else:
+            return {'emotion_label': 'api error', 'caption': 'No valid emotion extracted'}
+    else:
+        return {'emotion_label': 'api error', 'caption': 'OpenAI API returned invalid result'}
+
+
+# 画像パスまたはImageContextを受け取り、感情分析を行う（APIエラー版）
+def process_emo(image, on_scene=None):
+    """画像パスまたはImageContextを受け取り、感情分析を行う（APIエラー版）
+
+    on_scene: process_emo_with_apiを参照
+    """
+    error = precheck_emo(image)
+    if error is not None:
+        return error
     
     # OpenAI API実行
     try:
-        result = process_emo_with_api(image_path)
-        if result and isinstance(result, dict) and 'emotion_label' in result:
-            # emotion_labelが有効な値かチェック
-            emotion = result.get('emotion_label', '').strip()
-            if emotion and emotion != 'api error':
-                return result
+        return check_emo_result(process_emo_with_api(image, on_scene))
+    except Exception as e:
+        print(f"OpenAI API processing failed: {e}")
+        return {'emotion_label': 'api error', 'caption': f'Emotion analysis failed: {str(e)}'}
+
+
+async def process_emo_async(image, on_scene=None):
+    """process_emoの非同期版（ASGIモード用）
+
+    single方式・chain方式（およびsingle失敗時のフォールバック）ともAsyncOpenAIで応答を待つ。
+    """
+    error = precheck_emo(image)
+    if error is not None:
+        return error
+
+    try:
+        result = None
+        if EMO_GPT_MODE == 'single':
+            vision = await analyze_image_with_vision_async(image)
+            if on_scene:
+                on_scene(vision.get('scene_label', '') if vision else '')
+            if vision:
+                result = build_emo_result(vision.get('original_caption_en', '').strip(), vision)
             else:
-                return {'emotion_label': 'api error', 'caption': 'No valid emotion extracted'}
-        else:
-            return {'emotion_label': 'api error', 'caption': 'OpenAI API returned invalid result'}
+                print("Single-call vision analysis failed, falling back to chained calls")
+        if result is None:
+            result = await process_emo_chain_async(image)
+        return check_emo_result(result)
     except Exception as e:
         print(f"OpenAI API processing failed: {e}")
-        return {'emotion_label': 'api error', 'caption': f'Emotion analysis failed: {str(e)}'} 
\ No newline at end of file
+        return {'emotion_label': 'api error', 'caption': f'Emotion analysis failed: {str(e)}'}
@@ -0,0 +1,7 @@
+# gunicornの設定（起動オプションはstart.sh、ここにはサーバーフックだけを置く）
+
+
+def child_exit(server, worker):
+    # 終了したワーカーの処理中リクエスト数を /metrics の集計から外す
+    import metrics
+    metrics.mark_process_dead(worker.pid)
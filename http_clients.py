@@ -0,0 +1,159 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+    HTTPX_AVAILABLE = True
+except ImportError:
+    HTTPX_AVAILABLE = False
+
+try:
+    import h2  # noqa: F401  HTTP/2はh2パッケージがある場合のみ
+    H2_AVAILABLE = True
+except ImportError:
+    H2_AVAILABLE = False
+
+# 外部API（Google / OpenAI）への接続設定
+# ワーカーごとに1つの接続プールを持ち、ホストごとにKeep-Aliveで接続を再利用する
+HTTP_POOL_CONNECTIONS = int(os.getenv('EMOTABI_HTTP_POOL_CONNECTIONS', '4'))   # プールするホスト数
+HTTP_POOL_MAXSIZE = int(os.getenv('EMOTABI_HTTP_POOL_MAXSIZE', '16'))          # ホストごとの最大接続数
+HTTP_CONNECT_TIMEOUT = float(os.getenv('EMOTABI_HTTP_CONNECT_TIMEOUT', '3'))
+HTTP_READ_TIMEOUT = float(os.getenv('EMOTABI_HTTP_READ_TIMEOUT', '10'))
+HTTP2_ENABLED = os.getenv('EMOTABI_HTTP2', '').strip().lower() in ('1', 'true', 'yes')
+
+# requests.get(..., timeout=HTTP_TIMEOUT) 用
+HTTP_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+_lock = threading.Lock()
+_session = None
+_session_pid = None
+_openai_client = None
+_openai_pid = None
+_async_http_client = None
+_async_http_pid = None
+_async_openai_client = None
+_async_openai_pid = None
+
+
+def get_http_session():
+    """Google API呼び出し用の共有requests.Session（fork後はワーカーごとに作り直す）"""
+    global _session, _session_pid
+    if _session is not None and _session_pid == os.getpid():
+        return _session
+    with _lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_POOL_CONNECTIONS,
+                pool_maxsize=HTTP_POOL_MAXSIZE,
+                pool_block=False
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+            _session_pid = os.getpid()
+    return _session
+
+
+def _httpx_options():
+    """httpxクライアント共通の設定（Keep-Aliveプール・タイムアウト・任意でHTTP/2）"""
+    http2 = HTTP2_ENABLED and H2_AVAILABLE
+    if HTTP2_ENABLED and not H2_AVAILABLE:
+        print("EMOTABI_HTTP2 is set but 'h2' is not installed; using HTTP/1.1")
+    return {
+        'http2': http2,
+        'limits': httpx.Limits(
+            max_connections=HTTP_POOL_MAXSIZE,
+            max_keepalive_connections=HTTP_POOL_MAXSIZE
+        ),
+        'timeout': httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+    }
+
+
+def _build_openai_http_client():
+    """OpenAIクライアント用のhttpx.Client（Keep-Aliveプール・任意でHTTP/2）"""
+    if not HTTPX_AVAILABLE:
+        return None
+    return httpx.Client(**_httpx_options())
+
+
+def openai_base_url():
+    """OpenAI APIの接続先（負荷試験ではスタブサーバーの http://host:port/v1 を指定。未設定時は公式API）"""
+    return os.getenv('OPENAI_BASE_URL') or None
+
+
+def get_openai_client():
+    """全モジュール共有のOpenAIクライアント（APIキー未設定・初期化失敗時はNone）"""
+    global _openai_client, _openai_pid
+    if _openai_client is not None and _openai_pid == os.getpid():
+        return _openai_client
+    api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key:
+        return None
+    with _lock:
+        if _openai_client is None or _openai_pid != os.getpid():
+            try:
+                from openai import OpenAI
+                http_client = _build_openai_http_client()
+                if http_client is not None:
+                    _openai_client = OpenAI(api_key=api_key, base_url=openai_base_url(), http_client=http_client)
+                else:
+                    _openai_client = OpenAI(api_key=api_key, base_url=openai_base_url())
+                _openai_pid = os.getpid()
+            except Exception as e:
+                print(f"OpenAI client initialization error: {e}")
+                _openai_client = None
+    return _openai_client
+
+
+def get_async_http_client():
+    """ASGIモードでGoogle API呼び出しに使う共有httpx.AsyncClient（ワーカーごと）"""
+    global _async_http_client, _async_http_pid
+    if _async_http_client is not None and _async_http_pid == os.getpid():
+        return _async_http_client
+    if not HTTPX_AVAILABLE:
+        raise RuntimeError("httpx is required for the async server mode")
+    with _lock:
+        if _async_http_client is None or _async_http_pid != os.getpid():
+            _async_http_client = httpx.AsyncClient(**_httpx_options())
+            _async_http_pid = os.getpid()
+    return _async_http_client
+
+
+def get_async_openai_client():
+    """ASGIモード用の共有AsyncOpenAIクライアント（APIキー未設定・初期化失敗時はNone）"""
+    global _async_openai_client, _async_openai_pid
+    if _async_openai_client is not None and _async_openai_pid == os.getpid():
+        return _async_openai_client
+    api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key:
+        return None
+    with _lock:
+        if _async_openai_client is None or _async_openai_pid != os.getpid():
+            try:
+                from openai import AsyncOpenAI
+                if HTTPX_AVAILABLE:
+                    _async_openai_client = AsyncOpenAI(
+                        api_key=api_key, base_url=openai_base_url(), http_client=httpx.AsyncClient(**_httpx_options())
+                    )
+                else:
+                    _async_openai_client = AsyncOpenAI(api_key=api_key, base_url=openai_base_url())
+                _async_openai_pid = os.getpid()
+            except Exception as e:
+                print(f"Async OpenAI client initialization error: {e}")
+                _async_openai_client = None
+    return _async_openai_client
+
+
+async def close_async_clients():
+    """ASGIワーカー終了時に非同期クライアントの接続を閉じる"""
+    global _async_http_client, _async_openai_client
+    if _async_http_client is not None and _async_http_pid == os.getpid():
+        await _async_http_client.aclose()
+    if _async_openai_client is not None and _async_openai_pid == os.getpid():
+        await _async_openai_client.close()
+    _async_http_client = None
+    _async_openai_client = None
@@ -0,0 +1,188 @@
+import io
+import os
+import base64
+import threading
+
+import numpy as np
+
+try:
+    import cv2
+    CV2_AVAILABLE = True
+except ImportError:
+    CV2_AVAILABLE = False
+
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+# 分析用の作業画像の最大サイズ（従来のoptimize_imageと同じ）
+WORKING_MAX_SIZE = (320, 320)
+JPEG_QUALITY = 85
+
+# Vision APIへ送る画像の上限（長辺ピクセル・JPEG品質）
+# detail=lowでAPI側が512pxに縮小するため、それ以上は送っても転送量が増えるだけ
+VISION_MAX_EDGE = int(os.getenv('EMOTABI_VISION_MAX_EDGE', '512'))
+VISION_JPEG_QUALITY = int(os.getenv('EMOTABI_VISION_JPEG_QUALITY', '80'))
+VISION_DETAILS = ('low', 'high', 'auto')
+
+
+def vision_detail(value, default='low'):
+    """環境変数のdetail指定を検証（不正値は既定値）"""
+    value = (value or '').strip().lower()
+    return value if value in VISION_DETAILS else default
+
+
+def fit_within(w, h, max_w, max_h):
+    """(w, h)をmax_w×max_hに収める縮小後のサイズ（収まる場合はNone）"""
+    if w <= max_w and h <= max_h:
+        return None
+    scale = min(max_w/w, max_h/h)
+    return max(1, int(w*scale)), max(1, int(h*scale))
+
+
+class ImageContext:
+    """アップロード画像を1回だけデコードし、各分析モジュールで共有するコンテキスト
+
+    bgr/rgb配列・縮小版・Vision API用JPEG/Base64ペイロードを遅延生成してキャッシュする。
+    shikisai / buttai / emo_gpt_1 はファイルを読み直さずこのオブジェクトを参照する。
+    """
+
+    def __init__(self, data, bgr=None, resized=False, source=None, vision_bgr=None, vision_resized=False):
+        self.data = data          # 元のアップロードバイト列
+        self.bgr = bgr            # 作業画像（最大WORKING_MAX_SIZE、cv2が無い場合はNone）
+        self.resized = resized    # 作業画像が元画像から縮小されたか
+        self.source = source      # 元ファイルパス（ログ用、メモリ入力時はNone）
+        self.vision_bgr = vision_bgr            # Vision API用画像（長辺VISION_MAX_EDGE以下）
+        self.vision_resized = vision_resized    # Vision API用画像が元画像から縮小されたか
+        self._cache = {}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_bytes(cls, data, max_size=WORKING_MAX_SIZE, source=None):
+        """バイト列からデコード＆縮小（デコード不能な場合はValueError）"""
+        if not data:
+            raise ValueError('empty image data')
+        if not CV2_AVAILABLE:
+            # cv2が無い環境ではバイト列のみ保持（Vision APIへの送信は可能）
+            return cls(data, source=source)
+
+        buf = np.frombuffer(data, dtype=np.uint8)
+        img = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError('cannot decode image')
+
+        # 作業画像・Vision API用画像とも元のデコード結果から1回ずつ縮小（アスペクト比保持）
+        h, w = img.shape[:2]
+        vision_size = fit_within(w, h, VISION_MAX_EDGE, VISION_MAX_EDGE)
+        vision = img if vision_size is None else cv2.resize(img, vision_size, interpolation=cv2.INTER_AREA)
+        work_size = fit_within(w, h, max_size[0], max_size[1])
+        work = img if work_size is None else cv2.resize(img, work_size, interpolation=cv2.INTER_AREA)
+        return cls(data, bgr=work, resized=work_size is not None, source=source,
+                   vision_bgr=vision, vision_resized=vision_size is not None)
+
+    @classmethod
+    def from_path(cls, path, max_size=WORKING_MAX_SIZE):
+        """ファイルから読み込み（後方互換用。以降はファイルにアクセスしない）"""
+        with open(path, 'rb') as f:
+            data = f.read()
+        return cls.from_bytes(data, max_size=max_size, source=path)
+
+    @classmethod
+    def from_vision_jpeg(cls, jpeg, source=None):
+        """Vision API用JPEGだけを持つコンテキスト（別プロセスで作成済みのペイロードを再デコードしない）"""
+        ctx = cls(jpeg, source=source)
+        ctx._cache['jpeg'] = jpeg
+        return ctx
+
+    def _cached(self, key, factory):
+        """派生データを1回だけ生成（並列スレッドから安全に呼べる）"""
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = factory()
+            return self._cache[key]
+
+    @property
+    def rgb(self):
+        """作業画像のRGB版"""
+        if self.bgr is None:
+            return None
+        return self._cached('rgb', lambda: cv2.cvtColor(self.bgr, cv2.COLOR_BGR2RGB))
+
+    def resized_rgb(self, size):
+        """RGB作業画像を指定サイズ(w, h)に縮小したもの（色彩分析のサムネイル用）"""
+        if self.bgr is None:
+            return None
+        return self._cached(
+            ('rgb', size),
+            lambda: cv2.resize(self.rgb, size, interpolation=cv2.INTER_AREA)
+        )
+
+    def scaled_bgr(self, max_w, max_h):
+        """BGR作業画像をmax_w×max_hに収まる倍率で拡大縮小したもの（物体検出用）"""
+        if self.bgr is None:
+            return None
+
+        def build():
+            h, w = self.bgr.shape[:2]
+            scale = min(max_w/w, max_h/h)
+            new_w, new_h = int(w*scale), int(h*scale)
+            if (new_w, new_h) == (w, h):
+                return self.bgr
+            return cv2.resize(self.bgr, (new_w, new_h), interpolation=cv2.INTER_AREA)
+
+        return self._cached(('bgr', max_w, max_h), build)
+
+    @property
+    def jpeg_bytes(self):
+        """Vision API用JPEG（長辺VISION_MAX_EDGE以下。縮小不要なJPEGは元バイト列をそのまま使う）"""
+        def build():
+            if self.vision_bgr is None:
+                return self._pil_jpeg()
+            if not self.vision_resized and self.data[:2] == b'\xff\xd8':
+                return self.data
+            ok, enc = cv2.imencode('.jpg', self.vision_bgr, [cv2.IMWRITE_JPEG_QUALITY, VISION_JPEG_QUALITY])
+            return enc.tobytes() if ok else self.data
+
+        return self._cached('jpeg', build)
+
+    def _pil_jpeg(self):
+        """cv2が無い環境ではPILで縮小・JPEG化（失敗時のみ元バイト列）"""
+        if not PIL_AVAILABLE:
+            return self.data
+        try:
+            img = Image.open(io.BytesIO(self.data))
+            if self.data[:2] == b'\xff\xd8' and fit_within(*img.size, VISION_MAX_EDGE, VISION_MAX_EDGE) is None:
+                return self.data
+            img = ImageOps.exif_transpose(img).convert('RGB')
+            img.thumbnail((VISION_MAX_EDGE, VISION_MAX_EDGE), Image.LANCZOS)
+            out = io.BytesIO()
+            img.save(out, format='JPEG', quality=VISION_JPEG_QUALITY)
+            return out.getvalue()
+        except Exception as e:
+            print(f"Vision payload encode error: {e}")
+            return self.data
+
+    @property
+    def base64_jpeg(self):
+        """Vision API用のBase64文字列（リクエストごとに1回だけエンコード）"""
+        return self._cached('b64', lambda: base64.b64encode(self.jpeg_bytes).decode('utf-8'))
+
+    def vision_image_part(self, detail='low'):
+        """chat completionのcontentに入れるimage_urlパート（Base64は共有、detailは呼び出しごと）"""
+        return {
+            'type': 'image_url',
+            'image_url': {'url': f'data:image/jpeg;base64,{self.base64_jpeg}', 'detail': detail}
+        }
+
+
+def as_image_context(image):
+    """パスまたはImageContextを受け取りImageContextを返す（読み込み失敗時はNone）"""
+    if isinstance(image, ImageContext):
+        return image
+    try:
+        return ImageContext.from_path(image)
+    except (OSError, ValueError, TypeError) as e:
+        print(f"Cannot open image: {image} ({e})")
+        return None
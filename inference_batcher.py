@@ -0,0 +1,137 @@
+import os
+import time
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import Future
+
+from metrics import record_inference_batch, set_inference_queue_depth
+
+
+class InferenceBatcher:
+    """同一プロセス内の推論要求をまとめ、1回のバッチ推論で処理するスケジューラ
+
+    最初の要求が届いてから max_wait_ms ミリ秒、または max_batch 件に達するまで待ち、
+    集まった画像を run_batch(items) に渡す。結果は要求元のスレッドへ順に返す。
+    ただし待つのは expect() で予告された要求（前処理中でまもなく届くもの）がある間だけで、
+    他に推論待ちが無い1件はすぐに推論する（1件ずつの要求に待ち時間を足さない）。
+    バッチ推論は専用の1スレッドだけが行う（要求元はFutureで結果を待つ。enqueueを使えば
+    イベントループ上からも待てる）。
+    --preloadのfork後はワーカープロセスごとにキューとスレッドを作り直す。
+    """
+
+    def __init__(self, run_batch, max_batch=8, max_wait_ms=5.0, name='inference-batcher'):
+        self.run_batch = run_batch
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.name = name
+        self._lock = threading.Lock()
+        self._expected = 0
+        self._queue = None
+        self._pid = None
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._requests = 0
+        self._batches = 0
+        self._batch_sizes = Counter()
+        self._max_queue_depth = 0
+        self._wait_ms_total = 0.0
+
+    def _ensure_worker(self):
+        """ワーカースレッドを起動（fork後の子プロセスでは作り直す）"""
+        if self._pid == os.getpid():
+            return self._queue
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._expected = 0
+                self._reset_stats()
+                threading.Thread(target=self._worker, args=(self._queue,), name=self.name, daemon=True).start()
+                self._pid = os.getpid()
+        return self._queue
+
+    def expect(self):
+        """これから1件を依頼することを予告（前処理の前に呼ぶ。依頼しない場合はcancel_expect()）"""
+        self._ensure_worker()
+        with self._lock:
+            self._expected += 1
+
+    def cancel_expect(self):
+        """expect()した依頼を取りやめる（前処理の失敗時など）"""
+        with self._lock:
+            self._expected = max(0, self._expected - 1)
+
+    def enqueue(self, item, expected=False):
+        """1件分の推論を依頼し、結果のFutureを返す（expected: expect()で予告済みの依頼）"""
+        q = self._ensure_worker()
+        future = Future()
+        with self._lock:
+            # キューに入れてから予告を減らす（ワーカーが予告なし・キュー空と見て先に推論しないように）
+            q.put((item, future, time.perf_counter()))
+            if expected:
+                self._expected = max(0, self._expected - 1)
+            self._requests += 1
+            depth = q.qsize()
+            self._max_queue_depth = max(self._max_queue_depth, depth)
+        set_inference_queue_depth(depth)
+        return future
+
+    def submit(self, item, expected=False):
+        """1件分の推論を依頼し、結果が出るまで待つ（推論の例外はそのまま送出）"""
+        return self.enqueue(item, expected).result()
+
+    def _worker(self, q):
+        while True:
+            batch = [q.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(q.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+                remaining = deadline - time.perf_counter()
+                # 予告された要求が無ければ、これ以上は集まらないのですぐに推論する
+                if remaining <= 0 or not self._expected:
+                    break
+                try:
+                    batch.append(q.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            set_inference_queue_depth(q.qsize())
+            self._run(batch)
+
+    def _run(self, batch):
+        started = time.perf_counter()
+        with self._lock:
+            self._batches += 1
+            self._batch_sizes[len(batch)] += 1
+            self._wait_ms_total += sum((started - queued) * 1000 for _, _, queued in batch)
+        record_inference_batch(len(batch))
+        try:
+            results = self.run_batch([item for item, _, _ in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f"run_batch returned {len(results)} results for {len(batch)} items")
+            for (_, future, _), result in zip(batch, results):
+                # 待ち側がキャンセルした要求（asyncioのタイムアウトなど）には結果を設定しない
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def stats(self):
+        """キューの深さ・バッチサイズなどの集計（このワーカープロセス分）"""
+        with self._lock:
+            images = sum(size * count for size, count in self._batch_sizes.items())
+            return {
+                'queue_depth': self._queue.qsize() if self._pid == os.getpid() else 0,
+                'max_queue_depth': self._max_queue_depth,
+                'requests': self._requests,
+                'batches': self._batches,
+                'mean_batch_size': round(images / self._batches, 3) if self._batches else 0.0,
+                'batch_sizes': {str(size): count for size, count in sorted(self._batch_sizes.items())},
+                'mean_queue_wait_ms': round(self._wait_ms_total / images, 3) if images else 0.0,
+            }
@@ -0,0 +1,84 @@
+import os
+import json
+import asyncio
+import hashlib
+
+from cache_store import get_cache
+
+# OpenAI応答キャッシュ（モデル・プロンプト・入力画像から作るキーで全ワーカー共有）
+LLM_CACHE_TTL = int(os.getenv('EMOTABI_LLM_CACHE_TTL', str(7 * 24 * 3600)))
+LLM_CACHE_MAX = int(os.getenv('EMOTABI_LLM_CACHE_MAX', '5000'))
+
+llm_cache = get_cache('llm', max_entries=LLM_CACHE_MAX, default_ttl=LLM_CACHE_TTL)
+
+# API呼び出し前に acquire() するレート制限（バッチ処理などで設定。キャッシュヒット時は消費しない）
+_rate_limiter = None
+
+
+def set_rate_limiter(limiter):
+    """OpenAI呼び出しのレート制限を設定（acquire()を持つオブジェクト、Noneで解除）"""
+    global _rate_limiter
+    _rate_limiter = limiter
+
+
+def completion_cache_key(model, messages, **params):
+    """モデル・メッセージ（画像はBase64ごと）・生成パラメータのハッシュ"""
+    payload = json.dumps(
+        {'model': model, 'messages': messages, 'params': params},
+        sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def cached_chat_completion(client, model, messages, validate=None, timeout=None, **params):
+    """chat completionの本文をキャッシュ付きで取得
+
+    validateが偽を返す応答（空・JSON不正など）はキャッシュしない。
+    timeoutはキーに含めない。API呼び出しの例外は呼び出し元にそのまま送出する。
+    """
+    key = completion_cache_key(model, messages, **params)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        return cached
+
+    if timeout is not None:
+        params['timeout'] = timeout
+    if _rate_limiter is not None:
+        _rate_limiter.acquire()
+    response = client.chat.completions.create(model=model, messages=messages, **params)
+    content = response.choices[0].message.content
+
+    if content and (validate is None or validate(content)):
+        llm_cache.set(key, content)
+    return content
+
+
+async def cached_chat_completion_async(client, model, messages, validate=None, timeout=None, **params):
+    """cached_chat_completionの非同期版（clientはAsyncOpenAI、キャッシュの読み書きはスレッドで実行）"""
+    key = completion_cache_key(model, messages, **params)
+    cached = await asyncio.to_thread(llm_cache.get, key)
+    if cached is not None:
+        return cached
+
+    if timeout is not None:
+        params['timeout'] = timeout
+    if _rate_limiter is not None:
+        await asyncio.to_thread(_rate_limiter.acquire)
+    response = await client.chat.completions.create(model=model, messages=messages, **params)
+    content = response.choices[0].message.content
+
+    if content and (validate is None or validate(content)):
+        await asyncio.to_thread(llm_cache.set, key, content)
+    return content
+
+
+def is_json_with(*keys):
+    """指定キーを含むJSONオブジェクトかどうかを判定するvalidateを作る"""
+    def validate(content):
+        try:
+            payload = json.loads(content)
+        except (TypeError, ValueError):
+            return False
+        return isinstance(payload, dict) and all(k in payload for k in keys)
+    return validate
+
@@ -0,0 +1,188 @@
+"""処理段階ごとの計測（Server-Timingヘッダー・Prometheus形式の /metrics）
+
+stage('yolo') などで囲んだ区間の所要時間を、リクエストごとのServer-Timingと
+Prometheusのヒストグラム（emotabi_stage_seconds）の両方に記録する。
+gunicornの複数ワーカー分は PROMETHEUS_MULTIPROC_DIR（start.shで設定）のファイル経由で集計する。
+prometheus_clientが無い環境ではServer-Timingだけを出す。
+"""
+import os
+import time
+import inspect
+import functools
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess
+    )
+    PROMETHEUS_AVAILABLE = True
+except ImportError:
+    PROMETHEUS_AVAILABLE = False
+
+MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+
+# 段階の所要時間のバケット（秒）: 数msの色抽出から数十秒のAPI待ちまで
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+if PROMETHEUS_AVAILABLE:
+    STAGE_SECONDS = Histogram('emotabi_stage_seconds', '処理段階ごとの所要時間', ['stage'], buckets=STAGE_BUCKETS)
+    STAGE_ERRORS = Counter('emotabi_stage_errors_total', '例外で終わった処理段階の回数', ['stage'])
+    REQUEST_SECONDS = Histogram('emotabi_request_seconds', 'リクエストの所要時間（応答開始まで）', ['endpoint'],
+                                buckets=STAGE_BUCKETS)
+    REQUESTS = Counter('emotabi_requests_total', 'リクエスト数', ['endpoint', 'status'])
+    IN_FLIGHT = Gauge('emotabi_in_flight_requests', '処理中のリクエスト数', ['endpoint'], multiprocess_mode='livesum')
+    CACHE_REQUESTS = Counter('emotabi_cache_requests_total', 'キャッシュの参照数（result=hit/miss）', ['cache', 'result'])
+    INFERENCE_QUEUE_DEPTH = Gauge('emotabi_inference_queue_depth', '物体検出のマイクロバッチ待ちの件数',
+                                  multiprocess_mode='livesum')
+    INFERENCE_BATCH_SIZE = Histogram('emotabi_inference_batch_size', '物体検出の1回のバッチ推論の画像数',
+                                     buckets=(1, 2, 3, 4, 6, 8, 12, 16, 32))
+
+# このプロセスでPrometheusに記録するか（CPUプロセスプールの子では親側の計測と二重にならないよう無効にする）
+_enabled = True
+# 実行中のリクエストの計測（スレッドプールへは in_request_context で引き継ぐ）
+_current = contextvars.ContextVar('emotabi_request_timings', default=None)
+
+
+def disable():
+    """このプロセスではPrometheusへの記録を行わない"""
+    global _enabled
+    _enabled = False
+
+
+def _recording():
+    return PROMETHEUS_AVAILABLE and _enabled
+
+
+class RequestTimings:
+    """1リクエスト分の段階ごとの所要時間（複数スレッドから追加される）"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            total, count = self._entries.get(name, (0.0, 0))
+            self._entries[name] = (total + seconds, count + 1)
+
+    def header(self):
+        """Server-Timingヘッダーの値（同じ段階が複数回あれば合計し、descに回数を入れる）"""
+        with self._lock:
+            entries = list(self._entries.items())
+        parts = []
+        for name, (total, count) in entries:
+            part = f'{name};dur={total * 1000:.1f}'
+            if count > 1:
+                part += f';desc="x{count}"'
+            parts.append(part)
+        parts.append(f'total;dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ', '.join(parts)
+
+
+@contextmanager
+def stage(name):
+    """処理段階の区間を計測（例外時はエラー数も記録して再送出）"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        if _recording():
+            STAGE_ERRORS.labels(name).inc()
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        timings = _current.get()
+        if timings is not None:
+            timings.add(name, elapsed)
+        if _recording():
+            STAGE_SECONDS.labels(name).observe(elapsed)
+
+
+def timed(name):
+    """関数全体を1つの処理段階として計測するデコレーター（async関数にも使える）"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def in_request_context(func):
+    """スレッドプールで実行する関数に、呼び出し元のリクエストの計測を引き継ぐ（並列に呼んでもよい）"""
+    parent = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return parent.copy().run(func, *args, **kwargs)
+    return wrapper
+
+
+def record_cache(cache, hit):
+    """キャッシュのヒット/ミス（ヒット率はPrometheus側で hit / (hit + miss) として計算）"""
+    if _recording():
+        CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+def set_inference_queue_depth(depth):
+    """マイクロバッチのキューの深さ（全ワーカーの合計を /metrics に出す）"""
+    if _recording():
+        INFERENCE_QUEUE_DEPTH.set(depth)
+
+
+def record_inference_batch(size):
+    """バッチ推論1回分の画像数（平均バッチサイズは _sum / _count で計算）"""
+    if _recording():
+        INFERENCE_BATCH_SIZE.observe(size)
+
+
+def begin_request(endpoint):
+    """リクエストの計測を開始。戻り値: finish_requestに渡すトークン"""
+    if _recording():
+        IN_FLIGHT.labels(endpoint).inc()
+    timings = RequestTimings()
+    return endpoint, timings, _current.set(timings)
+
+
+def finish_request(token, status):
+    """リクエストの計測を終了。戻り値: Server-Timingヘッダーの値"""
+    endpoint, timings, var_token = token
+    try:
+        _current.reset(var_token)
+    except ValueError:
+        _current.set(None)  # 開始時と別のコンテキストから呼ばれた場合
+    if _recording():
+        IN_FLIGHT.labels(endpoint).dec()
+        REQUESTS.labels(endpoint, str(status)).inc()
+        REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - timings.started)
+    return timings.header()
+
+
+def render_metrics():
+    """/metrics の本文とContent-Type（全ワーカー分を集計）。prometheus_clientが無い場合はNone"""
+    if not PROMETHEUS_AVAILABLE:
+        return None
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """終了したワーカーのin-flightの値を集計から外す（gunicornのchild_exitから呼ぶ）"""
+    if PROMETHEUS_AVAILABLE and MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
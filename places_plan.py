@@ -0,0 +1,113 @@
+import os
+import unicodedata
+from collections import namedtuple
+
+# 1リクエストで提案する場所の件数と、1クエリで辿るText Searchの最大ページ数
+PLACES_TARGET_COUNT = 3
+PLACES_MAX_PAGES = int(os.getenv('EMOTABI_PLACES_MAX_PAGES', '2'))
+
+# 提案の表示に使う項目（キャッシュにはこれだけを保存する）
+PLACE_FIELDS = ('place_id', 'name', 'formatted_address', 'rating')
+
+# 実行する検索1回分（page_no > 1 は次ページの取得。page_tokenが無い場合はキャッシュからのみ）
+PlaceSearchStep = namedtuple('PlaceSearchStep', ['key', 'query', 'page_token', 'page_no'])
+
+
+def canonical_query(query):
+    """検索クエリの正規化キー（NFKC・小文字化・空白の統一。語順と重複語は無視）"""
+    tokens = unicodedata.normalize('NFKC', query or '').lower().split()
+    return ' '.join(sorted(set(tokens)))
+
+
+def dedupe_queries(queries):
+    """正規化キーが同じクエリを1つにまとめる。戻り値: [(key, query)]（最初に現れた表記を使う）"""
+    planned = {}
+    for query in queries:
+        key = canonical_query(query)
+        if key and key not in planned:
+            planned[key] = query
+    return list(planned.items())
+
+
+def page_cache_key(language, key, page_no=1):
+    """Text Searchの1ページ分のキャッシュキー"""
+    return f"{language}:{key}" if page_no == 1 else f"{language}:{key}#p{page_no}"
+
+
+def trim_place(place):
+    """Text Search / Detailsの結果から表示に使う項目だけを残す"""
+    trimmed = {field: place[field] for field in PLACE_FIELDS if field in place}
+    photos = [
+        {'photo_reference': photo['photo_reference']}
+        for photo in place.get('photos', [])[:1] if photo.get('photo_reference')
+    ]
+    if photos:
+        trimmed['photos'] = photos
+    return trimmed
+
+
+def needs_details(place):
+    """Text Searchの結果だけでは表示項目が足りない場合のみPlace Detailsを取得する"""
+    return bool(place.get('place_id')) and not (place.get('formatted_address') and place.get('photos'))
+
+
+class PlacesPlan:
+    """重複しないplace_idを必要件数だけ集めるための検索計画
+
+    語順だけが違うクエリは同じ正規化キーにまとめ、1回の検索で件数が揃えば残りは実行しない。
+    足りない場合の次の手順は、キャッシュ済みのクエリ（API呼び出しなし）→ 取得済みクエリの次ページ
+    （既出の場所と重ならない）→ 未実行のクエリ、の順に選ぶ。
+    """
+
+    def __init__(self, queries, count=PLACES_TARGET_COUNT, max_pages=PLACES_MAX_PAGES):
+        self.pending = dedupe_queries(queries)
+        self.count = count
+        self.max_pages = max_pages
+        self.places = []
+        self.seen_place_ids = set()
+        self.next_pages = []
+        self.searches = 0
+
+    @property
+    def done(self):
+        return len(self.places) >= self.count
+
+    def pending_keys(self):
+        """未実行のクエリの正規化キー（キャッシュの事前確認用）"""
+        return [key for key, _ in self.pending]
+
+    def use_cached(self, pages):
+        """キャッシュ済みのページ（{key: page}）を先に取り込む"""
+        for key, query in list(self.pending):
+            if self.done:
+                break
+            page = pages.get(key)
+            if page is not None:
+                self.pending.remove((key, query))
+                self.add_page(key, query, page)
+
+    def next_step(self):
+        """次に実行する検索（PlaceSearchStep）。件数が揃ったか候補が尽きた場合はNone"""
+        if self.done:
+            return None
+        if self.next_pages:
+            return self.next_pages.pop(0)
+        if self.pending:
+            key, query = self.pending.pop(0)
+            return PlaceSearchStep(key, query, None, 1)
+        return None
+
+    def add_page(self, key, query, page, page_no=1):
+        """検索結果1ページ分を取り込み、未出のplace_idを件数に達するまで採用"""
+        self.searches += 1
+        for place in page.get('places', []):
+            if self.done:
+                break
+            place_id = place.get('place_id')
+            if place_id and place_id not in self.seen_place_ids:
+                self.seen_place_ids.add(place_id)
+                self.places.append(place)
+        # キャッシュから読んだページはトークンを持たず has_next_page だけが付く（次ページはキャッシュのみ）
+        token = page.get('next_page_token')
+        if (token or page.get('has_next_page')) and page_no < self.max_pages:
+            self.next_pages.append(PlaceSearchStep(key, query, token, page_no + 1))
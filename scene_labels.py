@@ -0,0 +1,6 @@
+# シーン名の候補（雰囲気分析のVision応答スキーマと、物体未検出時のシーン判定で共有）
+# emo_gpt_1・buttaiのどちらかが読み込めなくても、もう一方だけで使えるよう独立させている
+SCENE_LABELS = [
+    'mountain','lake','sea','forest','temple','shrine','castle','tower',
+    'city skyline','night view','sunset','waterfall','park','river','snow','desert','island'
+]
@@ -1,18 +1,37 @@
 import os
+import sys
+import json
+import hashlib
+import tempfile
+import threading
 import cv2
 import numpy as np
 import pandas as pd
-from collections import Counter
-from sklearn.cluster import MiniBatchKMeans
 from PIL import Image
 from functools import lru_cache
+from image_context import as_image_context
+from cpu_pool import pool_enabled, run_in_pool, analyze_colors_task
+from metrics import timed
 
 # CSVファイルの場所（アプリ直下）
 # Dockerコンテナでは作業ディレクトリが/appになる
 CSV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output_emo.csv')
 
+# 事前計算インデックス（RGBルックアップテーブル + 単語IDマトリクス）の保存先
+INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'color_index')
+INDEX_BINS = 32  # 各チャンネルのビン数（32×32×32）
+
+# 色抽出用サムネイルのサイズ(w, h)
+THUMBNAIL_SIZE = (150, 100)
+
+# 色量子化エンジン: 'kmeans'（MiniBatchKMeans）または 'mediancut'（NumPyのみ・決定的）
+QUANTIZER = os.getenv('SHIKISAI_QUANTIZER', 'kmeans').strip().lower()
+HIST_BITS = 5  # メディアンカット用ヒストグラムの1チャンネルあたりのビット数（32段階）
+
 # グローバルキャッシュでデータ読み込みを1回だけに
 _emotion_mapping_cache = None
+_color_index_cache = None
+_color_index_lock = threading.Lock()
 
 def load_emotion_mapping(path=CSV_PATH):
     """感情マッピングデータの読み込み（フォールバック機能付き）"""
@@ -45,15 +64,280 @@ def load_emotion_mapping(path=CSV_PATH):
     
     return _emotion_mapping_cache
 
-def extract_colors(image, num_colors=5, sample_size=2000):
-    """色抽出（メモリ効率改善版）"""
-    # 1) 低解像度リサイズ（メモリ効率向上）
-    img = cv2.resize(image, (150, 100), interpolation=cv2.INTER_AREA)
-    pixels = img.reshape(-1, 3)
+def _csv_digest(path):
+    """CSVの内容ハッシュ（インデックスの鮮度確認用）"""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def _resolve_csv_path(path=CSV_PATH):
+    """load_emotion_mappingと同じ順序で実在するCSVパスを探す"""
+    for csv_path in [path, '/app/output_emo.csv', os.path.join(os.getcwd(), 'output_emo.csv'), 'output_emo.csv']:
+        if os.path.exists(csv_path):
+            return csv_path
+    return None
+
+def build_color_index(df=None, bins=INDEX_BINS):
+    """CSVから色→感情インデックスを構築
+
+    lut:   (bins, bins, bins) 各RGBビンの最近傍CSV行番号（境界ビンは番兵値）
+    rgb:   (行数, 3) 各行のRGB（境界ビンの厳密計算用）
+    words: (行数, word列数) 語彙IDマトリクス（空欄は-1）
+    vocab: 語彙（ユニコード配列、mmap可能）
+    """
+    if df is None:
+        df = load_emotion_mapping()
+
+    word_cols = [col for col in df.columns if col.startswith('word')]
+    vocab = []
+    vocab_ids = {}
+    words = np.full((len(df), max(len(word_cols), 1)), -1, dtype=np.int16)
+
+    for i, row in enumerate(df[word_cols].itertuples(index=False, name=None)):
+        # cached_color_distance と同じく欠損・空文字を除外
+        emotions = [w for w in row if isinstance(w, str) and w.strip()]
+        if not emotions:
+            emotions = ['api error']
+        for j, w in enumerate(emotions):
+            if w not in vocab_ids:
+                vocab_ids[w] = len(vocab)
+                vocab.append(w)
+            words[i, j] = vocab_ids[w]
+
+    # 各RGBビン（8×8×8の整数色ブロック）の最近傍行を事前計算。
+    # ボロノイ領域は凸なので、ビンの8頂点の最近傍が一致すればビン全体がその行になる。
+    # 頂点が一致しないビン（境界上）は番兵値にして参照時に厳密計算する。
+    rgb = df[['R', 'G', 'B']].to_numpy(dtype=np.int32)
+    step = 256 // bins
+    lo = np.arange(bins, dtype=np.int32) * step
+    corners = np.stack([lo, lo + step - 1], axis=1).reshape(-1)  # (2*bins,)
+    dtype = np.uint8 if len(df) < np.iinfo(np.uint8).max else np.uint16
+    nearest = np.empty((2 * bins,) * 3, dtype=dtype)
+    gg, bb = np.meshgrid(corners, corners, indexing='ij')
+    for i, r in enumerate(corners):
+        pts = np.stack([np.full(gg.size, r, dtype=np.int32), gg.ravel(), bb.ravel()], axis=1)
+        d = ((pts[:, None, :] - rgb[None, :, :]) ** 2).sum(axis=2)
+        nearest[i] = d.argmin(axis=1).reshape(gg.shape)
+
+    nearest = nearest.reshape(bins, 2, bins, 2, bins, 2)
+    lut = nearest[:, 0, :, 0, :, 0].copy()
+    uniform = np.ones(lut.shape, dtype=bool)
+    for dr in (0, 1):
+        for dg in (0, 1):
+            for db in (0, 1):
+                uniform &= nearest[:, dr, :, dg, :, db] == lut
+    lut[~uniform] = np.iinfo(dtype).max
+
+    return {'lut': lut, 'rgb': rgb, 'words': words, 'vocab': np.array(vocab, dtype=str)}
+
+def _replace_atomically(path, write, mode='wb'):
+    """同じディレクトリの一意な一時ファイルに書き込んでから置き換える（同時に書いても混ざらない）"""
+    name = os.path.basename(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f'.{name}.', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, mode, **({} if 'b' in mode else {'encoding': 'utf-8'})) as f:
+            write(f)
+        os.chmod(tmp_path, 0o644)  # mkstempは0600で作るため、通常の保存と同じ権限にする
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def save_color_index(index, index_dir=INDEX_DIR, csv_digest=''):
+    """インデックスをmmap可能な.npyとして保存（meta.jsonは最後に書き込む）"""
+    os.makedirs(index_dir, exist_ok=True)
+    for name in ('lut', 'rgb', 'words', 'vocab'):
+        _replace_atomically(os.path.join(index_dir, f'{name}.npy'), lambda f, arr=index[name]: np.save(f, arr))
+
+    meta = {'csv_sha256': csv_digest, 'bins': int(index['lut'].shape[0])}
+    _replace_atomically(os.path.join(index_dir, 'meta.json'), lambda f: json.dump(meta, f), mode='w')
+
+def _prepare_vote_tables(index):
+    """単語IDマトリクスから投票用テーブル（行×語彙の出現数・初出位置）を作る"""
+    words = np.asarray(index['words'])
+    n_rows, n_cols = words.shape
+    n_vocab = len(index['vocab'])
+    counts = np.zeros((n_rows, n_vocab), dtype=np.int32)
+    first = np.full((n_rows, n_vocab), np.iinfo(np.int32).max // 2, dtype=np.int32)
+    for col in range(n_cols - 1, -1, -1):
+        ids = words[:, col]
+        valid = ids >= 0
+        rows = np.nonzero(valid)[0]
+        np.add.at(counts, (rows, ids[valid]), 1)
+        first[rows, ids[valid]] = col
+    index['counts'] = counts
+    index['first'] = first
+    return index
+
+def load_color_index(index_dir=INDEX_DIR, rebuild=False):
+    """色→感情インデックスを取得（保存済みならmmap、古い/無い場合はCSVから再構築）"""
+    global _color_index_cache
+    if _color_index_cache is not None and not rebuild:
+        return _color_index_cache
+
+    # 同じプロセスの複数スレッド（リクエストとプールのフォールバックなど）が同時に構築・保存しない
+    with _color_index_lock:
+        if _color_index_cache is not None and not rebuild:
+            return _color_index_cache
+        _color_index_cache = _load_or_build_color_index(index_dir, rebuild)
+    return _color_index_cache
+
+def _load_or_build_color_index(index_dir, rebuild):
+    csv_path = _resolve_csv_path()
+    digest = _csv_digest(csv_path) if csv_path else ''
+    index = None
+
+    if not rebuild:
+        try:
+            with open(os.path.join(index_dir, 'meta.json'), encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('csv_sha256') == digest and meta.get('bins') == INDEX_BINS:
+                index = {
+                    name: np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode='r')
+                    for name in ('lut', 'rgb', 'words', 'vocab')
+                }
+        except (OSError, ValueError):
+            index = None
+
+    if index is None:
+        index = build_color_index()
+        try:
+            save_color_index(index, index_dir, digest)
+            print(f"Color index built and saved to {index_dir}")
+        except OSError as e:
+            # 読み取り専用環境ではメモリ上のインデックスのみ使用
+            print(f"Color index could not be saved ({e}); using in-memory index")
+
+    return _prepare_vote_tables(index)
+
+def match_color_emotions(centers, weights=None):
+    """パレット中心色をまとめてインデックス参照し、最多得票の感情語を返す
+
+    weights未指定時は各色1票（従来のCounterによる集計と同じ）。
+    同票の場合は先に出現した語を優先する。
+    """
+    index = load_color_index()
+    lut = index['lut']
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+    if len(centers) == 0:
+        return 'api error'
+
+    bins = lut.shape[0]
+    colors = np.clip(centers, 0, 255).astype(np.int64)
+    q = (colors * bins) // 256
+    rows = np.asarray(lut[q[:, 0], q[:, 1], q[:, 2]], dtype=np.intp)
 
-    # 2) ピクセル数が多い場合はランダムサンプリング
+    # 境界ビンに落ちた色だけ全行との距離で最近傍を求める
+    boundary = rows == np.iinfo(lut.dtype).max
+    if boundary.any():
+        rgb = np.asarray(index['rgb'], dtype=np.int64)
+        d = ((colors[boundary, None, :] - rgb[None, :, :]) ** 2).sum(axis=2)
+        rows[boundary] = d.argmin(axis=1)
+
+    if weights is None:
+        weights = np.ones(len(rows))
+    weights = np.asarray(weights, dtype=np.float64).reshape(-1, 1)
+
+    votes = (index['counts'][rows] * weights).sum(axis=0)
+    n_cols = index['words'].shape[1]
+    offsets = (np.arange(len(rows)) * n_cols).reshape(-1, 1)
+    first = (index['first'][rows] + offsets).min(axis=0)
+
+    order = np.lexsort((first, -votes))
+    top = order[0]
+    if votes[top] <= 0:
+        return 'api error'
+    return str(index['vocab'][top])
+
+def median_cut_colors(pixels, num_colors=5, refine_iters=2):
+    """3Dヒストグラム＋メディアンカットによる色量子化（NumPyのみ・完全に決定的）
+
+    pixels: (N, 3) uint8。ヒストグラムの非空ビンを単位として、
+    二乗誤差が最大のボックスを分散最大の軸の加重中央値で分割していく。
+    最後にビン単位のk-means更新を数回行い中心を整える。
+    """
+    pixels = np.asarray(pixels, dtype=np.uint8).reshape(-1, 3)
+    shift = 8 - HIST_BITS
+    q = (pixels >> shift).astype(np.int64)
+    keys = (q[:, 0] << (2 * HIST_BITS)) | (q[:, 1] << HIST_BITS) | q[:, 2]
+    n_bins = 1 << (3 * HIST_BITS)
+
+    # 非空ビンごとの画素数と平均色
+    hist = np.bincount(keys, minlength=n_bins)
+    nz = np.nonzero(hist)[0]
+    weights = hist[nz].astype(np.float64)
+    sums = np.stack([
+        np.bincount(keys, weights=pixels[:, ch], minlength=n_bins)[nz] for ch in range(3)
+    ], axis=1)
+    colors = sums / weights[:, None]
+
+    def box_stats(idx):
+        w = weights[idx]
+        c = colors[idx]
+        mean = (c * w[:, None]).sum(axis=0) / w.sum()
+        var = ((c - mean) ** 2 * w[:, None]).sum(axis=0)
+        return var.sum(), int(var.argmax())
+
+    boxes = [np.arange(len(nz))]
+    stats = [box_stats(boxes[0])]
+    while len(boxes) < num_colors:
+        # 分割可能（2ビン以上）で二乗誤差が最大のボックスを選ぶ
+        scores = [sse if len(b) > 1 else -1.0 for b, (sse, _) in zip(boxes, stats)]
+        target = int(np.argmax(scores))
+        if scores[target] <= 0:
+            break
+        idx = boxes[target]
+        axis = stats[target][1]
+        order = idx[np.argsort(colors[idx, axis], kind='stable')]
+        cum = np.cumsum(weights[order])
+        cut = int(np.searchsorted(cum, cum[-1] / 2))
+        cut = min(max(cut, 1), len(order) - 1)
+        left, right = order[:cut], order[cut:]
+        boxes[target:target + 1] = [left, right]
+        stats[target:target + 1] = [box_stats(left), box_stats(right)]
+
+    labels = np.empty(len(nz), dtype=np.int64)
+    for i, idx in enumerate(boxes):
+        labels[idx] = i
+    k = len(boxes)
+
+    # ビン単位のk-means更新（決定的）
+    for it in range(refine_iters + 1):
+        totals = np.bincount(labels, weights=weights, minlength=k)
+        centers = np.stack([
+            np.bincount(labels, weights=sums[:, ch], minlength=k) for ch in range(3)
+        ], axis=1) / np.maximum(totals, 1)[:, None]
+        if it == refine_iters:
+            break
+        d = ((colors[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        labels = d.argmin(axis=1)
+
+    # 空クラスタを除外して出現数の多い順に並べる
+    keep = totals > 0
+    counts, centers = totals[keep].astype(np.int64), centers[keep]
+    order = np.argsort(-counts, kind='stable')
+    return counts[order], centers[order]
+
+def extract_colors(image, num_colors=5, sample_size=2000, method=None):
+    """色抽出（メモリ効率改善版）。methodで量子化エンジンを切り替え（既定はQUANTIZER）"""
+    # 1) 低解像度リサイズ（メモリ効率向上、共有サムネイル済みならそのまま）
+    if image.shape[1::-1] != THUMBNAIL_SIZE:
+        image = cv2.resize(image, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+    pixels = image.reshape(-1, 3)
+
+    # ヒストグラム方式はサンプリング不要（全画素を1回集計するだけ）
+    if (method or QUANTIZER) == 'mediancut':
+        return median_cut_colors(pixels, num_colors=num_colors)
+
+    # sklearnはKMeans使用時のみ読み込む
+    from sklearn.cluster import MiniBatchKMeans
+
+    # 2) ピクセル数が多い場合はランダムサンプリング（シード固定で同じ画像は同じパレット）
     if pixels.shape[0] > sample_size:
-        idx = np.random.choice(pixels.shape[0], sample_size, replace=False)
+        rng = np.random.default_rng(42)
+        idx = rng.choice(pixels.shape[0], sample_size, replace=False)
         pixels = pixels[idx]
 
     # 3) MiniBatchKMeans による高速クラスタリング（最適化）
@@ -71,18 +355,14 @@ def extract_colors(image, num_colors=5, sample_size=2000):
     order = counts.argsort()[::-1]
     return counts[order], centers[order]
 
-def extract_palette_hex(image_path, num_colors=5):
-    """上位色のHEXパレットを返す（保存なし）"""
-    try:
-        img = cv2.imread(image_path)
-        if img is None:
-            return []
-        rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        _, centers = extract_colors(rgb, num_colors=num_colors)
-        hex_colors = [f"#{int(c[0]):02x}{int(c[1]):02x}{int(c[2]):02x}" for c in centers]
-        return hex_colors[:num_colors]
-    except Exception:
-        return []
+def to_hex_palette(centers, num_colors=5):
+    """クラスタ中心をHEX文字列のリストに変換"""
+    hex_colors = [f"#{int(c[0]):02x}{int(c[1]):02x}{int(c[2]):02x}" for c in centers]
+    return hex_colors[:num_colors]
+
+def extract_palette_hex(image, num_colors=5):
+    """上位色のHEXパレットを返す（保存なし）。imageはパスまたはImageContext"""
+    return analyze_colors(image, num_colors=num_colors)['palette']
 
 def create_color_pie_chart(counts, centers, image_path):
     """円グラフ作成（無効化）"""
@@ -109,48 +389,50 @@ def cached_color_distance(r, g, b, df_hash):
         # word列がない場合はエラー
         return ['api error']
 
-def get_color_emotions(image_path):
-    """色感情分析（最適化＆エラーハンドリング強化版）"""
+@timed('color')
+def analyze_colors(image, num_colors=5, in_process=False):
+    """色抽出を1回だけ実行し、出現数・中心色・HEXパレット・感情をまとめて返す
+
+    imageはパスまたはImageContext。表示用パレットと感情判定は同じ抽出結果から作られる。
+    CPUプロセスプール有効時（in_process=Falseの場合）は子プロセスで実行する。
+    失敗時は emotion='api error'、palette=[] を返す。
+    """
+    result = {'emotion': 'api error', 'chart': '', 'palette': [], 'counts': [], 'centers': []}
     try:
-        # 画像読み込み
-        img = cv2.imread(image_path)
-        if img is None:
-            print(f"Cannot open image: {image_path}")
-            return 'api error', ''
-            
-        rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        df = load_emotion_mapping()
-        
-        # 色抽出
-        counts, centers = extract_colors(rgb)
+        # 共有コンテキストから取得（パス指定時のみ読み込み）
+        ctx = as_image_context(image)
+        if ctx is None or ctx.bgr is None:
+            return result
 
-        words = []
-        df_hash = hash(tuple(df.values.flatten()))  # DataFrameのハッシュ値作成
+        if pool_enabled() and not in_process:
+            # 子プロセスで抽出（画像は共有メモリ経由。プール破損時はこのプロセスで実行）
+            return run_in_pool(analyze_colors_task, ctx.bgr, num_colors,
+                               fallback=lambda: analyze_colors(ctx, num_colors, in_process=True))
         
-        # 各色について感情を取得（キャッシュ使用）
-        for c in centers:
-            try:
-                color_emotions = cached_color_distance(
-                    int(c[0]), int(c[1]), int(c[2]), df_hash
-                )
-                words.extend(color_emotions)
-            except Exception as e:
-                print(f"Error processing color {c}: {e}")
-                continue
+        # 色抽出（1回のみ）
+        counts, centers = extract_colors(ctx.resized_rgb(THUMBNAIL_SIZE), num_colors=num_colors)
+        result['counts'] = counts.tolist()
+        result['centers'] = centers.tolist()
+        result['palette'] = to_hex_palette(centers, num_colors)
 
-        # 最頻感情を取得
-        if words:
-            top = Counter(words).most_common(1)[0][0]
-        else:
-            top = 'api error'  # エラー時
-
-        # チャート作成は無効化
-        chart = ''
-        return top, chart
+        # 事前計算インデックスで全パレット色を一括照合（最頻感情を取得）
+        result['emotion'] = match_color_emotions(centers)
+        return result
         
     except FileNotFoundError as e:
         print(f"File not found: {e}")
-        return 'api error', ''
+        return result
     except Exception as e:
         print(f"Error in color emotion analysis: {e}")
-        return 'api error', '' 
\ No newline at end of file
+        return result
+
+def get_color_emotions(image):
+    """色感情分析（最適化＆エラーハンドリング強化版）。imageはパスまたはImageContext"""
+    result = analyze_colors(image)
+    # チャート作成は無効化
+    return result['emotion'], result['chart']
+
+if __name__ == '__main__':
+    # Dockerビルド時などにインデックスを事前生成: python shikisai.py --build-index
+    if '--build-index' in sys.argv:
+        load_color_index(rebuild=True)
@@ -15,7 +15,7 @@ echo "Working Directory: $(pwd)"
 FINAL_PORT=${PORT:-10000}
 echo "Using port: $FINAL_PORT"
 
-# 必要なディレクトリ作成（chartsは不要）
+# 必要なディレクトリ作成（chartsは不要、uploadsはEMOTABI_DEBUG_CAPTURE有効時のみ使用）
 echo "Creating required directories..."
 mkdir -p static/uploads static/images static/css static/js
 chmod 755 static/uploads
@@ -32,13 +32,30 @@ if [ ! -d "templates" ]; then
     exit 1
 fi
 
+# サーバーモード（sync: 従来のWSGI / async: uvicornワーカーでASGI、/analyzeをイベントループ上で処理）
+SERVER_MODE=${EMOTABI_SERVER_MODE:-sync}
+if [ "$SERVER_MODE" = "async" ]; then
+    WORKER_CLASS=uvicorn.workers.UvicornWorker
+    APP_MODULE=asgi:app
+else
+    WORKER_CLASS=sync
+    APP_MODULE=app:app
+fi
+echo "Server mode: $SERVER_MODE ($WORKER_CLASS)"
+
+# /metrics用の集計ディレクトリ（全ワーカーの計測をここのファイル経由で合算する。前回起動分は消す）
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/emotabi_metrics}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
 echo "All checks passed. Starting Gunicorn server..."
 
 # プロダクション用Gunicorn設定
 exec gunicorn \
+    --config gunicorn.conf.py \
     --bind 0.0.0.0:$FINAL_PORT \
     --workers 2 \
-    --worker-class sync \
+    --worker-class $WORKER_CLASS \
     --worker-connections 1000 \
     --timeout 120 \
     --keep-alive 5 \
@@ -49,4 +66,4 @@ exec gunicorn \
     --access-logfile - \
     --error-logfile - \
     --capture-output \
-    app:app 
\ No newline at end of file
+    $APP_MODULE 
\ No newline at end of file
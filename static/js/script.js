@@ -44,17 +44,22 @@ function createParticles() {
 function animateCards() {
   const cards = document.querySelectorAll('.recommendation-card');
   cards.forEach((card, index) => {
-    card.style.opacity = '0';
-    card.style.transform = 'translateY(30px)';
-    
-    setTimeout(() => {
-      card.style.transition = 'opacity 0.6s ease, transform 0.6s ease';
-      card.style.opacity = '1';
-      card.style.transform = 'translateY(0)';
-    }, index * 150);
+    animateCard(card, index * 150);
   });
 }
 
+// カード1枚のフェードインアニメーション
+function animateCard(card, delay = 0) {
+  card.style.opacity = '0';
+  card.style.transform = 'translateY(30px)';
+  
+  setTimeout(() => {
+    card.style.transition = 'opacity 0.6s ease, transform 0.6s ease';
+    card.style.opacity = '1';
+    card.style.transform = 'translateY(0)';
+  }, delay);
+}
+
 // 感情分析のプログレスバーアニメーション
 function animateEmotionAnalysis() {
   const emotionItems = document.querySelectorAll('.emotion-item');
@@ -469,22 +474,28 @@ document.getElementById('analyze-form').addEventListener('submit', async functio
   try {
     console.log('📁 サーバーへ送信中...');
     
-    const response = await fetch('/analyze', {
+    // ストリーミング版：各分析・各提案が得られた順に表示
+    const response = await fetch('/analyze/stream', {
       method: 'POST',
       body: formData
     });
     
-    const result = await response.json();
-    
-    if (!response.ok) {
-      throw new Error(result.error || 'サーバーエラーが発生しました');
+    const contentType = response.headers.get('content-type') || '';
+    if (!response.ok || !contentType.includes('text/event-stream') || !response.body) {
+      const result = await response.json();
+      
+      if (!response.ok) {
+        throw new Error(result.error || 'サーバーエラーが発生しました');
+      }
+      
+      // 結果を表示
+      showResults(result);
+      return;
     }
     
+    const result = await readAnalysisStream(response, loadingOverlay);
     console.log('📁 解析成功:', result);
     
-    // 結果を表示
-    showResults(result);
-    
   } catch (error) {
     console.error('📁 エラー:', error);
     showError(error.message);
@@ -494,6 +505,131 @@ document.getElementById('analyze-form').addEventListener('submit', async functio
   }
 });
 
+// Server-Sent Eventsの応答を読み、イベントごとに結果を表示（'done'の本文を返す）
+async function readAnalysisStream(response, loadingOverlay) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let started = false;
+  
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    
+    let separator;
+    while ((separator = buffer.indexOf('\n\n')) !== -1) {
+      const { event, data } = parseServerEvent(buffer.slice(0, separator));
+      buffer = buffer.slice(separator + 2);
+      if (!event) continue;
+      
+      if (event === 'error') {
+        throw new Error(data.error || 'サーバーエラーが発生しました');
+      }
+      
+      // 最初の結果が届いた時点でローディングを閉じて結果セクションを開く
+      if (!started) {
+        started = true;
+        loadingOverlay.classList.remove('active');
+        beginStreamingResults();
+      }
+      
+      handleAnalysisEvent(event, data);
+      if (event === 'done') {
+        return data;
+      }
+    }
+  }
+  
+  throw new Error('サーバーとの接続が切断されました');
+}
+
+// SSEの1イベント分（event: / data: 行）を解釈
+function parseServerEvent(raw) {
+  let event = '';
+  const dataLines = [];
+  raw.split('\n').forEach(line => {
+    if (line.startsWith('event:')) {
+      event = line.slice(6).trim();
+    } else if (line.startsWith('data:')) {
+      dataLines.push(line.slice(5).trim());
+    }
+  });
+  return { event, data: dataLines.length ? JSON.parse(dataLines.join('\n')) : {} };
+}
+
+// ストリーミング表示の開始（結果欄を空にして待機表示）
+function beginStreamingResults() {
+  const resultsSection = document.getElementById('results');
+  resultsSection.classList.remove('hidden');
+  
+  ['color-emotion', 'object-emotion', 'atmosphere-emotion'].forEach(id => {
+    const value = document.getElementById(id);
+    value.textContent = '...';
+    delete value.closest('.emotion-item').dataset.revealed;
+  });
+  document.getElementById('suggestions-list').innerHTML = '';
+  
+  scrollToResults();
+}
+
+// 分析1件分の結果を表示（最初の表示時のみ、animateEmotionAnalysisと同じ登場アニメーション）
+function revealEmotion(id, text) {
+  const value = document.getElementById(id);
+  const item = value.closest('.emotion-item');
+  if (!item.dataset.revealed) {
+    item.dataset.revealed = '1';
+    item.style.transition = 'none';
+    item.style.opacity = '0';
+    item.style.transform = 'scale(0.8)';
+    // 初期状態を反映させてから遷移させる
+    void item.offsetWidth;
+    item.style.transition = 'opacity 0.6s ease, transform 0.6s ease';
+    item.style.opacity = '1';
+    item.style.transform = 'scale(1)';
+  }
+  
+  value.style.transition = 'color 0.3s ease';
+  value.style.color = '#c9a96e';
+  value.textContent = text;
+  
+  setTimeout(() => {
+    value.style.color = '#2c2c2c';
+  }, 300);
+}
+
+function handleAnalysisEvent(event, data) {
+  const suggestionsList = document.getElementById('suggestions-list');
+  
+  switch (event) {
+    case 'color':
+      revealEmotion('color-emotion', data.emotion);
+      break;
+    case 'object':
+      revealEmotion('object-emotion', data.emotion);
+      break;
+    case 'atmosphere':
+      revealEmotion('atmosphere-emotion', data.emotion);
+      break;
+    case 'suggestion': {
+      const card = createRecommendationCard(data, data.index);
+      suggestionsList.appendChild(card);
+      animateCard(card);
+      break;
+    }
+    case 'done':
+      // 提案が1件も届かなかった場合（APIキー未設定の案内など）は最終結果から表示
+      if (!suggestionsList.children.length) {
+        data.suggestions.forEach((item, index) => {
+          const card = createRecommendationCard(item, index);
+          suggestionsList.appendChild(card);
+          animateCard(card, index * 150);
+        });
+      }
+      break;
+  }
+}
+
 function showError(message) {
   // エラーメッセージを表示（アニメーション付き）
   const errorDiv = document.createElement('div');